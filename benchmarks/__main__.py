@@ -0,0 +1,95 @@
+"""benchmarks of the ingestion, clustering and classification hot paths
+
+    python -m benchmarks --sizes 10k 100k --output results.json
+    python -m benchmarks --sizes 10k --baseline results.json
+
+Every case runs in a fresh process so that its peak RSS is not inflated by
+earlier cases. Peak RSS is the high water mark of that process, including
+imports and the synthetic dataset, while the time covers the measured code
+path only. Models are offline stand-ins, so embedding and prediction numbers
+measure the pipeline around the model rather than the model itself.
+"""
+import argparse
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmarks.cases import CASES, MAX_ROWS, run_case
+from benchmarks.datasets import SIZES
+
+
+def run_isolated(name: str, n_rows: int, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            runs.append(executor.submit(run_case, name, n_rows).result())
+    # fastest run, the others mostly measure noise from the rest of the machine
+    best = min(runs, key=lambda run: run["seconds"])
+    best["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    return best
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> tuple[list[str], int]:
+    """lines of the comparison against a baseline and the number of regressions"""
+    lines, regressions = [], 0
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(name, {}).get(size)
+            if not base or not base.get("seconds") or "seconds" not in result:
+                continue
+            time_ratio = result["seconds"] / base["seconds"]
+            rss_ratio = result["peak_rss_mb"] / base["peak_rss_mb"]
+            is_regression = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+            regressions += is_regression
+            lines.append(
+                f"{name:<22}{size:>6}  time x{time_ratio:.2f}  rss x{rss_ratio:.2f}"
+                + ("  REGRESSION" if is_regression else "")
+            )
+    lines.append(f"{regressions} regression(s) beyond {tolerance:.0%}")
+    return lines, regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["10k"])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--output", help="write the results as json to this path")
+    parser.add_argument("--baseline", help="results json of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before flagging")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.cases:
+        for size in args.sizes:
+            n_rows = SIZES[size]
+            if n_rows > MAX_ROWS.get(name, n_rows):
+                result = {"skipped": f"more than {MAX_ROWS[name]} rows"}
+            else:
+                result = run_isolated(name, n_rows, args.repeat)
+            results.setdefault(name, {})[size] = result
+            if "skipped" in result:
+                print(f"{name:<22}{size:>6}  skipped, {result['skipped']}")
+            else:
+                print(
+                    f"{name:<22}{size:>6}  {result['seconds']:>9.3f}s  "
+                    f"{result['items_per_second']:>12.1f} items/s  {result['peak_rss_mb']:>8.1f} MB"
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
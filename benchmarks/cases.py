@@ -0,0 +1,302 @@
+import asyncio
+import io
+import logging
+import platform
+import resource
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Callable
+
+from tortoise import Tortoise
+
+from benchmarks.datasets import TAGS, generate_reviews, reviews_csv, reviews_upload
+from benchmarks.models import StandInSentenceTransformer, StandInSetFitModel
+
+
+logger = logging.getLogger("benchmarks")
+
+CASES: dict[str, Callable[[int], tuple[int, float]]] = {}
+# community detection compares every pair of sentences, larger sizes take hours on CPU
+MAX_ROWS = {"community_detection": 100_000}
+# sentences per batch of the fixed batching baseline, the SentenceTransformer default
+FIXED_BATCH_SIZE = 32
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 1024**2 if platform.system() == "Darwin" else peak / 1024
+
+
+def run_case(name: str, n_rows: int) -> dict:
+    """runs a registered case, meant to be called in a fresh process"""
+    items, seconds = CASES[name](n_rows)
+    return {
+        "items": items,
+        "seconds": round(seconds, 4),
+        "items_per_second": round(items / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def case(name: str):
+    def register(func):
+        CASES[name] = func
+        return func
+
+    return register
+
+
+def timed(func, *args) -> float:
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+async def init_sqlite_db():
+    """in memory database with the app schema, standing in for postgres"""
+    from tagmate.utils.database import DB_MODELS
+
+    await Tortoise.init(db_url="sqlite://:memory:", modules={"models": DB_MODELS})
+    await Tortoise.generate_schemas()
+
+
+async def create_activity() -> str:
+    from tagmate.models.db.activity import Activity as ActivityTable
+    from tagmate.models.db.user import User as UserTable
+
+    user = await UserTable.create(name="bench", email="bench@tagmate.local", password="", is_admin=False)
+    activity = await ActivityTable.create(
+        name="bench",
+        task="multi_label_classification",
+        tags=TAGS,
+        user_id=user.id,
+        file_name="reviews.csv",
+        storage_path="bench/reviews.csv",
+    )
+    return str(activity.id)
+
+
+def stand_in_documents(n_rows: int) -> list[SimpleNamespace]:
+    reviews = generate_reviews(n_rows)["review"].tolist()
+    return [SimpleNamespace(id=uuid.UUID(int=idx), text=text) for idx, text in enumerate(reviews)]
+
+
+def ingest(data: bytes, file_name: str) -> list[dict]:
+    """documents of an upload, read the way activity creation reads them"""
+    from tagmate.utils.ingest import detect_upload_format, iter_upload_documents
+
+    batches = iter_upload_documents(io.BytesIO(data), detect_upload_format(file_name))
+    return [doc for batch in batches for doc in batch]
+
+
+@case("csv_ingestion")
+def csv_ingestion(n_rows: int) -> tuple[int, float]:
+    data = reviews_csv(n_rows)
+    return n_rows, timed(ingest, data, "reviews.csv")
+
+
+@case("csv_gzip_ingestion")
+def csv_gzip_ingestion(n_rows: int) -> tuple[int, float]:
+    data = reviews_upload(n_rows, ".csv.gz")
+    return n_rows, timed(ingest, data, "reviews.csv.gz")
+
+
+@case("jsonl_gzip_ingestion")
+def jsonl_gzip_ingestion(n_rows: int) -> tuple[int, float]:
+    data = reviews_upload(n_rows, ".jsonl.gz")
+    return n_rows, timed(ingest, data, "reviews.jsonl.gz")
+
+
+@case("parquet_ingestion")
+def parquet_ingestion(n_rows: int) -> tuple[int, float]:
+    data = reviews_upload(n_rows, ".parquet")
+    return n_rows, timed(ingest, data, "reviews.parquet")
+
+
+@case("document_insert")
+def document_insert(n_rows: int) -> tuple[int, float]:
+    from tagmate.models.db.activity import Document as DocumentTable
+    from tagmate.utils.constants import DATASET_INDEX_COLUMN_NAME, DATASET_TEXT_COLUMN_NAME
+
+    documents = ingest(reviews_csv(n_rows), "reviews.csv")
+
+    async def run() -> float:
+        await init_sqlite_db()
+        activity_id = await create_activity()
+        # same bulk insert as activity creation in the api
+        started = time.perf_counter()
+        await DocumentTable.bulk_create(
+            [
+                DocumentTable(
+                    index=doc[DATASET_INDEX_COLUMN_NAME],
+                    text=doc[DATASET_TEXT_COLUMN_NAME],
+                    activity_id=activity_id,
+                )
+                for doc in documents
+            ]
+        )
+        elapsed = time.perf_counter() - started
+        await Tortoise.close_connections()
+        return elapsed
+
+    return n_rows, asyncio.run(run())
+
+
+def load_rows(n_rows: int) -> list[tuple]:
+    """document rows of `GET /activity/{id}/load`, as `values_list` returns them"""
+    import datetime
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    reviews = generate_reviews(n_rows)
+    return [
+        (uuid.UUID(int=idx), idx, row.review, row.tags, [], False, False, now, now)
+        for idx, row in enumerate(reviews.itertuples())
+    ]
+
+
+@case("load_serialisation")
+def load_serialisation(n_rows: int) -> tuple[int, float]:
+    """response serialisation of `GET /activity/{id}/load`, without the database read"""
+    from tagmate.utils.serialisation import documents_json
+
+    rows = load_rows(n_rows)
+    return n_rows, timed(documents_json, rows)
+
+
+@case("load_serialisation_pydantic")
+def load_serialisation_pydantic(n_rows: int) -> tuple[int, float]:
+    """the former serialisation of `/load`, model instances through the response model"""
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+
+    try:
+        from fastapi.utils import create_model_field as create_field
+    except ImportError:
+        from fastapi.utils import create_response_field as create_field
+
+    from tagmate.models.db.activity import Document as DocumentTable
+    from tagmate.models.py.activity import Document
+    from tagmate.utils.serialisation import DOCUMENT_COLUMNS
+
+    activity_id = uuid.uuid4()
+    documents = [
+        DocumentTable(activity_id=activity_id, **dict(zip(DOCUMENT_COLUMNS, row)))
+        for row in load_rows(n_rows)
+    ]
+    field = create_field(name="Response_load", type_=list[Document])
+
+    async def run() -> float:
+        started = time.perf_counter()
+        content = await serialize_response(field=field, response_content=documents)
+        JSONResponse(content)
+        return time.perf_counter() - started
+
+    return n_rows, asyncio.run(run())
+
+
+@case("document_load")
+def document_load(n_rows: int) -> tuple[int, float]:
+    """database read and serialisation of `/load`"""
+    from tagmate.models.db.activity import Document as DocumentTable
+    from tagmate.utils.serialisation import load_documents_json
+
+    reviews = generate_reviews(n_rows)
+
+    async def run() -> float:
+        await init_sqlite_db()
+        activity_id = await create_activity()
+        await DocumentTable.bulk_create(
+            [
+                DocumentTable(index=idx, text=row.review, labels=row.tags, activity_id=activity_id)
+                for idx, row in enumerate(reviews.itertuples())
+            ]
+        )
+        started = time.perf_counter()
+        await load_documents_json(activity_id)
+        elapsed = time.perf_counter() - started
+        await Tortoise.close_connections()
+        return elapsed
+
+    return n_rows, asyncio.run(run())
+
+
+@case("sentence_splitting")
+def sentence_splitting(n_rows: int) -> tuple[int, float]:
+    from tagmate.classifiers.clustering import ClusterBuilder
+
+    builder = ClusterBuilder(activity_id="bench", logger=logger)
+    builder.documents = stand_in_documents(n_rows)
+
+    def split():
+        builder.split_documents()
+        builder.dedupe_sentences()
+
+    return n_rows, timed(split)
+
+
+def embedded_builder(n_rows: int):
+    from tagmate.classifiers.clustering import ClusterBuilder
+
+    builder = ClusterBuilder(activity_id="bench", logger=logger)
+    builder.documents = stand_in_documents(n_rows)
+    builder.split_documents()
+    builder.dedupe_sentences()
+    builder.model = StandInSentenceTransformer()
+    return builder
+
+
+@case("embedding")
+def embedding(n_rows: int) -> tuple[int, float]:
+    builder = embedded_builder(n_rows)
+    return len(builder.unique_sentences), timed(builder.generate_embeddings)
+
+
+@case("embedding_fixed_batches")
+def embedding_fixed_batches(n_rows: int) -> tuple[int, float]:
+    """the embedding case in fixed batches of sentences, the baseline of token budget batching"""
+    builder = embedded_builder(n_rows)
+    sentences = builder.unique_sentences
+    return len(sentences), timed(builder.model.encode, sentences, FIXED_BATCH_SIZE)
+
+
+@case("community_detection")
+def community_detection(n_rows: int) -> tuple[int, float]:
+    builder = embedded_builder(n_rows)
+    builder.generate_embeddings()
+    return len(builder.sentences), timed(builder.build_clusters)
+
+
+@case("prediction_writeback")
+def prediction_writeback(n_rows: int) -> tuple[int, float]:
+    from tagmate.classifiers.multi_label_classification import MultiLabelClassifier
+    from tagmate.models.db.activity import Document as DocumentTable
+
+    reviews = generate_reviews(n_rows)
+
+    async def run() -> tuple[int, float]:
+        await init_sqlite_db()
+        activity_id = await create_activity()
+        await DocumentTable.bulk_create(
+            [
+                DocumentTable(index=idx, text=text, activity_id=activity_id)
+                for idx, text in enumerate(reviews["review"])
+            ]
+        )
+
+        classifier = MultiLabelClassifier(activity_id=activity_id, logger=logger)
+        await classifier.fetch_activity_from_db()
+        await classifier.get_activity_tags()
+        await classifier.get_activity_documents()
+        classifier.convert_documents_to_df()
+        classifier.model = StandInSetFitModel(n_labels=len(classifier.tags))
+
+        started = time.perf_counter()
+        classifier.generate_predictions()
+        await classifier.save_predictions()
+        elapsed = time.perf_counter() - started
+        await Tortoise.close_connections()
+        return len(classifier.untagged_documents_df), elapsed
+
+    return asyncio.run(run())
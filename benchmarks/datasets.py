@@ -0,0 +1,89 @@
+import random
+from io import StringIO
+from os import makedirs
+from os.path import dirname, exists, join as joinpath
+
+import pandas as pd
+
+
+DATA_DIR = joinpath(dirname(__file__), ".data")
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+TAGS = ["maintenance", "neighborhood", "parking", "pets", "pricing", "staff"]
+# share of reviews repeated verbatim, real review exports carry a lot of copy pasted text
+DUPLICATE_RATE = 0.2
+
+SUBJECTS = [
+    "The apartment", "Our unit", "The building", "The parking lot", "The gym",
+    "The leasing office", "The elevator", "The laundry room", "The pool", "The kitchen",
+]
+ASPECTS = {
+    "maintenance": ["repairs take weeks", "the heating broke twice", "maintenance fixed the leak the same day"],
+    "neighborhood": ["the area feels safe at night", "there are great cafes nearby", "the street is noisy"],
+    "parking": ["there is never a free spot", "guest parking is easy", "the garage gate is always broken"],
+    "pets": ["dogs are welcome", "the pet fee is too high", "there is a nice dog park"],
+    "pricing": ["rent went up again", "the price is fair for the area", "fees keep piling up"],
+    "staff": ["the manager is very friendly", "nobody answers the phone", "the front desk is helpful"],
+}
+CLOSINGS = [
+    "Would recommend", "Would not rent here again", "Overall a decent place",
+    "Think twice before signing", "Happy to renew the lease",
+]
+
+
+def generate_reviews(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """synthetic apartment reviews in the shape of an uploaded dataset
+
+    Reviews are made of a few templated sentences, so they split into sentences
+    and cluster like real reviews, and a share of them are exact duplicates.
+
+    Args:
+        n_rows (int): number of reviews
+        seed (int): random seed, the same seed always gives the same dataset
+
+    Returns:
+        pd.DataFrame: a `review` column and the tags each review was generated from
+    """
+    rng = random.Random(seed)
+    reviews, labels = [], []
+    for _ in range(n_rows):
+        if reviews and rng.random() < DUPLICATE_RATE:
+            idx = rng.randrange(len(reviews))
+            reviews.append(reviews[idx])
+            labels.append(labels[idx])
+            continue
+        tags = rng.sample(TAGS, rng.randint(1, 3))
+        sentences = [f"{rng.choice(SUBJECTS)} is okay but {rng.choice(ASPECTS[tag])}" for tag in tags]
+        sentences.append(rng.choice(CLOSINGS))
+        reviews.append(". ".join(sentences) + ".")
+        labels.append(tags)
+    return pd.DataFrame({"review": reviews, "tags": labels})
+
+
+def reviews_csv(n_rows: int, seed: int = 0) -> bytes:
+    """csv upload of `generate_reviews`, cached on disk since the 1m dataset is slow to build"""
+    path = joinpath(DATA_DIR, f"reviews-{n_rows}-{seed}.csv")
+    if not exists(path):
+        makedirs(DATA_DIR, exist_ok=True)
+        buffer = StringIO()
+        generate_reviews(n_rows, seed)[["review"]].to_csv(buffer, index=False)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(buffer.getvalue())
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def reviews_upload(n_rows: int, extension: str, seed: int = 0) -> bytes:
+    """upload of `generate_reviews` in the format of the extension, like `.parquet` or `.jsonl.gz`"""
+    path = joinpath(DATA_DIR, f"reviews-{n_rows}-{seed}{extension}")
+    if not exists(path):
+        makedirs(DATA_DIR, exist_ok=True)
+        reviews = generate_reviews(n_rows, seed)[["review"]]
+        compression = "gzip" if extension.endswith(".gz") else None
+        if extension.startswith(".parquet"):
+            reviews.to_parquet(path, index=False)
+        elif extension.startswith(".jsonl"):
+            reviews.to_json(path, orient="records", lines=True, compression=compression)
+        else:
+            reviews.to_csv(path, index=False, compression=compression)
+    with open(path, "rb") as f:
+        return f.read()
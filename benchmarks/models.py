@@ -0,0 +1,92 @@
+import hashlib
+import re
+
+import torch
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+EMBEDDING_DIM = 64
+MAX_SEQ_LENGTH = 128
+
+
+class StandInTokenizer:
+    """word level tokenizer with the call signature of a huggingface tokenizer"""
+
+    def __call__(self, texts: list[str], add_special_tokens: bool = True, **kwargs) -> dict:
+        special = 2 if add_special_tokens else 0
+        return {
+            "input_ids": [
+                [0] * (len(TOKEN_PATTERN.findall(text)) + special) for text in texts
+            ]
+        }
+
+
+class StandInSentenceTransformer:
+    """deterministic hashed bag of words encoder standing in for a SentenceTransformer
+
+    It exposes the parts of the SentenceTransformer api the pipelines use and
+    needs no downloads, so benchmarks run offline on CPU. Texts sharing words
+    get similar embeddings, which keeps community detection meaningful.
+
+    Like a transformer, every batch is padded to its longest text and a layer
+    runs over every position, padding included, so the cost of a batch grows
+    with batch size times its longest text. The layer is orthogonal, it leaves
+    the similarities of the bag of words embeddings unchanged.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, max_seq_length: int = MAX_SEQ_LENGTH, seed: int = 0):
+        self.dim = dim
+        self.max_seq_length = max_seq_length
+        self.tokenizer = StandInTokenizer()
+        generator = torch.Generator().manual_seed(seed)
+        self.layer = torch.linalg.qr(torch.randn((dim, dim), generator=generator))[0]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def token_bucket(self, token: str) -> int:
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.dim
+
+    def encode_batch(self, sentences: list[str]) -> torch.Tensor:
+        tokens = [TOKEN_PATTERN.findall(sentence.lower())[: self.max_seq_length] for sentence in sentences]
+        max_len = max((len(sentence_tokens) for sentence_tokens in tokens), default=0) or 1
+        buckets = torch.zeros((len(sentences), max_len), dtype=torch.long)
+        mask = torch.zeros((len(sentences), max_len, 1))
+        for row, sentence_tokens in enumerate(tokens):
+            buckets[row, : len(sentence_tokens)] = torch.tensor(
+                [self.token_bucket(token) for token in sentence_tokens], dtype=torch.long
+            )
+            mask[row, : len(sentence_tokens)] = 1.0
+        # batch x max_len x dim, computed for padding positions too
+        hidden = torch.nn.functional.one_hot(buckets, self.dim).float() @ self.layer
+        return (hidden * mask).sum(dim=1)
+
+    def encode(
+        self,
+        sentences: list[str],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        convert_to_tensor: bool = False,
+        **kwargs,
+    ):
+        chunks = [
+            self.encode_batch(sentences[start:start + batch_size])
+            for start in range(0, len(sentences), batch_size)
+        ]
+        embeddings = torch.cat(chunks) if chunks else torch.zeros((0, self.dim))
+        embeddings = torch.nn.functional.normalize(embeddings, dim=1)
+        return embeddings if convert_to_tensor else embeddings.numpy()
+
+
+class StandInSetFitModel:
+    """multi label SetFit stand in, a fixed random one-vs-rest head on the stand in encoder"""
+
+    def __init__(self, n_labels: int, seed: int = 0):
+        self.model_body = StandInSentenceTransformer()
+        generator = torch.Generator().manual_seed(seed)
+        self.head = torch.randn((EMBEDDING_DIM, n_labels), generator=generator)
+
+    def __call__(self, texts: list[str]) -> torch.Tensor:
+        embeddings = self.model_body.encode(texts, convert_to_tensor=True)
+        return (embeddings @ self.head > 0).int()
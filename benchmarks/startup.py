@@ -0,0 +1,92 @@
+"""cold start of an api worker
+
+    python -m benchmarks.startup --repeat 5 --output startup.json
+    python -m benchmarks.startup --budget 1.0
+
+Every uvicorn worker imports the app on its own, so the app is imported in
+fresh interpreters and each reports its import time and peak RSS. The import
+time of one more run is grouped by top level package with `-X importtime`, to
+show where the time goes.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+
+PROBE = """
+import json, platform, resource, time
+started = time.perf_counter()
+import tagmate.app
+seconds = time.perf_counter() - started
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# kilobytes on linux, bytes on macos
+peak_rss_mb = peak / 1024**2 if platform.system() == "Darwin" else peak / 1024
+print(json.dumps({"seconds": seconds, "peak_rss_mb": peak_rss_mb}))
+"""
+# settings the app reads at import, real values are not needed to import it
+PROBE_ENV = {"JWT_SECRET": "startup", "ALGORITHM": "HS256"}
+
+
+def run_probe() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        env={**PROBE_ENV, **os.environ},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def import_times(top: int) -> list[tuple[str, float]]:
+    """seconds spent importing each top level package, slowest first"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import tagmate.app"],
+        env={**PROBE_ENV, **os.environ},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    totals = defaultdict(float)
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        totals[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters importing the app")
+    parser.add_argument("--top", type=int, default=10, help="packages listed by import time")
+    parser.add_argument("--output", help="write the results as json to this path")
+    parser.add_argument("--budget", type=float, help="fail when the median import takes longer, in seconds")
+    args = parser.parse_args()
+
+    runs = [run_probe() for _ in range(args.repeat)]
+    results = {
+        "seconds": round(statistics.median(run["seconds"] for run in runs), 4),
+        "peak_rss_mb": round(max(run["peak_rss_mb"] for run in runs), 1),
+        "packages": {name: round(seconds, 4) for name, seconds in import_times(args.top)},
+    }
+
+    print(f"import tagmate.app  {results['seconds']:.3f}s median  {results['peak_rss_mb']:.1f} MB peak rss")
+    for name, seconds in results["packages"].items():
+        print(f"  {name:<24}{seconds:.3f}s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.budget is not None and results["seconds"] > args.budget:
+        print(f"startup is over the budget of {args.budget:.3f}s")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,29 @@
-from fastapi import FastAPI
+import asyncio
+import time
+import uuid
+
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from tortoise import Tortoise
 from tortoise.contrib.fastapi import register_tortoise
 
-from tagmate.logging.app import init_logger
-from tagmate.routers import activity, user
-from tagmate.utils.database import DB_URI
+from tagmate.logging.app import init_logger, logger
+from tagmate.routers import activity, admin, user
+from tagmate.utils.auth import authenticate_with_token
+from tagmate.utils.database import TORTOISE_ORM, instrument_connections
+from tagmate.utils.metrics import HTTP_REQUEST_DURATION, render_metrics
+from tagmate.utils.profiling import (
+    PROFILE_HEADER,
+    PROFILE_ID_HEADER,
+    PROFILE_QUERY_PARAM,
+    REQUEST_PROFILES,
+    Profiler,
+    ProfilerBusy,
+    is_truthy,
+    store_profile,
+)
+from tagmate.utils.queue import close_redis_pool
+from tagmate.utils.validations import validate_token_user
 
 
 init_logger()
@@ -18,21 +36,83 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # the ui revalidates cached activity reads with the etag
+    expose_headers=[PROFILE_ID_HEADER, "ETag"],
 )
 
+
+async def is_admin_request(request: Request) -> bool:
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    claims = await authenticate_with_token(token)
+    if not claims:
+        return False
+    try:
+        user = await validate_token_user(claims)
+    except HTTPException:
+        return False
+    return user.is_admin
+
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """profiles a request when asked to with the profile header or query parameter
+
+    Only requests of admins are profiled. The profile covers the handler, a
+    streamed response body is sent after the profile has stopped.
+    """
+    requested = is_truthy(request.headers.get(PROFILE_HEADER)) or is_truthy(
+        request.query_params.get(PROFILE_QUERY_PARAM)
+    )
+    if not requested or not await is_admin_request(request):
+        return await call_next(request)
+
+    profiler = Profiler(REQUEST_PROFILES, str(uuid.uuid4()), f"{request.method} {request.url.path}")
+    try:
+        profiler.start()
+    except ProfilerBusy:
+        logger.warning(f"another request is being profiled, {request.method} {request.url.path} runs unprofiled")
+        return await call_next(request)
+
+    try:
+        response = await call_next(request)
+    finally:
+        files = profiler.stop()
+    try:
+        await asyncio.to_thread(store_profile, REQUEST_PROFILES, profiler.profile_id, files)
+        response.headers[PROFILE_ID_HEADER] = profiler.profile_id
+    except Exception as exc:
+        logger.warning(f"could not store profile {profiler.profile_id}: {exc}")
+    return response
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # templated path, so that ids in the url do not explode the label cardinality
+        route = request.scope.get("route")
+        HTTP_REQUEST_DURATION.labels(
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status_code,
+        ).observe(time.perf_counter() - started)
+
+
 app.include_router(user.router)
 app.include_router(activity.router)
+app.include_router(admin.router)
 # app.include_router(dataset.router)
 
 register_tortoise(
     app,
-    db_url=DB_URI,
-    modules={
-        "models": [
-            "tagmate.models.db.user",
-            "tagmate.models.db.activity",
-        ]
-    },
+    config=TORTOISE_ORM,
     generate_schemas=True,
     add_exception_handlers=False,
 )
@@ -40,12 +120,20 @@ register_tortoise(
 
 @app.on_event("startup")
 async def startup_event():
-    pass
+    # registered after register_tortoise, so the connections are initialised by now
+    instrument_connections()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     await Tortoise.close_connections()
+    await close_redis_pool()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
 
 
 @app.get("/health")
@@ -1,5 +1,6 @@
 import uuid
 import pandas as pd
+import torch
 from sentence_transformers import SentenceTransformer, util
 from tagmate.models.db.activity import (
     Activity as ActivityTable,
@@ -8,26 +9,55 @@ from tagmate.models.db.activity import (
 )
 from tagmate.utils.database import db_init
 from tagmate.logging.worker import JobLogger
+from tagmate.models.enums import JobStageEnum
+from tagmate.storage.checkpoint import JobCheckpoint
+from tagmate.utils.batching import count_tokens, fixed_size_batches, padding_efficiency, token_budget_batches
+from tagmate.utils.cancellation import CancellationToken
+from tagmate.utils.dedupe import dedupe
+from tagmate.utils.metrics import stage
+from tagmate.utils.progress import ProgressReporter
 
 
 model_id = "all-MiniLM-L6-v2"
 
+EMBEDDING_MAX_TOKENS = 16384
+EMBEDDINGS_CHECKPOINT = "embeddings.npy"
+CLUSTERS_CHECKPOINT = "clusters.json"
+
 
 class ClusterBuilder:
-    def __init__(self, activity_id: str, logger: JobLogger | None = None):
+    def __init__(
+        self,
+        activity_id: str,
+        logger: JobLogger | None = None,
+        progress: ProgressReporter | None = None,
+        checkpoint: JobCheckpoint | None = None,
+        cancellation: CancellationToken | None = None,
+    ):
         self.activity_id = activity_id
         self.model_id = model_id
         self.logger = logger
+        self.progress = progress or ProgressReporter(
+            redis=None, job_id="0", activity_id=activity_id
+        )
+        self.checkpoint = checkpoint
+        self.cancellation = cancellation or CancellationToken()
 
     def load_model(self):
         self.model = SentenceTransformer(model_id)
+        self.cancellation.watch(self.model)
 
     async def fetch_activity_from_db(self):
         self.activity = await ActivityTable.get(id=self.activity_id)
 
+    @stage("fetch_activity_documents")
     async def fetch_activity_documents(self):
+        # stable ordering so sentence indices line up with checkpointed embeddings
+        self.documents = await DocumentTable.filter(activity_id=self.activity_id).order_by("id")
+        self.split_documents()
+
+    def split_documents(self):
         min_sentence_len = 10
-        self.documents = await DocumentTable.filter(activity_id=self.activity_id)
         # self.documents = [[doc.id, doc.text] for doc in self.documents]
         # self.texts = [doc[1] for doc in self.documents]
         # self.idx2id = {idx: doc[0] for idx, doc in enumerate(self.documents)}
@@ -41,23 +71,84 @@ class ClusterBuilder:
         self.sentences = documents_df["sentence"].tolist()
         self.logger.info(self.documents_df[:10])
         self.logger.info(self.sentences[:10])
-        
 
+    def load_embeddings_checkpoint(self) -> bool:
+        if self.checkpoint is None:
+            return False
+        embeddings = self.checkpoint.load_array(EMBEDDINGS_CHECKPOINT)
+        if embeddings is None or len(embeddings) != len(self.unique_sentences):
+            return False
+        self.unique_embeddings = torch.from_numpy(embeddings)
+        self.logger.info(f"resumed {len(embeddings)} embeddings from checkpoint")
+        return True
+
+    def dedupe_sentences(self):
+        self.unique_idx, self.sentence2unique = dedupe(self.sentences)
+        self.unique_sentences = [self.sentences[idx] for idx in self.unique_idx]
+        self.logger.info(
+            f"{len(self.unique_sentences)} unique sentences out of {len(self.sentences)}"
+        )
+
+    def fan_out_embeddings(self):
+        # every sentence shares the embedding of its unique sentence
+        index = torch.tensor(self.sentence2unique, dtype=torch.long, device=self.unique_embeddings.device)
+        self.embeddings = self.unique_embeddings[index]
+
+    @stage("generate_embeddings")
     def generate_embeddings(self):
-        self.embeddings = self.model.encode(
-            self.sentences, batch_size=8, show_progress_bar=True, convert_to_tensor=True
+        self.resumed_embeddings = self.load_embeddings_checkpoint()
+        if self.resumed_embeddings:
+            self.fan_out_embeddings()
+            return
+        sentences = self.unique_sentences
+        lengths = count_tokens(self.model.tokenizer, sentences, self.model.max_seq_length)
+        batches = list(token_budget_batches(lengths, EMBEDDING_MAX_TOKENS))
+        fixed_batches = list(fixed_size_batches(len(lengths), 8))
+        self.logger.info(
+            f"embedding {len(sentences)} sentences in {len(batches)} batches, "
+            f"padding efficiency {padding_efficiency(lengths, batches):.2f} "
+            f"vs {padding_efficiency(lengths, fixed_batches):.2f} with fixed batches of 8"
         )
-        self.logger.info(self.embeddings)
 
+        order, chunks = [], []
+        for batch in batches:
+            self.cancellation.raise_if_cancelled()
+            chunks.append(
+                self.model.encode(
+                    [sentences[idx] for idx in batch],
+                    batch_size=len(batch),
+                    show_progress_bar=False,
+                    convert_to_tensor=True,
+                )
+            )
+            order.extend(batch)
+        if len(chunks) == 0:
+            self.unique_embeddings = torch.empty((0, self.model.get_sentence_embedding_dimension()))
+            self.fan_out_embeddings()
+            return
+
+        # batches come out sorted by length, scatter them back to unique sentence order
+        sorted_embeddings = torch.cat(chunks)
+        self.unique_embeddings = torch.empty_like(sorted_embeddings)
+        self.unique_embeddings[torch.tensor(order, device=sorted_embeddings.device)] = sorted_embeddings
+        if self.checkpoint is not None:
+            self.checkpoint.save_array(EMBEDDINGS_CHECKPOINT, self.unique_embeddings.cpu().numpy())
+        self.fan_out_embeddings()
+        self.logger.info(f"embeddings of shape {tuple(self.embeddings.shape)}")
+
+    @stage("build_clusters")
     def build_clusters(self, size=20):
+        # community detection is a single blocking call, check before it starts
+        self.cancellation.raise_if_cancelled()
         self.clusters = util.community_detection(
             self.embeddings, min_community_size=size, threshold=0.65
         )
         if len(self.clusters) == 0:
             self.logger.info(f"cluster count: {len(self.clusters)}")
             self.logger.info(f"cluster size: {size}")
-            self.build_clusters(size=size//2)
+            self.build_clusters(size=size // 2)
 
+    @stage("save_clusters")
     async def save_clusters(self):
         clusters_to_save = []
         sentence2cluster = {}
@@ -68,21 +159,45 @@ class ClusterBuilder:
             )
             for sentence_idx in cluster_sentences:
                 sentence2cluster[sentence_idx] = cluster_id
-        
-        self.documents_df["cluster_id"] = self.documents_df["sentence_idx"].apply(lambda x: sentence2cluster.get(x,None))
+
+        self.documents_df["cluster_id"] = self.documents_df["sentence_idx"].apply(lambda x: sentence2cluster.get(x, None))
         self.documents_df = self.documents_df[pd.notnull(self.documents_df["cluster_id"])][["id", "cluster_id"]]
         self.documents_df = self.documents_df.groupby("id", as_index=False).agg({"cluster_id": lambda x: x.tolist()}).rename(columns={"cluster_id": "clusters"})
-        documents_to_save = [DocumentTable(id=row["id"], clusters=row["clusters"]) for idx,row in self.documents_df.iterrows()]
+        documents_to_save = [DocumentTable(id=row["id"], clusters=row["clusters"]) for idx, row in self.documents_df.iterrows()]
 
         await ClusterTable.bulk_create(objects=clusters_to_save)
         await DocumentTable.bulk_update(objects=documents_to_save, fields=["clusters"])
 
-    async def run_clustering(self):
+    async def prepare_sentences(self):
         await db_init()
-        self.load_model()
         await self.fetch_activity_from_db()
         await self.fetch_activity_documents()
-        self.generate_embeddings()
-        self.build_clusters()
-        self.logger.info(self.clusters)
+        self.dedupe_sentences()
+
+    async def cluster_sentences(self):
+        await self.cancellation.run(self.load_model)
+
+        n_sentences = len(self.sentences)
+        await self.progress.update(JobStageEnum.embed, 10, 0, n_sentences)
+        await self.cancellation.run(self.generate_embeddings)
+
+        await self.progress.update(JobStageEnum.cluster, 70, n_sentences, n_sentences)
+        # clusters are only valid for the embeddings they were built from
+        clusters = None
+        if self.resumed_embeddings:
+            clusters = self.checkpoint.load_json(CLUSTERS_CHECKPOINT)
+        if clusters is not None:
+            self.clusters = clusters
+        else:
+            await self.cancellation.run(self.build_clusters)
+            if self.checkpoint is not None:
+                self.checkpoint.save_json(CLUSTERS_CHECKPOINT, self.clusters)
+        self.logger.info(f"{len(self.clusters)} clusters of {sum(len(cluster) for cluster in self.clusters)} sentences")
+
+        await self.progress.update(JobStageEnum.write_back, 90, n_sentences, n_sentences)
         await self.save_clusters()
+
+    async def run_clustering(self):
+        await self.progress.update(JobStageEnum.fetch, 0)
+        await self.prepare_sentences()
+        await self.cluster_sentences()
@@ -1,33 +1,255 @@
-from tagmate.classifiers.base import Classifier
+import random
+import re
+import time
+from collections import Counter
+from os.path import join as joinpath
+
 from datasets import Dataset
 from sentence_transformers.losses import CosineSimilarityLoss
-
 from setfit import SetFitModel, SetFitTrainer
+import pandas as pd
+
+from tagmate.classifiers.base import Classifier
+from tagmate.classifiers.registry import get_model_version, new_version_storage_path, register_model_version
+from tagmate.models.db.activity import (
+    Activity as ActivityTable,
+    Document as DocumentTable,
+)
+from tagmate.logging.worker import JobLogger
+from tagmate.models.enums import ActivityTaskEnum, JobStageEnum
+from tagmate.storage.checkpoint import JobCheckpoint
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.storage.model_cache import ModelCache, build_manifest, folder_size, manifest_digest
+from tagmate.utils.batching import count_tokens, map_in_length_buckets
+from tagmate.utils.cancellation import CancellationToken
+from tagmate.utils.constants import MODELS_BUCKET
+from tagmate.utils.database import db_init
+from tagmate.utils.dedupe import dedupe
+from tagmate.utils.metrics import stage
+from tagmate.utils.functions import SoftTemporaryDirectory
+from tagmate.utils.progress import ProgressReporter
 
 
 FEW_SHOT_MODEL_NAME = "sentence-transformers/paraphrase-mpnet-base-v2"
 BATCH_SIZE = 4
 NUM_ITERATIONS = 20
+INFERENCE_MAX_TOKENS = 16384
+PREDICTION_CHUNK_SIZE = 1000
+METRIC = "accuracy"
+
+# label of candidate spans which are not an entity
+NO_ENTITY_LABEL = "O"
+# number of non-entity spans sampled per entity span for training
+NEGATIVE_SAMPLES_PER_ENTITY = 2
+MIN_SPAN_LEN = 3
+# longest candidate span in words, capped by the longest tagged entity
+MAX_SPAN_WORDS = 6
+# bounds the spans classified per document, about a hundred forward passes
+MAX_CANDIDATES_PER_DOCUMENT = 128
+# entity words in more documents than this share are too common to anchor candidates
+MAX_KEYWORD_DOCUMENT_FREQUENCY = 0.5
+SPAN_PATTERN = re.compile(r"[^.!?;\n]+")
+WORD_PATTERN = re.compile(r"\w+(?:['’-]\w+)*")
+
+TRAINED_CHECKPOINT = "trained.json"
+PREDICTIONS_CHECKPOINT = "predictions/{chunk_idx:06d}.json"
+
+
+def split_spans(text: str) -> list[tuple[int, int]]:
+    """splits a text into spans at sentence and clause boundaries
+
+    Args:
+        text (str): text of the document
+
+    Returns:
+        list[tuple[int, int]]: start and end character offsets of each span
+    """
+    spans = []
+    for match in SPAN_PATTERN.finditer(text):
+        segment = match.group()
+        start = match.start() + len(segment) - len(segment.lstrip())
+        end = match.end() - len(segment) + len(segment.rstrip())
+        if end - start >= MIN_SPAN_LEN:
+            spans.append((start, end))
+    return spans
+
+
+def entity_keywords(entity_texts: list[str], texts: list[str]) -> set[str]:
+    """lower cased words of the tagged entities, without those common enough to be in most documents"""
+    words = {word.lower() for text in entity_texts for word in WORD_PATTERN.findall(text)}
+    document_frequency = Counter(
+        word for text in texts for word in {word.lower() for word in WORD_PATTERN.findall(text)} & words
+    )
+    max_documents = MAX_KEYWORD_DOCUMENT_FREQUENCY * len(texts)
+    return {word for word in words if document_frequency[word] <= max_documents}
+
+
+def candidate_spans(
+    text: str,
+    max_words: int = MAX_SPAN_WORDS,
+    keywords: set[str] | None = None,
+    max_candidates: int = MAX_CANDIDATES_PER_DOCUMENT,
+) -> list[tuple[int, int]]:
+    """word windows of up to `max_words` words around the keywords in every clause of a text
+
+    Entities are trained on their own text, so candidates are short windows
+    of the size of an entity rather than whole clauses. Only windows holding
+    one of `keywords` are candidates, so that inference classifies the spans
+    near words seen in tagged entities rather than every window of every
+    document, and no more than the first `max_candidates` in text order.
+
+    Args:
+        text (str): text of the document
+        max_words (int): longest window in words
+        keywords (set[str] | None): lower cased words anchoring the windows, every word when None
+        max_candidates (int): most candidates returned for the text
+
+    Returns:
+        list[tuple[int, int]]: start and end character offsets of each candidate
+    """
+    spans = {}
+    for clause_start, clause_end in split_spans(text):
+        words = list(WORD_PATTERN.finditer(text, clause_start, clause_end))
+        for anchor, word in enumerate(words):
+            if keywords is not None and word.group().lower() not in keywords:
+                continue
+            for first in range(max(0, anchor - max_words + 1), anchor + 1):
+                for last in range(anchor, min(first + max_words, len(words))):
+                    start, end = words[first].start(), words[last].end()
+                    if end - start >= MIN_SPAN_LEN:
+                        spans.setdefault((start, end), None)
+            if len(spans) >= max_candidates:
+                return sorted(spans)[:max_candidates]
+    return sorted(spans)
+
+
+def select_spans(scored_spans: list[tuple[int, int, str, float]]) -> list[tuple[int, int, str]]:
+    """the most confident entity spans of a text which do not overlap, in text order"""
+    selected = []
+    for start, end, label, _ in sorted(scored_spans, key=lambda span: span[3], reverse=True):
+        if not any(start < s_end and s_start < end for s_start, s_end, _ in selected):
+            selected.append((start, end, label))
+    return sorted(selected)
 
 
 class EntityClassifier(Classifier):
-    def __init__(self, model_name: str | None = FEW_SHOT_MODEL_NAME, model_path: str | None = None):
-        self.model = SetFitModel.from_pretrained(model_name)
+    """few shot entity classifier over candidate spans
+
+    Entity labels of a document are stored as a list of
+    `{"start": int, "end": int, "label": str}` spans. The classifier learns
+    to label candidate spans (word windows inside each clause, around words
+    of the tagged entities) with one of the activity tags, or
+    `NO_ENTITY_LABEL`, and writes the most confident non overlapping entity
+    spans back.
+    """
+
+    def __init__(
+        self,
+        activity_id: str,
+        logger: JobLogger | None = None,
+        progress: ProgressReporter | None = None,
+        checkpoint: JobCheckpoint | None = None,
+        cancellation: CancellationToken | None = None,
+    ):
+        self.activity_id = activity_id
+        self.logger = logger
+        self.progress = progress or ProgressReporter(
+            redis=None, job_id="0", activity_id=activity_id
+        )
+        self.checkpoint = checkpoint
+        self.cancellation = cancellation or CancellationToken()
+        self.model_cache = ModelCache()
+        self.model_version = None
+        self.max_span_words = MAX_SPAN_WORDS
+        self.keywords = None
+
+    async def fetch_activity_from_db(self):
+        self.activity = await ActivityTable.get(id=self.activity_id)
+
+    @stage("get_activity_documents")
+    async def get_activity_documents(self):
+        # stable ordering so prediction chunks line up with their checkpoints
+        self.documents = await DocumentTable.filter(activity_id=self.activity_id).order_by("id")
 
-    def train(self, train_ds: Dataset, eval_ds: Dataset | None = None):
+    @staticmethod
+    def get_object_store():
+        return MinioObjectStore()
+
+    async def get_activity_tags(self):
+        self.tags = sorted(self.activity.tags) + [NO_ENTITY_LABEL]
+        self.label_encoder = {tag: idx for idx, tag in enumerate(self.tags)}
+        self.label_decoder = {idx: tag for idx, tag in enumerate(self.tags)}
+
+    @staticmethod
+    def get_entity_offsets(text: str, entity: dict) -> tuple[int, int] | None:
+        if entity.get("start") is not None and entity.get("end") is not None:
+            return entity["start"], entity["end"]
+        start = text.find(entity.get("text", ""))
+        if start < 0 or not entity.get("text"):
+            return None
+        return start, start + len(entity["text"])
+
+    def convert_documents_to_df(self) -> None:
+        documents_list = [[doc.id, doc.text, doc.labels] for doc in self.documents]
+        documents_df = pd.DataFrame(
+            data=documents_list, columns=["id", "text", "label"]
+        )
+        tagged_df = documents_df[documents_df["label"].apply(lambda x: len(x)) > 0]
+        self.untagged_documents_df = documents_df[
+            documents_df["label"].apply(lambda x: len(x)) == 0
+        ].reset_index(drop=True)
+
+        entities, negatives = [], []
+        entity_texts, document_offsets = [], []
+        for _, row in tagged_df.iterrows():
+            entity_offsets = []
+            for entity in row["label"]:
+                offsets = self.get_entity_offsets(row["text"], entity)
+                if offsets is None or entity.get("label") not in self.label_encoder:
+                    continue
+                entity_offsets.append(offsets)
+                start, end = offsets
+                entities.append([row["text"][start:end], self.label_encoder[entity["label"]]])
+                entity_texts.append(row["text"][start:end])
+            document_offsets.append((row["text"], entity_offsets))
+
+        # negatives and inference candidates are windows of the size of the tagged entities, around their words
+        entity_words = [len(WORD_PATTERN.findall(text)) for text in entity_texts]
+        self.max_span_words = max(1, min(MAX_SPAN_WORDS, max(entity_words, default=MAX_SPAN_WORDS)))
+        self.keywords = entity_keywords(entity_texts, documents_df["text"].tolist()) or None
+        for text, entity_offsets in document_offsets:
+            for start, end in candidate_spans(text, self.max_span_words, self.keywords):
+                if not any(start < e_end and e_start < end for e_start, e_end in entity_offsets):
+                    negatives.append([text[start:end], self.label_encoder[NO_ENTITY_LABEL]])
+
+        n_negatives = min(len(negatives), NEGATIVE_SAMPLES_PER_ENTITY * len(entities))
+        negatives = random.Random(0).sample(negatives, n_negatives)
+        self.tagged_spans_df = pd.DataFrame(
+            data=entities + negatives, columns=["text", "label"]
+        )
+        self.logger.info(
+            f"entity spans: {len(entities)}, non-entity spans: {n_negatives}, "
+            f"candidate spans of up to {self.max_span_words} words around {len(self.keywords or ())} keywords"
+        )
+        self.logger.info(f"untagged documents: {len(self.untagged_documents_df)}")
+
+    def convert_df_to_dataset(self) -> None:
+        self.tagged_spans_ds = Dataset.from_pandas(self.tagged_spans_df)
+
+    def load_model(self):
+        self.model = SetFitModel.from_pretrained(FEW_SHOT_MODEL_NAME)
+        self.cancellation.watch(self.model.model_body)
+
+    @stage("train")
+    def train(self):
         self.trainer = SetFitTrainer(
             model=self.model,
-            train_dataset=train_ds,
-            eval_dataset=eval_ds,
+            train_dataset=self.tagged_spans_ds,
             loss_class=CosineSimilarityLoss,
-            metric="accuracy",
+            metric=METRIC,
             batch_size=BATCH_SIZE,
             num_iterations=NUM_ITERATIONS,  # The number of text pairs to generate for contrastive learning
             num_epochs=1,  # The number of epochs to use for contrastive learning
-            column_mapping={
-                "sentence": "text",
-                "label": "label",
-            },  # Map dataset columns to text/label expected by trainer
         )
         self.trainer.train()
 
@@ -35,8 +257,191 @@ class EntityClassifier(Classifier):
         metrics = self.trainer.evaluate()
         return metrics
 
-    def predict(data: str | list[str]):
-        pass
+    @stage("save_model")
+    def save_model(self):
+        user_id = str(self.activity.user_id)
+        # every run uploads to a fresh prefix, earlier versions are never overwritten
+        self.saved_version_id, storage_path = new_version_storage_path(user_id, self.activity_id)
+        self.saved_storage_path = storage_path
+
+        with SoftTemporaryDirectory() as tmpdir:
+            local_storage_path = joinpath(tmpdir, self.activity_id)
+            self.trainer.model.save_pretrained(save_directory=local_storage_path)
+            self.saved_manifest = build_manifest(local_storage_path)
+            self.saved_size = folder_size(local_storage_path)
+            client = self.get_object_store()
+            client.upload_objects_from_folder(
+                bucket_name=MODELS_BUCKET,
+                objects_path=storage_path,
+                folder_path=local_storage_path,
+            )
+            self.model_cache.add(local_storage_path, manifest_digest(self.saved_manifest), self.saved_manifest)
+
+    async def register_saved_model(self, metrics: dict, training_time: float):
+        self.model_version = await register_model_version(
+            version_id=self.saved_version_id,
+            activity_id=self.activity_id,
+            name=ActivityTaskEnum.ENTITY_CLASSIFICATION.value,
+            storage_path=self.saved_storage_path,
+            manifest=self.saved_manifest,
+            size=self.saved_size,
+            metrics=metrics,
+            training_time=training_time,
+        )
+
+    async def fetch_model_version(self, version_id: str | None = None):
+        """the pinned model version, or the active version of the activity's classifier"""
+        self.model_version = await get_model_version(
+            self.activity_id, ActivityTaskEnum.ENTITY_CLASSIFICATION.value, version_id
+        )
+
+    def load_trained_model(self):
+        if self.model_version is not None:
+            model_path = self.model_cache.fetch(
+                digest=self.model_version.digest,
+                manifest=self.model_version.manifest,
+                objects_path=self.model_version.storage_path,
+            )
+            self.model = SetFitModel.from_pretrained(model_path)
+            self.cancellation.watch(self.model.model_body)
+            return
+
+        user_id = str(self.activity.user_id)
+        storage_path = joinpath(user_id, self.activity_id)
+        client = self.get_object_store()
+
+        with SoftTemporaryDirectory() as tmpdir:
+            client.download_objects_as_folder(
+                bucket_name=MODELS_BUCKET,
+                objects_path=storage_path,
+                folder_path=tmpdir,
+            )
+            self.model = SetFitModel.from_pretrained(tmpdir)
+        self.cancellation.watch(self.model.model_body)
+
+    def predict(self, texts: list[str]) -> list[tuple[str, float]]:
+        """most likely label of every text, with its probability"""
+        model_body = self.model.model_body
+        # columns of the probabilities follow the labels seen in training
+        classes = getattr(self.model.model_head, "classes_", range(len(self.tags)))
+
+        def predict_batch(batch: list[str]) -> list[tuple[str, float]]:
+            probs = self.model.predict_proba(batch, as_numpy=True)
+            return [(self.label_decoder[int(classes[row.argmax()])], float(row.max())) for row in probs]
+
+        return map_in_length_buckets(
+            predict_batch,
+            texts,
+            lengths=count_tokens(model_body.tokenizer, texts, model_body.max_seq_length),
+            max_tokens=INFERENCE_MAX_TOKENS,
+        )
+
+    def predict_entities(self, texts: list[str]) -> list[list[dict]]:
+        """labels the candidate spans of every text in one length bucketed pass"""
+        spans = [
+            (doc_idx, start, end)
+            for doc_idx, text in enumerate(texts)
+            for start, end in candidate_spans(text, self.max_span_words, self.keywords)
+        ]
+        preds = self.predict([texts[doc_idx][start:end] for doc_idx, start, end in spans])
+
+        scored_spans = [[] for _ in texts]
+        for (doc_idx, start, end), (label, score) in zip(spans, preds):
+            if label != NO_ENTITY_LABEL:
+                scored_spans[doc_idx].append((start, end, label, score))
+        return [
+            [
+                {"start": start, "end": end, "text": text[start:end], "label": label}
+                for start, end, label in select_spans(doc_spans)
+            ]
+            for text, doc_spans in zip(texts, scored_spans)
+        ]
+
+    @stage("generate_predictions")
+    def generate_predictions(self):
+        ids = [str(id) for id in self.untagged_documents_df["id"].tolist()]
+        texts = self.untagged_documents_df["text"].tolist()
+
+        # spans carry character offsets, so only byte identical texts share predictions
+        unique_idx, inverse = dedupe(texts, near_duplicates=False, normalize=False)
+        unique_ids = [ids[idx] for idx in unique_idx]
+        unique_texts = [texts[idx] for idx in unique_idx]
+        self.logger.info(f"predicting {len(unique_texts)} unique texts for {len(texts)} documents")
+
+        unique_preds = []
+        for chunk_idx, start in enumerate(range(0, len(unique_texts), PREDICTION_CHUNK_SIZE)):
+            self.cancellation.raise_if_cancelled()
+            end = start + PREDICTION_CHUNK_SIZE
+            chunk_ids = unique_ids[start:end]
+            key = PREDICTIONS_CHECKPOINT.format(chunk_idx=chunk_idx)
+
+            saved = self.checkpoint.load_json(key) if self.checkpoint else None
+            if saved is not None and saved["ids"] == chunk_ids:
+                unique_preds.extend(saved["labels"])
+                continue
+
+            labels = self.predict_entities(unique_texts[start:end])
+            unique_preds.extend(labels)
+            if self.checkpoint is not None:
+                self.checkpoint.save_json(key, {"ids": chunk_ids, "labels": labels})
+
+        self.preds = [unique_preds[pos] for pos in inverse]
+
+    @stage("save_predictions")
+    async def save_predictions(self):
+        documents_to_save = [
+            DocumentTable(id=row["id"], labels=self.preds[idx], is_auto_generated=True)
+            for idx, row in self.untagged_documents_df.iterrows()
+            if len(self.preds[idx])
+        ]
+        await DocumentTable.bulk_update(
+            objects=documents_to_save, fields=["labels", "is_auto_generated"]
+        )
+
+    async def train_classifier(self):
+        await db_init()
+        await self.progress.update(JobStageEnum.fetch, 0)
+        await self.fetch_activity_from_db()
+        await self.get_activity_tags()
+
+        await self.get_activity_documents()
+        self.convert_documents_to_df()
+        self.convert_df_to_dataset()
+
+        n_tagged = len(self.tagged_spans_df)
+        n_untagged = len(self.untagged_documents_df)
+
+        trained = self.checkpoint.load_json(TRAINED_CHECKPOINT) if self.checkpoint else None
+        if trained is not None:
+            self.logger.info("resuming from the model saved by an earlier attempt")
+            await self.fetch_model_version(trained.get("model_version_id"))
+            await self.cancellation.run(self.load_trained_model)
+        else:
+            await self.progress.update(JobStageEnum.train, 10, 0, n_tagged)
+            await self.cancellation.run(self.load_model)
+            started = time.perf_counter()
+            await self.cancellation.run(self.train)
+            training_time = time.perf_counter() - started
+
+            await self.progress.update(JobStageEnum.save, 60, n_tagged, n_tagged)
+            await self.cancellation.run(self.save_model)
+            await self.register_saved_model(
+                metrics={
+                    "tagged_spans": n_tagged,
+                    "tags": len(self.tags),
+                    "batch_size": BATCH_SIZE,
+                    "num_iterations": NUM_ITERATIONS,
+                },
+                training_time=training_time,
+            )
+            if self.checkpoint is not None:
+                self.checkpoint.save_json(
+                    TRAINED_CHECKPOINT,
+                    {"tagged": n_tagged, "model_version_id": str(self.model_version.id)},
+                )
+
+        await self.progress.update(JobStageEnum.predict, 70, 0, n_untagged)
+        await self.cancellation.run(self.generate_predictions)
 
-    def save(self):
-        pass
\ No newline at end of file
+        await self.progress.update(JobStageEnum.write_back, 90, n_untagged, n_untagged)
+        await self.save_predictions()
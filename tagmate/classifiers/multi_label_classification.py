@@ -1,7 +1,9 @@
 import random
-from os import listdir
+import time
+from os import getenv as env
 from os.path import join as joinpath
 
+from arq.connections import ArqRedis
 from datasets import Dataset
 from sentence_transformers.losses import CosineSimilarityLoss
 from setfit import SetFitModel, SetFitTrainer
@@ -10,46 +12,106 @@ import numpy as np
 import torch
 
 from tagmate.classifiers.base import Classifier
+from tagmate.classifiers.registry import get_model_version, new_version_storage_path, register_model_version
 from tagmate.models.db.activity import (
     Activity as ActivityTable,
     Document as DocumentTable,
 )
 from tagmate.logging.worker import JobLogger
+from tagmate.models.enums import ActivityTaskEnum, JobStageEnum
+from tagmate.storage.checkpoint import JobCheckpoint
 from tagmate.storage.minio import MinioObjectStore
+from tagmate.storage.model_cache import ModelCache, build_manifest, folder_size, manifest_digest
+from tagmate.utils.batching import count_tokens, map_in_length_buckets
+from tagmate.utils.cancellation import CancellationToken
 from tagmate.utils.constants import MODELS_BUCKET
 from tagmate.utils.database import db_init
+from tagmate.utils.dedupe import dedupe
+from tagmate.utils.metrics import stage
 from tagmate.utils.functions import SoftTemporaryDirectory
+from tagmate.utils.progress import ProgressReporter
+from tagmate.utils.queue import enqueue_fanout_job, reset_shards
 
 
 MODEL_ID = "sentence-transformers/paraphrase-mpnet-base-v2"
 BATCH_SIZE = 4
+MAX_BATCH_SIZE = 32
+# padded token budgets per batch, training holds two texts per pair plus gradients
+TRAIN_MAX_TOKENS = 2048
+INFERENCE_MAX_TOKENS = 16384
 NUM_ITERATIONS = 2
 METRIC = "accuracy"
+PREDICTION_CHUNK_SIZE = 1000
+# untagged sets larger than this are predicted by parallel shard jobs
+PREDICTION_SHARD_SIZE = int(env("PREDICTION_SHARD_SIZE", 20000))
+PREDICTION_TASK = "multi_label_prediction"
+
+TRAINED_CHECKPOINT = "trained.json"
+PREDICTIONS_CHECKPOINT = "predictions/{chunk_idx:06d}.json"
 
 
 class MultiLabelClassifier(Classifier):
-    def __init__(self, activity_id: str, logger: JobLogger | None = None):
+    def __init__(
+        self,
+        activity_id: str,
+        logger: JobLogger | None = None,
+        progress: ProgressReporter | None = None,
+        checkpoint: JobCheckpoint | None = None,
+        cancellation: CancellationToken | None = None,
+    ):
         self.activity_id = activity_id
         self.logger = logger
+        self.progress = progress or ProgressReporter(
+            redis=None, job_id="0", activity_id=activity_id
+        )
+        self.checkpoint = checkpoint
+        self.cancellation = cancellation or CancellationToken()
         self.is_multilabel = True
+        self.model_cache = ModelCache()
+        self.model_version = None
 
     async def fetch_activity_from_db(self):
         self.activity = await ActivityTable.get(id=self.activity_id)
 
-    async def get_activity_documents(self):
-        self.documents = await DocumentTable.filter(activity_id=self.activity_id)
+    @stage("get_activity_documents")
+    async def get_activity_documents(self, first_id: str | None = None, last_id: str | None = None):
+        query = DocumentTable.filter(activity_id=self.activity_id)
+        if first_id is not None and last_id is not None:
+            query = query.filter(id__gte=first_id, id__lte=last_id)
+        # stable ordering so prediction chunks line up with their checkpoints
+        self.documents = await query.order_by("id")
 
     @staticmethod
     def get_object_store():
         return MinioObjectStore()
 
+    def get_train_batch_size(self) -> int:
+        """largest batch size whose padded pairs fit the training token budget
+
+        SetFitTrainer builds the pair batches itself, so the budget is applied
+        to the batch size using the 95th percentile length of the tagged texts.
+        """
+        model_body = self.model.model_body
+        lengths = count_tokens(
+            model_body.tokenizer,
+            self.tagged_documents_df["text"].tolist(),
+            model_body.max_seq_length,
+        )
+        if len(lengths) == 0:
+            return BATCH_SIZE
+        typical_length = sorted(lengths)[int(0.95 * (len(lengths) - 1))]
+        return max(1, min(MAX_BATCH_SIZE, TRAIN_MAX_TOKENS // (2 * typical_length)))
+
+    @stage("train")
     def train(self):
+        batch_size = self.batch_size = self.get_train_batch_size()
+        self.logger.info(f"training with batch size {batch_size}")
         self.trainer = SetFitTrainer(
             model=self.model,
             train_dataset=self.tagged_documents_ds,
             loss_class=CosineSimilarityLoss,
             metric=METRIC,
-            batch_size=BATCH_SIZE,
+            batch_size=batch_size,
             num_iterations=NUM_ITERATIONS,
             num_epochs=1,
         )
@@ -96,27 +158,83 @@ class MultiLabelClassifier(Classifier):
         self.tagged_documents_df["label"] = self.tagged_documents_df["label"].apply(
             self.encode_labels
         )
-        self.logger.info(f"tagged df length: {self.tagged_documents_df[:10]}")
-        self.logger.info(f"untagged df length: {self.untagged_documents_df[:3]}")
+        self.logger.info(f"tagged df length: {len(self.tagged_documents_df)}")
+        self.logger.info(f"untagged df length: {len(self.untagged_documents_df)}")
 
     def convert_df_to_dataset(self) -> None:
         self.tagged_documents_ds = Dataset.from_pandas(self.tagged_documents_df)
 
+    @stage("save_model")
     def save_model(self):
         user_id = str(self.activity.user_id)
-        storage_path = joinpath(user_id, self.activity_id)
+        # every run uploads to a fresh prefix, earlier versions are never overwritten
+        self.saved_version_id, storage_path = new_version_storage_path(user_id, self.activity_id)
+        self.saved_storage_path = storage_path
 
         with SoftTemporaryDirectory() as tmpdir:
             local_storage_path = joinpath(tmpdir, self.activity_id)
             self.trainer.model.save_pretrained(save_directory=local_storage_path)
+            self.saved_manifest = build_manifest(local_storage_path)
+            self.saved_size = folder_size(local_storage_path)
             client = self.get_object_store()
             client.upload_objects_from_folder(
                 bucket_name=MODELS_BUCKET,
                 objects_path=storage_path,
                 folder_path=local_storage_path,
             )
+            # prediction right after training, and the next job on this worker, read it from disk
+            self.model_cache.add(local_storage_path, manifest_digest(self.saved_manifest), self.saved_manifest)
+
+    async def register_saved_model(self, metrics: dict, training_time: float):
+        self.model_version = await register_model_version(
+            version_id=self.saved_version_id,
+            activity_id=self.activity_id,
+            name=ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION.value,
+            storage_path=self.saved_storage_path,
+            manifest=self.saved_manifest,
+            size=self.saved_size,
+            metrics=metrics,
+            training_time=training_time,
+        )
+
+    async def fetch_model_version(self, version_id: str | None = None):
+        """the pinned model version, or the active version of the activity's classifier"""
+        self.model_version = await get_model_version(
+            self.activity_id, ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION.value, version_id
+        )
+
+    def get_model_version_path(self) -> str | None:
+        """local path of the latest model version of the activity, None if it was never trained"""
+        if self.model_version is None:
+            return None
+        return self.model_cache.fetch(
+            digest=self.model_version.digest,
+            manifest=self.model_version.manifest,
+            objects_path=self.model_version.storage_path,
+        )
 
     def load_model(self):
+        model_path = self.get_model_version_path()
+        if model_path is None:
+            self.logger.info(
+                f"Could not find an earlier model version, loading pretrained model from hub with id: {MODEL_ID}"
+            )
+            self.model = SetFitModel.from_pretrained(
+                MODEL_ID, multi_target_strategy="one-vs-rest"
+            )
+        else:
+            self.logger.info(f"Found an earlier model version with id: {self.model_version.id}")
+            self.model = SetFitModel.from_pretrained(model_path)
+        self.cancellation.watch(self.model.model_body)
+
+    def load_trained_model(self):
+        model_path = self.get_model_version_path()
+        if model_path is not None:
+            self.model = SetFitModel.from_pretrained(model_path)
+            self.cancellation.watch(self.model.model_body)
+            return
+
+        # models saved before versions were recorded only exist in the object store
         user_id = str(self.activity.user_id)
         storage_path = joinpath(user_id, self.activity_id)
         client = self.get_object_store()
@@ -127,31 +245,53 @@ class MultiLabelClassifier(Classifier):
                 objects_path=storage_path,
                 folder_path=tmpdir,
             )
-            if len(listdir(tmpdir)) == 0:
-                self.logger.info(
-                    f"Could not find an earlier model version, loading pretrained model from hub with id: {MODEL_ID}"
-                )
-                self.model = SetFitModel.from_pretrained(
-                    MODEL_ID, multi_target_strategy="one-vs-rest"
-                )
-            else:
-                self.logger.info(f"Found an earlier model version with id: {MODEL_ID}")
-                self.model = SetFitModel.from_pretrained(tmpdir)
-        # TODO: Remove this and fix in the original line
-        self.model = SetFitModel.from_pretrained(
-            MODEL_ID, multi_target_strategy="one-vs-rest"
-        )
+            self.model = SetFitModel.from_pretrained(tmpdir)
+        self.cancellation.watch(self.model.model_body)
 
+    @stage("generate_predictions")
     def generate_predictions(self):
         # self.load_model()
+        ids = [str(id) for id in self.untagged_documents_df["id"].tolist()]
         texts = self.untagged_documents_df["text"].tolist()
-        preds = self.model(texts)
-        self.logger.info(preds)
-        self.preds = [
-            [self.label_decoder[idx.item()] for idx in torch.argwhere(pred == 1)]
-            for pred in preds
-        ]
 
+        # predict once per unique text and fan the labels out to its duplicates
+        unique_idx, inverse = dedupe(texts)
+        unique_ids = [ids[idx] for idx in unique_idx]
+        unique_texts = [texts[idx] for idx in unique_idx]
+        self.logger.info(f"predicting {len(unique_texts)} unique texts for {len(texts)} documents")
+
+        unique_preds = []
+        for chunk_idx, start in enumerate(range(0, len(unique_texts), PREDICTION_CHUNK_SIZE)):
+            self.cancellation.raise_if_cancelled()
+            end = start + PREDICTION_CHUNK_SIZE
+            chunk_ids = unique_ids[start:end]
+            key = PREDICTIONS_CHECKPOINT.format(chunk_idx=chunk_idx)
+
+            saved = self.checkpoint.load_json(key) if self.checkpoint else None
+            if saved is not None and saved["ids"] == chunk_ids:
+                unique_preds.extend(saved["labels"])
+                continue
+
+            chunk_texts = unique_texts[start:end]
+            model_body = self.model.model_body
+            preds = map_in_length_buckets(
+                self.model,
+                chunk_texts,
+                lengths=count_tokens(model_body.tokenizer, chunk_texts, model_body.max_seq_length),
+                max_tokens=INFERENCE_MAX_TOKENS,
+            )
+            self.logger.info(f"predicted labels of {len(preds)} texts")
+            labels = [
+                [self.label_decoder[idx.item()] for idx in torch.argwhere(pred == 1)]
+                for pred in preds
+            ]
+            unique_preds.extend(labels)
+            if self.checkpoint is not None:
+                self.checkpoint.save_json(key, {"ids": chunk_ids, "labels": labels})
+
+        self.preds = [unique_preds[pos] for pos in inverse]
+
+    @stage("save_predictions")
     async def save_predictions(self):
         documents_to_save = [
             DocumentTable(id=row["id"], labels=self.preds[idx], is_auto_generated=True)
@@ -161,20 +301,118 @@ class MultiLabelClassifier(Classifier):
             objects=documents_to_save, fields=["labels", "is_auto_generated"]
         )
 
-    async def train_classifier(self):
+    def partition_untagged_documents(self) -> list[tuple[str, str]]:
+        """splits the untagged documents into contiguous id ranges of near equal size
+
+        The documents are split by row number in the primary key order they
+        were read in, the order the shards filter their id range by, so every
+        shard gets at most PREDICTION_SHARD_SIZE and none gets a small remainder.
+        """
+        ids = [str(id) for id in self.untagged_documents_df["id"]]
+        n_shards = -(-len(ids) // PREDICTION_SHARD_SIZE)
+        bounds = [len(ids) * shard_idx // n_shards for shard_idx in range(n_shards + 1)]
+        return [(ids[start], ids[end - 1]) for start, end in zip(bounds, bounds[1:])]
+
+    async def enqueue_prediction_shards(self, redis: ArqRedis, job_id: str) -> int:
+        ranges = self.partition_untagged_documents()
+
+        await reset_shards(redis, job_id)
+        for shard_idx, (first_id, last_id) in enumerate(ranges):
+            # shards stay on the queue, and so the lane, of the worker running the training job
+            await enqueue_fanout_job(
+                redis,
+                self.activity_id,
+                job_id,
+                PREDICTION_TASK,
+                f"{job_id}:predict:{shard_idx}",
+                redis.default_queue_name,
+                coordinator_job_id=job_id,
+                shard_idx=shard_idx,
+                n_shards=len(ranges),
+                first_id=first_id,
+                last_id=last_id,
+                # every shard predicts with the version this job trained
+                model_version_id=str(self.model_version.id) if self.model_version else None,
+            )
+        self.logger.info(f"split {len(self.untagged_documents_df)} untagged documents into {len(ranges)} shards")
+        return len(ranges)
+
+    async def run_prediction_shard(self, first_id: str, last_id: str, model_version_id: str | None = None):
         await db_init()
         await self.fetch_activity_from_db()
         await self.get_activity_tags()
 
+        # documents tagged since the shards were enqueued are left untouched
+        await self.get_activity_documents(first_id, last_id)
+        self.convert_documents_to_df()
+
+        await self.fetch_model_version(model_version_id)
+        await self.cancellation.run(self.load_trained_model)
+        await self.cancellation.run(self.generate_predictions)
+        await self.save_predictions()
+
+    async def train_classifier(self, redis: ArqRedis | None = None, job_id: str | None = None) -> int:
+        """trains the classifier and labels the untagged documents
+
+        Args:
+            redis (ArqRedis | None): arq redis pool, enables fanning out predictions
+            job_id (str | None): id of the training job the prediction shards report to
+
+        Returns:
+            int: number of prediction shards enqueued, 0 when predicted in this job
+        """
+        await db_init()
+        await self.progress.update(JobStageEnum.fetch, 0)
+        await self.fetch_activity_from_db()
+        await self.get_activity_tags()
+
         await self.get_activity_documents()
         self.convert_documents_to_df()
         self.convert_df_to_dataset()
 
-        self.load_model()
-        self.train()
-        self.save_model()
-        self.generate_predictions()
+        n_tagged = len(self.tagged_documents_df)
+        n_untagged = len(self.untagged_documents_df)
+
+        trained = self.checkpoint.load_json(TRAINED_CHECKPOINT) if self.checkpoint else None
+        if trained is not None:
+            self.logger.info("resuming from the model saved by an earlier attempt")
+            await self.fetch_model_version(trained.get("model_version_id"))
+            await self.cancellation.run(self.load_trained_model)
+        else:
+            # warm start from the active version of the classifier
+            await self.fetch_model_version()
+            await self.progress.update(JobStageEnum.train, 10, 0, n_tagged)
+            await self.cancellation.run(self.load_model)
+            started = time.perf_counter()
+            await self.cancellation.run(self.train)
+            training_time = time.perf_counter() - started
+
+            await self.progress.update(JobStageEnum.save, 60, n_tagged, n_tagged)
+            await self.cancellation.run(self.save_model)
+            await self.register_saved_model(
+                metrics={
+                    "tagged_documents": n_tagged,
+                    "tags": len(self.tags),
+                    "batch_size": self.batch_size,
+                    "num_iterations": NUM_ITERATIONS,
+                },
+                training_time=training_time,
+            )
+            if self.checkpoint is not None:
+                self.checkpoint.save_json(
+                    TRAINED_CHECKPOINT,
+                    {"tagged": n_tagged, "model_version_id": str(self.model_version.id)},
+                )
+
+        await self.progress.update(JobStageEnum.predict, 70, 0, n_untagged)
+        if redis is not None and n_untagged > PREDICTION_SHARD_SIZE:
+            return await self.enqueue_prediction_shards(redis, job_id)
+
+        await self.cancellation.run(self.generate_predictions)
+
+        await self.progress.update(JobStageEnum.write_back, 90, n_untagged, n_untagged)
         await self.save_predictions()
+        return 0
         # self.logger.info(
         #     f"model generated prediction: {self.predict(['Items are highly priced compared to local market!'])}"
         # )
@@ -0,0 +1,126 @@
+import uuid
+from os.path import join as joinpath
+
+from tortoise.transactions import in_transaction
+
+from tagmate.models.db.activity import (
+    Classifier as ClassifierTable,
+    ModelVersion as ModelVersionTable,
+)
+from tagmate.storage.model_cache import manifest_digest
+from tagmate.utils.database import PRIMARY_CONNECTION, primary
+
+
+def new_version_storage_path(user_id: str, activity_id: str) -> tuple[str, str]:
+    """id and object store prefix for a model version about to be saved
+
+    Every training run uploads to its own prefix, which is never written to
+    again, so concurrent runs cannot overwrite each other's files.
+
+    Returns:
+        tuple[str, str]: uuid of the model version and its object store prefix
+    """
+    version_id = str(uuid.uuid4())
+    return version_id, joinpath(str(user_id), str(activity_id), "versions", version_id)
+
+
+async def register_model_version(
+    version_id: str,
+    activity_id: str,
+    name: str,
+    storage_path: str,
+    manifest: dict[str, str],
+    size: int,
+    metrics: dict | None = None,
+    training_time: float | None = None,
+    promote: bool = True,
+) -> ModelVersionTable:
+    """records a saved model version under the classifier of an activity
+
+    The version number is assigned and the active version switched in one
+    transaction holding the classifier row lock, so concurrent runs get
+    distinct numbers and readers see either the old or the new version.
+
+    Args:
+        version_id (str): uuid of the model version, from `new_version_storage_path`
+        activity_id (str): uuid of the activity
+        name (str): classifier name, the task it was trained for
+        storage_path (str): object store prefix of the model files
+        manifest (dict[str, str]): sha256 of every model file
+        size (int): total size of the model files in bytes
+        metrics (dict | None): training metrics of the run
+        training_time (float | None): training time in seconds
+        promote (bool): make this the active version of the classifier
+
+    Returns:
+        ModelVersionTable: the new model version
+    """
+    async with in_transaction(PRIMARY_CONNECTION) as connection:
+        classifier, _ = await ClassifierTable.get_or_create(
+            activity_id=activity_id,
+            name=name,
+            defaults={"storage_path": storage_path.rsplit("/versions/", 1)[0]},
+            using_db=connection,
+        )
+        classifier = await ClassifierTable.select_for_update().using_db(connection).get(id=classifier.id)
+
+        latest = (
+            await ModelVersionTable.filter(classifier_id=classifier.id)
+            .using_db(connection)
+            .order_by("-version")
+            .first()
+        )
+        model_version = await ModelVersionTable.create(
+            id=version_id,
+            classifier=classifier,
+            version=latest.version + 1 if latest is not None else 1,
+            digest=manifest_digest(manifest),
+            manifest=manifest,
+            storage_path=storage_path,
+            size=size,
+            metrics=metrics or {},
+            training_time=training_time,
+            using_db=connection,
+        )
+        if promote:
+            classifier.active_version_id = model_version.id
+            await classifier.save(update_fields=["active_version_id", "updated_at"], using_db=connection)
+    return model_version
+
+
+async def promote_model_version(version_id: str) -> None:
+    """makes a model version the active version of its classifier"""
+    async with in_transaction(PRIMARY_CONNECTION) as connection:
+        model_version = await ModelVersionTable.get(id=version_id, using_db=connection)
+        await ClassifierTable.filter(id=model_version.classifier_id).using_db(connection).update(
+            active_version_id=model_version.id
+        )
+
+
+async def get_model_version(
+    activity_id: str, name: str, version_id: str | None = None
+) -> ModelVersionTable | None:
+    """a pinned model version, or the active version of the classifier
+
+    Args:
+        activity_id (str): uuid of the activity
+        name (str): classifier name, the task it was trained for
+        version_id (str | None): uuid of a pinned version, None for the active one
+
+    Returns:
+        ModelVersionTable | None: the model version, None if the classifier was never trained
+    """
+    # read from the primary, the version is usually written moments before by another job
+    if version_id is None:
+        classifier = await ClassifierTable.get_or_none(
+            activity_id=activity_id, name=name, using_db=primary()
+        )
+        if classifier is None or classifier.active_version_id is None:
+            return None
+        version_id = classifier.active_version_id
+    return await ModelVersionTable.get_or_none(
+        id=version_id,
+        classifier__activity_id=activity_id,
+        classifier__name=name,
+        using_db=primary(),
+    )
@@ -0,0 +1,221 @@
+from os import getenv as env
+from typing import Iterator
+
+import numpy as np
+import torch
+from arq.connections import ArqRedis
+
+from tagmate.classifiers.clustering import ClusterBuilder
+from tagmate.logging.worker import JobLogger
+from tagmate.models.enums import JobStageEnum
+from tagmate.storage.checkpoint import JobCheckpoint
+from tagmate.utils.cancellation import CancellationToken
+from tagmate.utils.progress import ProgressReporter
+from tagmate.utils.queue import enqueue_fanout_job, mark_shard_done, reset_shards
+
+
+# corpora with more unique sentences than this are clustered in shards
+SHARD_SIZE = int(env("CLUSTERING_SHARD_SIZE", 50000))
+SHARD_MIN_COMMUNITY_SIZE = 10
+MIN_COMMUNITY_SIZE = 20
+# shard clusters whose centroids are at least this similar are merged
+MERGE_THRESHOLD = 0.8
+# centroids are compared in tiles of this many rows and columns, not as one dense matrix
+MERGE_BLOCK_SIZE = 2048
+
+SHARD_TASK = "clustering_shard"
+REDUCE_TASK = "clustering_reduce"
+
+MANIFEST_CHECKPOINT = "shards/manifest.json"
+SHARD_SENTENCES_CHECKPOINT = "shards/{shard_idx:05d}/sentences.json"
+SHARD_CLUSTERS_CHECKPOINT = "shards/{shard_idx:05d}/clusters.json"
+SHARD_CENTROIDS_CHECKPOINT = "shards/{shard_idx:05d}/centroids.npy"
+
+
+def similar_pairs(vectors: np.ndarray, threshold: float, block_size: int = MERGE_BLOCK_SIZE) -> Iterator[tuple[int, int]]:
+    """pairs of normalised vectors whose cosine similarity is at least `threshold`, the lower index first
+
+    The similarities are computed in tiles on and above the diagonal, so
+    memory stays at `block_size` squared rather than growing with the square
+    of the number of vectors.
+    """
+    for row in range(0, len(vectors), block_size):
+        for col in range(row, len(vectors), block_size):
+            similar = vectors[row:row + block_size] @ vectors[col:col + block_size].T >= threshold
+            for idx, other in zip(*np.nonzero(similar)):
+                if row + idx < col + other:
+                    yield int(row + idx), int(col + other)
+
+
+class ShardedClusterBuilder(ClusterBuilder):
+    """map/reduce clustering across the clustering worker pool
+
+    The coordinator splits the unique sentences into shards and enqueues a
+    shard job per shard. Each shard job embeds its sentences and runs local
+    community detection, storing the clusters and their centroids in the
+    coordinator's checkpoint. The last shard to finish enqueues the reduce
+    job, which merges shard clusters with similar centroids and writes the
+    clusters back.
+    """
+
+    def __init__(
+        self,
+        activity_id: str,
+        coordinator_job_id: str,
+        logger: JobLogger | None = None,
+        progress: ProgressReporter | None = None,
+        checkpoint: JobCheckpoint | None = None,
+        cancellation: CancellationToken | None = None,
+    ):
+        super().__init__(
+            activity_id=activity_id,
+            logger=logger,
+            progress=progress,
+            checkpoint=checkpoint or JobCheckpoint(activity_id=activity_id, job_id=coordinator_job_id),
+            cancellation=cancellation,
+        )
+        self.coordinator_job_id = coordinator_job_id
+
+    def should_shard(self) -> bool:
+        return len(self.unique_sentences) > SHARD_SIZE
+
+    def shard_job_id(self, shard_idx: int) -> str:
+        return f"{self.coordinator_job_id}:shard:{shard_idx}"
+
+    def reduce_job_id(self) -> str:
+        return f"{self.coordinator_job_id}:reduce"
+
+    async def enqueue_shards(self, redis: ArqRedis) -> int:
+        n_shards = -(-len(self.unique_sentences) // SHARD_SIZE)
+        for shard_idx in range(n_shards):
+            start = shard_idx * SHARD_SIZE
+            self.checkpoint.save_json(
+                SHARD_SENTENCES_CHECKPOINT.format(shard_idx=shard_idx),
+                {"offset": start, "sentences": self.unique_sentences[start:start + SHARD_SIZE]},
+            )
+        self.checkpoint.save_json(
+            MANIFEST_CHECKPOINT,
+            {"n_shards": n_shards, "n_unique": len(self.unique_sentences)},
+        )
+
+        await reset_shards(redis, self.coordinator_job_id)
+        for shard_idx in range(n_shards):
+            # shards stay on the queue, and so the lane, of the worker running the coordinator
+            await enqueue_fanout_job(
+                redis,
+                self.activity_id,
+                self.coordinator_job_id,
+                SHARD_TASK,
+                self.shard_job_id(shard_idx),
+                redis.default_queue_name,
+                coordinator_job_id=self.coordinator_job_id,
+                shard_idx=shard_idx,
+            )
+        self.logger.info(f"split {len(self.unique_sentences)} unique sentences into {n_shards} shards")
+        return n_shards
+
+    def compute_centroids(self) -> np.ndarray:
+        centroids = [
+            torch.nn.functional.normalize(self.embeddings[cluster].mean(dim=0), dim=0)
+            for cluster in self.clusters
+        ]
+        if len(centroids) == 0:
+            return np.zeros((0, self.embeddings.shape[1]), dtype=np.float32)
+        return torch.stack(centroids).cpu().numpy()
+
+    def cluster_shard(self, shard_idx: int) -> None:
+        shard = self.checkpoint.load_json(SHARD_SENTENCES_CHECKPOINT.format(shard_idx=shard_idx))
+        self.unique_sentences = shard["sentences"]
+        self.sentence2unique = list(range(len(self.unique_sentences)))
+
+        self.load_model()
+        # shards are checkpointed as a whole, skip the per-stage embedding checkpoint
+        checkpoint, self.checkpoint = self.checkpoint, None
+        try:
+            self.generate_embeddings()
+        finally:
+            self.checkpoint = checkpoint
+        self.build_clusters(size=SHARD_MIN_COMMUNITY_SIZE)
+
+        offset = shard["offset"]
+        self.checkpoint.save_json(
+            SHARD_CLUSTERS_CHECKPOINT.format(shard_idx=shard_idx),
+            [[offset + idx for idx in cluster] for cluster in self.clusters],
+        )
+        self.checkpoint.save_array(
+            SHARD_CENTROIDS_CHECKPOINT.format(shard_idx=shard_idx), self.compute_centroids()
+        )
+
+    async def run_shard(self, redis: ArqRedis, shard_idx: int) -> None:
+        await self.cancellation.run(self.cluster_shard, shard_idx)
+
+        manifest = self.checkpoint.load_json(MANIFEST_CHECKPOINT)
+        n_done, is_last = await mark_shard_done(redis, self.coordinator_job_id, shard_idx, manifest["n_shards"])
+        await self.progress.update(
+            JobStageEnum.embed, 10 + 70 * n_done / manifest["n_shards"], n_done, manifest["n_shards"]
+        )
+
+        # only the shard completing the set enqueues the reduce job
+        if is_last:
+            await enqueue_fanout_job(
+                redis,
+                self.activity_id,
+                self.coordinator_job_id,
+                REDUCE_TASK,
+                self.reduce_job_id(),
+                redis.default_queue_name,
+                coordinator_job_id=self.coordinator_job_id,
+            )
+
+    def merge_shard_clusters(self, n_shards: int) -> list[list[int]]:
+        """merges shard clusters with similar centroids into clusters of unique sentence indices"""
+        clusters, centroids = [], []
+        for shard_idx in range(n_shards):
+            clusters.extend(self.checkpoint.load_json(SHARD_CLUSTERS_CHECKPOINT.format(shard_idx=shard_idx)))
+            centroids.append(self.checkpoint.load_array(SHARD_CENTROIDS_CHECKPOINT.format(shard_idx=shard_idx)))
+        if len(clusters) == 0:
+            return []
+
+        centroids = np.concatenate(centroids)
+        parent = list(range(len(clusters)))
+
+        def find(idx: int) -> int:
+            while parent[idx] != idx:
+                parent[idx] = parent[parent[idx]]
+                idx = parent[idx]
+            return idx
+
+        for idx, other in similar_pairs(centroids, MERGE_THRESHOLD):
+            root, other_root = find(idx), find(other)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+
+        merged = {}
+        for idx, cluster in enumerate(clusters):
+            merged.setdefault(find(idx), []).extend(cluster)
+        return sorted(merged.values(), key=len, reverse=True)
+
+    async def run_reduce(self) -> None:
+        await self.prepare_sentences()
+        manifest = self.checkpoint.load_json(MANIFEST_CHECKPOINT)
+        if manifest["n_unique"] != len(self.unique_sentences):
+            raise RuntimeError("activity documents changed while the clustering shards were running")
+
+        await self.progress.update(JobStageEnum.cluster, 80, manifest["n_unique"], manifest["n_unique"])
+        unique_clusters = await self.cancellation.run(self.merge_shard_clusters, manifest["n_shards"])
+
+        # expand clusters of unique sentences to every sentence sharing that text
+        unique2sentences = {}
+        for sentence_idx, unique_pos in enumerate(self.sentence2unique):
+            unique2sentences.setdefault(unique_pos, []).append(sentence_idx)
+        self.clusters = [
+            [sentence_idx for unique_pos in cluster for sentence_idx in unique2sentences[unique_pos]]
+            for cluster in unique_clusters
+        ]
+        large_clusters = [cluster for cluster in self.clusters if len(cluster) >= MIN_COMMUNITY_SIZE]
+        self.clusters = large_clusters or self.clusters
+        self.logger.info(f"merged shard clusters into {len(self.clusters)} clusters")
+
+        await self.progress.update(JobStageEnum.write_back, 90, len(self.sentences), len(self.sentences))
+        await self.save_clusters()
+        self.checkpoint.clear()
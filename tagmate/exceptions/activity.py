@@ -88,3 +88,80 @@ class JobAlreadyInProgress(HTTPException):
     ):
         logger.exception(exception)
         super().__init__(status_code=status_code, detail=detail)
+
+
+class JobAbortError(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_409_CONFLICT,
+        detail="the job has already finished and can not be aborted",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class JobDoesNotExist(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="No job exists by this id for the activity",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class ModelVersionDoesNotExist(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="No model version exists by this id for the activity",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class JobLogsDoNotExist(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="No logs were stored for this job",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class NotActivityOwner(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Only the owner of the activity can do this",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class InvalidExportOptions(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Invalid export options",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
+
+
+class InvalidUploadFile(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Could not read the uploaded file",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
@@ -0,0 +1,13 @@
+from fastapi import HTTPException, status
+from tagmate.logging.app import logger
+
+
+class ProfileDoesNotExist(HTTPException):
+    def __init__(
+        self,
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="No profile exists by this id",
+        exception=None,
+    ):
+        logger.exception(exception)
+        super().__init__(status_code=status_code, detail=detail)
@@ -19,3 +19,13 @@ class InvalidPassword(HTTPException):
 class InvalidToken(HTTPException):
     def __init__(self):
         super().__init__(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token", headers={"WWW-Authenticate": "Bearer"})
+
+
+class NotAnAdmin(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_403_FORBIDDEN, detail="admin access required")
+
+
+class TooManyLoginAttempts(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="too many login attempts, try again later")
@@ -2,6 +2,8 @@ import logging
 from os import getenv as env
 import sys
 
+from tagmate.logging.handlers import DefaultFields, get_formatter, start_queue_listener
+
 
 LOG_LEVEL = logging.getLevelName(env("APP_LOG_LEVEL", "INFO"))
 SEP = " " * 2
@@ -42,27 +44,19 @@ class RouteFilter(logging.Filter):
         return True
 
 
-class BaseHandler(logging.StreamHandler):
-    def format(self, record):
-        try:
-            record.requestID
-        except:
-            record.requestID = "0"
-
-        fmt = logging.Formatter(fmt=BASELOGFMT, datefmt=DATEFMT)
-        return fmt.format(record)
-
-
 def init_logger():
-    stdout = BaseHandler(sys.stdout)
+    # records are written to stdout by a listener thread, so request handlers never block on it
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setFormatter(get_formatter(BASELOGFMT, DATEFMT))
+    stdout.addFilter(DefaultFields(requestID="0"))
+    queue_handler = start_queue_listener(stdout)
     for module in ENABLE_LOGGERS:
-        stdout.setFormatter(logging.Formatter(fmt=BASELOGFMT, datefmt=DATEFMT))
         logging.getLogger(module).disabled = False
         logging.getLogger(module).isEnabledFor(logging.INFO)
         logging.getLogger(module).setLevel(LOG_LEVEL)
-        for handler in logging.getLogger(module).handlers:
+        for handler in logging.getLogger(module).handlers[:]:
             logging.getLogger(module).removeHandler(handler)
-        logging.getLogger(module).addHandler(stdout)
+        logging.getLogger(module).addHandler(queue_handler)
         logging.getLogger(module).addFilter(RouteFilter())
 
 
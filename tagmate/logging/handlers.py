@@ -0,0 +1,125 @@
+import atexit
+import json
+import logging
+import math
+import queue
+import reprlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from os import getenv as env
+
+
+# json for log shippers, text for reading the logs of a local run
+LOG_FORMAT = env("LOG_FORMAT", "json")
+# longest rendering of a logged object, larger objects are cut
+LOG_MAX_CHARS = int(env("LOG_MAX_CHARS", 2000))
+# arrays and frames with more elements than this are logged by shape only
+LOG_MAX_ELEMENTS = 100
+
+# attributes every record has, anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_repr = reprlib.Repr()
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxdict = 10
+_repr.maxstring = _repr.maxother = LOG_MAX_CHARS
+
+_listener: QueueListener | None = None
+
+
+def render(obj, max_chars: int = LOG_MAX_CHARS) -> str:
+    """string of a logged object, capped at `max_chars`
+
+    Tensors, arrays and data frames above a few elements are rendered as
+    their type and shape, containers are rendered with their first items.
+    """
+    if isinstance(obj, str):
+        text = obj
+    elif hasattr(obj, "shape") and math.prod(obj.shape) > LOG_MAX_ELEMENTS:
+        text = f"<{type(obj).__name__} shape={tuple(obj.shape)}>"
+    elif hasattr(obj, "shape"):
+        text = str(obj)
+    else:
+        text = _repr.repr(obj)
+    if len(text) > max_chars:
+        text = f"{text[:max_chars]}... [{len(text) - max_chars} more characters]"
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per record, with the `extra` fields as keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": render(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class PreparedQueueHandler(QueueHandler):
+    """queue handler leaving the formatting to the handlers of the listener
+
+    The message is merged with its arguments and the traceback rendered in
+    the logging thread, so that the record no longer references the logged
+    objects, while the output format is applied by the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        if isinstance(record.msg, str) or record.args:
+            record.msg = render(record.getMessage())
+        else:
+            # rendered directly, str() of a large tensor or frame is the expensive part
+            record.msg = render(record.msg)
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DefaultFields(logging.Filter):
+    """fills the fields of the text formats which only some records carry"""
+
+    def __init__(self, **defaults):
+        super().__init__()
+        self.defaults = defaults
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in self.defaults.items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+def get_formatter(text_format: str, datefmt: str) -> logging.Formatter:
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter(fmt=text_format, datefmt=datefmt)
+
+
+def start_queue_listener(handler: logging.Handler) -> QueueHandler:
+    """starts the thread writing the log records through `handler`, once per process
+
+    Later calls reuse the running listener and its handler.
+
+    Returns:
+        QueueHandler: handler to attach to the loggers, it only enqueues records
+    """
+    global _listener
+    if _listener is not None:
+        return PreparedQueueHandler(_listener.queue)
+    _listener = QueueListener(queue.SimpleQueue(), handler, respect_handler_level=True)
+    _listener.start()
+    # flushes the records still queued when the process exits
+    atexit.register(_listener.stop)
+    return PreparedQueueHandler(_listener.queue)
@@ -1,15 +1,20 @@
 import logging
 from os import getenv as env
 import sys
+import threading
+
+from tagmate.logging.handlers import DefaultFields, JsonFormatter, get_formatter, render, start_queue_listener
 
 
 LOG_LEVEL = logging.getLevelName(env("APP_LOG_LEVEL", "INFO"))
-SEP = " "*4
+SEP = " " * 4
 BASELOGFMT = f"[time] %(asctime)s.%(msecs)03d{SEP}[level] %(levelname)-8s [logger] %(name)-10s{SEP}[message] %(message)s"
 JOBLOGFMT = f"[time] %(asctime)s.%(msecs)03d{SEP}[level] %(levelname)-8s [logger] %(name)-10s{SEP}[requestID] %(requestID)s{SEP}[jobID] %(jobID)s{SEP}[message] %(message)s"
 DATEFMT = "%Y-%m-%d %H:%M:%S"
 
 JOB_LOGGER_NAME = "tagmate.worker.job"
+# records kept per job for its log file, later records are counted but dropped
+JOB_LOG_MAX_RECORDS = int(env("JOB_LOG_MAX_RECORDS", 10000))
 
 ENABLE_LOGGERS = [
     # "root",
@@ -19,38 +24,103 @@ ENABLE_LOGGERS = [
     "tortoise.db_client",
     "minio",
     "sentence_transformers.SentenceTransformer",
+    JOB_LOGGER_NAME,
 ]
 
+# records are written to stdout by a listener thread, logging calls only enqueue them
 stdout = logging.StreamHandler(sys.stdout)
+stdout.setFormatter(get_formatter(JOBLOGFMT, DATEFMT))
+stdout.addFilter(DefaultFields(requestID="0", jobID="0"))
+queue_handler = start_queue_listener(stdout)
 for module in ENABLE_LOGGERS:
-    stdout.setFormatter(logging.Formatter(fmt=BASELOGFMT, datefmt=DATEFMT))
     logging.getLogger(module).setLevel(LOG_LEVEL)
-    logging.getLogger(module).addHandler(stdout)
+    # child loggers propagate to the handler of their parent, adding it twice duplicates lines
+    if not any(module.startswith(f"{parent}.") for parent in ENABLE_LOGGERS):
+        logging.getLogger(module).addHandler(queue_handler)
+
+job_logger = logging.getLogger(JOB_LOGGER_NAME)
+job_logger.propagate = False
+
+
+class JobLogCapture(logging.Handler):
+    """keeps the job logger records of the jobs being captured, for their log file"""
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(JsonFormatter())
+        self.records: dict[str, list[str]] = {}
+        self.dropped: dict[str, int] = {}
+        self.captures_lock = threading.Lock()
+
+    def start(self, job_id: str) -> None:
+        with self.captures_lock:
+            self.records[job_id] = []
+            self.dropped[job_id] = 0
+
+    def finish(self, job_id: str) -> bytes:
+        """the captured records as json lines, and stops capturing the job"""
+        with self.captures_lock:
+            records = self.records.pop(job_id, [])
+            dropped = self.dropped.pop(job_id, 0)
+        if dropped:
+            records.append(self.format(logging.makeLogRecord({
+                "name": JOB_LOGGER_NAME,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"{dropped} records beyond {JOB_LOG_MAX_RECORDS} were not captured",
+                "jobID": job_id,
+            })))
+        return "".join(f"{record}\n" for record in records).encode("utf-8")
+
+    def emit(self, record: logging.LogRecord) -> None:
+        job_id = getattr(record, "jobID", None)
+        records = self.records.get(job_id)
+        if records is None:
+            return
+        if len(records) >= JOB_LOG_MAX_RECORDS:
+            self.dropped[job_id] += 1
+            return
+        try:
+            records.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+job_log_capture = JobLogCapture()
+job_logger.addHandler(job_log_capture)
 
 
 class JobLogger(logging.LoggerAdapter):
+    """adapter of the shared job logger adding the job and request ids
+
+    Non string messages are rendered with `render`, so logging a tensor or a
+    data frame logs its shape rather than every value.
+    """
 
-    def __init__(self, job_id: str = "0", request_id: str = "0"):
+    def __init__(self, job_id: str = "0", request_id: str = "0", capture: bool = False):
         self.job_id = job_id
         self.request_id = request_id
         self.level = LOG_LEVEL
+        self.capture = capture
         self.extra = {
             "jobID": self.job_id,
             "requestID": self.request_id,
         }
+        if capture:
+            job_log_capture.start(job_id)
 
-        self.logger = logging.Logger(JOB_LOGGER_NAME)
-
-        # ensure the logger is not disabled for the desired level
-        self.logger.disabled = False
-        self.logger.isEnabledFor(LOG_LEVEL)
-        self.logger.setLevel(LOG_LEVEL)
+        super().__init__(job_logger, self.extra)
 
-        self.handler = logging.StreamHandler(sys.stdout)
-        self.handler.setFormatter(logging.Formatter(fmt=JOBLOGFMT, datefmt=DATEFMT))
-        self.logger.handlers = [self.handler]
+    def process(self, msg, kwargs):
+        if not isinstance(msg, str):
+            msg = render(msg)
+        return super().process(msg, kwargs)
 
-        super().__init__(self.logger, self.extra)
+    def captured_logs(self) -> bytes:
+        """the records logged since the logger was created, as json lines"""
+        if not self.capture:
+            return b""
+        return job_log_capture.finish(self.job_id)
 
 
-logger = logging.getLogger()
\ No newline at end of file
+logger = logging.getLogger()
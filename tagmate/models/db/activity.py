@@ -4,6 +4,7 @@ from tortoise.models import Model
 from tagmate.utils.database import DB_URI
 from tagmate.models.enums import ActivityStatusEnum, JobStatusEnum
 
+
 class Activity(Model):  # type: ignore
     id = fields.UUIDField(pk=True)
     name = fields.CharField(max_length=100)
@@ -23,6 +24,10 @@ class ActivityUserMap(Model):
     is_owner = fields.BooleanField()
     created_at = fields.DatetimeField(auto_now_add=True)
 
+    class Meta:
+        # activity listing filters the map by user and joins the activities
+        indexes = (("user_id", "activity_id"),)
+
 
 class Document(Model):
     id = fields.UUIDField(pk=True)
@@ -59,9 +64,29 @@ class Classifier(Model):
     name = fields.CharField(max_length=100)
     storage_path = fields.CharField(max_length=1000)
     activity = fields.ForeignKeyField(model_name="models.Activity", to_field="id")
+    active_version_id = fields.UUIDField(null=True, description="model version used for inference and warm starts")
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
 
+    class Meta:
+        unique_together = (("activity", "name"),)
+
+
+class ModelVersion(Model):
+    id = fields.UUIDField(pk=True)
+    classifier = fields.ForeignKeyField(model_name="models.Classifier", to_field="id", related_name="versions")
+    version = fields.IntField(description="sequential version number within the classifier")
+    digest = fields.CharField(max_length=64, index=True, description="sha256 of the manifest, content address of the model files")
+    manifest = fields.JSONField(description="sha256 of every model file keyed by its path relative to storage_path")
+    storage_path = fields.CharField(max_length=1000, description="immutable object store prefix of this version")
+    size = fields.BigIntField(description="total size of the model files in bytes")
+    metrics = fields.JSONField(default={})
+    training_time = fields.FloatField(null=True, description="training time in seconds")
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (("classifier", "version"),)
+
 
 async def db_init(db_url=None):
     await Tortoise.init(
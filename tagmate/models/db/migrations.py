@@ -0,0 +1,41 @@
+from tortoise import Tortoise, connections, run_async
+
+from tagmate.utils.database import PRIMARY_CONNECTION, TORTOISE_ORM
+
+
+# generate_schemas only creates missing tables, these bring existing tables up to the models.
+# Constraint and index names are the ones generate_schemas gives them on a new
+# database, so that running these there changes nothing, keep them in sync with the models.
+MIGRATIONS = [
+    # Classifier.active_version_id
+    'ALTER TABLE "classifier" ADD COLUMN IF NOT EXISTS "active_version_id" UUID',
+    # Classifier.Meta.unique_together, postgres has no ADD CONSTRAINT IF NOT EXISTS
+    """DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uid_classifier_activit_04c7aa') THEN
+        ALTER TABLE "classifier" ADD CONSTRAINT "uid_classifier_activit_04c7aa" UNIQUE ("activity_id", "name");
+    END IF;
+END $$""",
+    # ActivityUserMap.Meta.indexes
+    'CREATE INDEX IF NOT EXISTS "idx_activityuse_user_id_123361" ON "activityusermap" ("user_id", "activity_id")',
+]
+
+
+async def migrate():
+    """creates missing tables, then brings the existing ones up to the models
+
+    Run once after deploying a version which changes the models, before the
+    api and the workers are started:
+
+        python -m tagmate.models.db.migrations
+    """
+    await Tortoise.init(config=TORTOISE_ORM)
+    await Tortoise.generate_schemas()
+    connection = connections.get(PRIMARY_CONNECTION)
+    for statement in MIGRATIONS:
+        await connection.execute_script(statement)
+    await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    run_async(migrate())
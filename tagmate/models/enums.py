@@ -1,5 +1,4 @@
 from enum import Enum
-from arq.jobs import JobStatus as ArqJobStatus
 
 
 class ActivityTaskEnum(str, Enum):
@@ -25,4 +24,46 @@ class JobStatusEnum(str, Enum):
     in_progress = "in_progress"
     not_found = "not_found"
     success = "success"
-    failed = "failed"
\ No newline at end of file
+    failed = "failed"
+    aborting = "aborting"
+    aborted = "aborted"
+
+
+class JobPriorityEnum(str, Enum):
+    interactive = "interactive"
+    bulk = "bulk"
+
+
+class JobStageEnum(str, Enum):
+    queued = "queued"
+    fetch = "fetch"
+    embed = "embed"
+    cluster = "cluster"
+    train = "train"
+    save = "save"
+    predict = "predict"
+    write_back = "write_back"
+    completed = "completed"
+    failed = "failed"
+    aborted = "aborted"
+
+
+class ExportFormatEnum(str, Enum):
+    parquet = "parquet"
+    csv = "csv"
+    jsonl = "jsonl"
+
+
+class ExportCompressionEnum(str, Enum):
+    none = "none"
+    gzip = "gzip"
+    # parquet only, applied per column chunk
+    snappy = "snappy"
+    zstd = "zstd"
+
+
+class UploadFormatEnum(str, Enum):
+    csv = "csv"
+    jsonl = "jsonl"
+    parquet = "parquet"
+    excel = "excel"
@@ -1,3 +1,4 @@
+import datetime
 import uuid
 from tortoise import Tortoise
 from enum import Enum
@@ -18,6 +19,14 @@ Document = pydantic_model_creator(
 )
 
 
+class ActivitySummary(Activity):
+    is_owner: bool
+    # only set when the counts are requested
+    document_count: int | None = None
+    auto_labelled_count: int | None = None
+    validated_count: int | None = None
+
+
 class ActivityCreate(BaseModel):
     name: str
     task: str
@@ -44,4 +53,16 @@ class ActivityStatus(ActivityId):
 
 class JobStatus(BaseModel):
     id: uuid.UUID
-    status: JobStatusEnum
\ No newline at end of file
+    status: JobStatusEnum
+
+
+class ModelVersion(BaseModel):
+    id: uuid.UUID
+    name: str
+    version: int
+    digest: str
+    size: int
+    metrics: dict
+    training_time: float | None
+    is_active: bool
+    created_at: datetime.datetime
@@ -30,4 +30,12 @@ class UserLogin(UserEmail):
 class UserToken(UserEmail):
     username: str
     access_token: str
-    token_type: str = "bearer"
\ No newline at end of file
+    token_type: str = "bearer"
+
+
+class TokenClaims(BaseModel):
+    email: str
+    # absent from tokens issued before the user id was embedded
+    user_id: uuid.UUID | None = None
+    token_id: str | None = None
+    expires_at: float
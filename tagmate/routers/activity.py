@@ -1,17 +1,19 @@
-from tortoise import Tortoise, fields, run_async
-import time
+from tortoise import BaseDBAsyncClient
+import asyncio
 import uuid
 import datetime
-from os import getenv as env
+from os import SEEK_END
 from os.path import join as joinpath
-from arq import create_pool
-from arq.connections import RedisSettings
-from arq.jobs import Job
+import json
 import redis  # type: ignore
 
-from fastapi import APIRouter, Depends, File, Form, UploadFile
+from fastapi import APIRouter, Depends, File, Form, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from tortoise import exceptions as TortoiseExceptions
+from tortoise.expressions import Q
+from tortoise.functions import Count
 
+from tagmate.classifiers.registry import promote_model_version
 from tagmate.exceptions import activity as ActivityExceptions
 from tagmate.exceptions import auth as AuthExceptions
 from tagmate.models.db.activity import (
@@ -19,29 +21,56 @@ from tagmate.models.db.activity import (
     ActivityUserMap as ActivityUserTable,
     Document as DocumentTable,
     Job as JobTable,
+    ModelVersion as ModelVersionTable,
 )
 from tagmate.models.db.user import User as UserTable
 from tagmate.models.py.activity import (
     Activity,
-    ActivityCreate,
     ActivityId,
     ActivityStatus,
+    ActivitySummary,
     JobStatus,
     JobStatusEnum,
     Document,
+    ModelVersion,
 )
-from tagmate.models.enums import ActivityStatusEnum, ActivityTaskEnum
-from tagmate.models.py.user import User
-from tagmate.storage.minio import MinioObjectStore
-from tagmate.utils.constants import (
-    UPLOADS_BUCKET,
-    DATASET_INDEX_COLUMN_NAME,
-    DATASET_TEXT_COLUMN_NAME,
+from tagmate.models.enums import (
+    ActivityStatusEnum,
+    ActivityTaskEnum,
+    ExportCompressionEnum,
+    ExportFormatEnum,
+    JobPriorityEnum,
+    UploadFormatEnum,
 )
+from tagmate.models.py.user import TokenClaims, User
+from tagmate.storage.job_logs import load_job_logs
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import UPLOADS_BUCKET
 from tagmate.utils.auth import authenticate_with_token
-from tagmate.utils.functions import bytes_to_df
+from tagmate.utils.database import primary
+from tagmate.utils.export import (
+    ENCODERS,
+    EXPORT_COLUMNS,
+    MEDIA_TYPES,
+    STREAM_COMPRESSIONS,
+    iter_document_batches,
+)
+from tagmate.utils.ingest import (
+    detect_upload_format,
+    first_upload_batch,
+    insert_upload_documents,
+    iter_upload_documents,
+    upload_errors,
+)
+from tagmate.utils.metrics import UPLOAD_BYTES
+from tagmate.utils.progress import listen_progress
+from tagmate.utils.purge import abort_activity_jobs, enqueue_purge
+from tagmate.utils.response_cache import bump_activity_version, cached_activity_response, serialize
+from tagmate.utils.serialisation import load_documents_json
+from tagmate.utils.queue import enqueue_unique_job, get_fanout_jobs, get_job, get_redis_pool, request_job_abort
 from tagmate.utils.validations import (
     validate_activity_exists,
+    validate_token_user,
     validate_user_exists,
     validate_activity_user,
 )
@@ -50,19 +79,40 @@ from tagmate.logging.app import logger
 
 router = APIRouter(prefix="/activity", tags=["activity"])
 
+JOB_ABORT_TIMEOUT = 10  # seconds
+MAX_PAGE_SIZE = 500
+
+
+def job_metadata(user: User, profile: bool) -> dict:
+    # profiles expose code paths and memory contents, only admins may request them
+    return {"profile": profile and user.is_admin}
+
+
+async def get_job_row(activity_id: str, job_id: str) -> JobTable | None:
+    """row of a run of the activity, None for shard and reduce jobs, which have no row"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return None
+    return await JobTable.get_or_none(id=job_id, activity_id=activity_id, using_db=primary())
+
 
 @router.post("/create", response_model=ActivityStatus)
 async def create_activity(
     name: str = Form(..., description="name of the activity"),
     task: str = Form(..., description="task of the activity"),
     tags: str = Form(..., description="tags of the activity"),
-    data: UploadFile = File(..., description="data for the activity"),
-    email: str = Depends(authenticate_with_token),
+    data: UploadFile = File(..., description="data for the activity, csv, jsonl, parquet or excel, optionally gzip or zstd compressed"),
+    format: UploadFormatEnum | None = Form(None, description="format of the data, told from the file extension by default"),
+    text_column: str | None = Form(None, description="column of the document text, text or review by default"),
+    id_column: str | None = Form(None, description="column of integer document ids, the row number by default"),
+    profile: bool = False,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
 
     user_id = str(user.id)
     activity_id = str(uuid.uuid4())
@@ -72,23 +122,37 @@ async def create_activity(
     file_name = data.filename
     storage_path = joinpath(user_id, activity_id, file_name)
 
-    try:
-        client = MinioObjectStore()
+    async with upload_errors():
+        upload_format = detect_upload_format(file_name, format)
+
+    client = MinioObjectStore()
 
+    def upload_file():
         if not client.bucket_exists(UPLOADS_BUCKET):
             client.create_bucket(UPLOADS_BUCKET)
 
-        bytes_data = await data.read()
+        # the upload is spooled to disk by starlette, it is streamed rather than read into memory
+        length = data.file.seek(0, SEEK_END)
+        data.file.seek(0)
+        UPLOAD_BYTES.observe(length)
 
-        client.upload_object_from_bytes(
+        client.upload_object_from_stream(
             bucket_name=UPLOADS_BUCKET,
             object_name=storage_path,
-            data=bytes_data,
-            length=len(bytes_data),
+            data=data.file,
+            length=length,
         )
+
+    try:
+        await asyncio.to_thread(upload_file)
     except Exception as exc:
         raise ActivityExceptions.FileUploadError(exception=exc)
 
+    documents = iter_upload_documents(data.file, upload_format, text_column, id_column)
+    # the first batch checks the format and columns before the activity exists
+    async with upload_errors(cleanup=lambda: asyncio.to_thread(client.remove_objects, UPLOADS_BUCKET, storage_path)):
+        batch = await first_upload_batch(documents)
+
     await ActivityTable.create(
         id=activity_id,
         name=name,
@@ -105,144 +169,224 @@ async def create_activity(
         is_owner=True,
     )
 
-    df = bytes_to_df(bytes_data)
-    df = df.rename(columns={"review": DATASET_TEXT_COLUMN_NAME})
-
-    documents = df[[DATASET_INDEX_COLUMN_NAME, DATASET_TEXT_COLUMN_NAME]].to_dict(
-        orient="records"
-    )
-
-    await DocumentTable.bulk_create(
-        [
-            DocumentTable(
-                index=doc[DATASET_INDEX_COLUMN_NAME],
-                text=doc[DATASET_TEXT_COLUMN_NAME],
-                activity_id=activity_id,
-            )
-            for doc in documents
-        ]
-    )
-
     try:
-        arq_redis = await create_pool(
-            RedisSettings(host=env("REDIS_HOST", "redis"), port=env("REDIS_PORT", 6379))
-        )
+        arq_redis = await get_redis_pool()
     except redis.exceptions.ConnectionError as e:
         raise ActivityExceptions.RedisConnectionError
 
-    job = await arq_redis.enqueue_job(
+    async def discard_activity():
+        # a malformed row past the first batch, the documents inserted so far are purged
+        await ActivityTable.filter(id=activity_id).update(status=ActivityStatusEnum.DELETED)
+        await enqueue_purge(arq_redis, activity_id)
+
+    async with upload_errors(cleanup=discard_activity):
+        await insert_upload_documents(activity_id, batch, documents)
+
+    job_id, job = await enqueue_unique_job(
+        arq_redis,
         ActivityTaskEnum.CLUSTERING,
         activity_id,
+        metadata=job_metadata(user, profile),
     )
+    if job is not None:
+        # the worker records the status of the clustering job in this row
+        await JobTable.create(id=job_id, activity_id=activity_id, status=await job.status())
 
     logger.info(job)
 
     return ActivityStatus(id=activity_id, status=ActivityStatusEnum.CREATED)
 
 
-@router.get("/list", response_model=list[Activity])
-async def fetch_all_activities(email: str = Depends(authenticate_with_token)):
-    if not email:
+@router.get("/list", response_model=list[ActivitySummary])
+async def fetch_all_activities(
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    status: ActivityStatusEnum | None = None,
+    task: ActivityTaskEnum | None = None,
+    ascending: bool = Query(False, description="oldest update first"),
+    counts: bool = Query(False, description="include document counts"),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
 
     user_id = user.id
 
-    try:
-        my_activities = await ActivityTable.filter(user_id=user_id)
-        shared_activity_ids = await ActivityUserTable.filter(
-            user_id=user_id, is_owner=False
-        ).values("activity_id")
-        shared_activity_ids = [a.get("activity_id") for a in shared_activity_ids]
-        shared_activities = await ActivityTable.filter(id__in=shared_activity_ids)
-
-        activities = my_activities + shared_activities
-    except TortoiseExceptions.DoesNotExist:
-        activities = []
+    # owned and shared activities in one query, the owner has a map row as well
+    query = ActivityUserTable.filter(user_id=user_id).exclude(
+        activity__status=ActivityStatusEnum.DELETED
+    ).select_related("activity")
+    if status is not None:
+        query = query.filter(activity__status=status)
+    if task is not None:
+        query = query.filter(activity__task=task)
+    # the id breaks ties, so that pages do not overlap
+    order = "activity__updated_at" if ascending else "-activity__updated_at"
+    rows = await query.order_by(order, "activity_id").offset(offset).limit(limit)
+
+    activities = []
+    for row in rows:
+        row.activity.is_owner = row.is_owner
+        activities.append(row.activity)
+
+    if counts and activities:
+        document_counts = {
+            row["activity_id"]: row
+            for row in await DocumentTable.filter(activity_id__in=[a.id for a in activities])
+            .group_by("activity_id")
+            .annotate(
+                document_count=Count("id"),
+                auto_labelled_count=Count("id", _filter=Q(is_auto_generated=True)),
+                validated_count=Count("id", _filter=Q(is_user_validated=True)),
+            )
+            .values("activity_id", "document_count", "auto_labelled_count", "validated_count")
+        }
+        for activity in activities:
+            row = document_counts.get(activity.id, {})
+            activity.document_count = row.get("document_count", 0)
+            activity.auto_labelled_count = row.get("auto_labelled_count", 0)
+            activity.validated_count = row.get("validated_count", 0)
 
     return activities
 
 
 @router.get("/{activity_id}", response_model=Activity)
 async def fetch_one_activity(
-    activity_id: str, email: str = Depends(authenticate_with_token)
+    activity_id: str,
+    request: Request,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     await validate_activity_exists(activity_id)
     await validate_activity_user(user_id, activity_id)
 
-    try:
-        activity = await ActivityTable.get(id=activity_id)
-        logger.info(activity)
-    except TortoiseExceptions.DoesNotExist:
-        activity = []
+    async def load(using_db: BaseDBAsyncClient | None) -> bytes:
+        # the replica, unless the version was bumped too recently for it to have the writes
+        try:
+            activity = await ActivityTable.get(id=activity_id, using_db=using_db)
+        except TortoiseExceptions.DoesNotExist:
+            raise ActivityExceptions.ActivityDoesNotExist()
+        return serialize(Activity, activity)
 
-    return activity
+    return await cached_activity_response(request, activity_id, "activity", load)
 
 
 @router.get("/{activity_id}/load", response_model=list[Document])
 async def fetch_activity_data(
-    activity_id: str, email: str = Depends(authenticate_with_token)
+    activity_id: str,
+    request: Request,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     await validate_activity_exists(activity_id)
     await validate_activity_user(user_id, activity_id)
 
-    try:
-        documents = await DocumentTable.filter(activity_id=activity_id)
-    except TortoiseExceptions.DoesNotExist:
-        documents = []
+    async def load(using_db: BaseDBAsyncClient | None) -> bytes:
+        # tuples encoded by orjson, validating every document through pydantic is too slow for large activities
+        return await load_documents_json(activity_id, using_db=using_db)
+
+    return await cached_activity_response(request, activity_id, "documents", load)
+
+
+@router.get("/{activity_id}/export")
+async def export_activity_data(
+    activity_id: str,
+    format: ExportFormatEnum = ExportFormatEnum.parquet,
+    compression: ExportCompressionEnum = ExportCompressionEnum.none,
+    columns: str | None = Query(None, description="comma separated columns, all columns by default"),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id)
 
-    return documents
+    selected = [column.strip() for column in columns.split(",") if column.strip()] if columns else EXPORT_COLUMNS
+    unknown = [column for column in selected if column not in EXPORT_COLUMNS]
+    if unknown or not selected:
+        raise ActivityExceptions.InvalidExportOptions(
+            detail=f"columns must be among {', '.join(EXPORT_COLUMNS)}"
+        )
+    if format != ExportFormatEnum.parquet and compression not in STREAM_COMPRESSIONS:
+        raise ActivityExceptions.InvalidExportOptions(
+            detail=f"{format.value} exports support none or gzip compression"
+        )
+
+    encoder = ENCODERS[format](selected, compression)
+
+    async def export_stream():
+        async for batch in iter_document_batches(activity_id, selected):
+            # encoding and compression are cpu bound, they run off the event loop
+            chunk = await asyncio.to_thread(encoder.encode, batch)
+            if chunk:
+                yield chunk
+        yield await asyncio.to_thread(encoder.close)
+
+    file_name = f"{activity_id}.{format.value}"
+    media_type = MEDIA_TYPES[format]
+    if format != ExportFormatEnum.parquet and compression == ExportCompressionEnum.gzip:
+        file_name, media_type = f"{file_name}.gz", "application/gzip"
+
+    return StreamingResponse(
+        export_stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
 
 
 @router.get("/{activity_id}/users", response_model=list[User])
 async def fetch_activity_users(
-    activity_id: str, email: str = Depends(authenticate_with_token)
+    activity_id: str,
+    request: Request,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     await validate_activity_exists(activity_id)
     await validate_activity_user(user_id, activity_id)
 
-    try:
-        user_ids = await ActivityUserTable.filter(activity_id=activity_id).values(
+    async def load(using_db: BaseDBAsyncClient | None) -> bytes:
+        user_ids = await ActivityUserTable.filter(activity_id=activity_id).using_db(using_db).values(
             "user_id"
         )
         user_ids = [u.get("user_id") for u in user_ids]
-        users = await UserTable.filter(id__in=user_ids)
-    except TortoiseExceptions.DoesNotExist:
-        users = []
+        users = await UserTable.filter(id__in=user_ids).using_db(using_db)
+        # TODO: Remove password hash from the response
+        return serialize(list[User], users)
 
-    # TODO: Remove password hash from the response
-    return users
+    return await cached_activity_response(request, activity_id, "users", load)
 
 
 @router.post("/{activity_id}/save", response_model=ActivityStatus)
 async def fetch_activity_data(
     activity_id: str,
     documents: list[Document],
-    email: str = Depends(authenticate_with_token),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     await validate_activity_exists(activity_id)
@@ -261,6 +405,8 @@ async def fetch_activity_data(
     except Exception as exc:
         raise ActivityExceptions.ActivitySaveError(exception=exc)
 
+    await bump_activity_version(activity_id)
+
     return ActivityStatus(id=activity_id, status=ActivityStatusEnum.SAVED)
 
 
@@ -268,12 +414,12 @@ async def fetch_activity_data(
 async def fetch_activity_data(
     activity_id: str,
     share_email: str,
-    email: str = Depends(authenticate_with_token),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     await validate_activity_exists(activity_id)
@@ -283,7 +429,7 @@ async def fetch_activity_data(
     share_user_id = share_user.id
 
     try:
-        await validate_activity_user(share_user_id, activity_id)
+        await validate_activity_user(share_user_id, activity_id, using_db=primary())
         # raise error if activity is already shared with user
         raise ActivityExceptions.ActivityAlreadyExists()
     except ActivityExceptions.ActivityAlreadyExists:
@@ -305,65 +451,71 @@ async def fetch_activity_data(
     except Exception as exc:
         raise ActivityExceptions.ActivitySaveError(exception=exc)
 
+    await bump_activity_version(activity_id)
+
     return ActivityStatus(id=activity_id, status=ActivityStatusEnum.SHARED)
 
 
 @router.post("/{activity_id}/train", response_model=JobStatus)
 async def train_activity_model(
     activity_id: str,
-    email: str = Depends(authenticate_with_token),
+    priority: JobPriorityEnum = JobPriorityEnum.interactive,
+    profile: bool = False,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
-    await validate_activity_exists(activity_id)
+    activity = await validate_activity_exists(activity_id)
     await validate_activity_user(user_id, activity_id)
 
     try:
-        arq_redis = await create_pool(
-            RedisSettings(host=env("REDIS_HOST", "redis"), port=env("REDIS_PORT", 6379))
-        )
+        arq_redis = await get_redis_pool()
     except redis.exceptions.ConnectionError as e:
         raise ActivityExceptions.RedisConnectionError
 
-    jobs = await JobTable.filter(activity_id=activity_id, status__in=[JobStatusEnum.queued, JobStatusEnum.in_progress, JobStatusEnum.deferred])
-    if len(jobs):
-        raise ActivityExceptions.JobAlreadyInProgress
+    task = ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION
+    if activity.task == ActivityTaskEnum.ENTITY_CLASSIFICATION:
+        task = ActivityTaskEnum.ENTITY_CLASSIFICATION
 
-    _job_id = str(uuid.uuid4())
-    job = await arq_redis.enqueue_job(
-        ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION,
-        activity_id=activity_id,
-        _job_id=_job_id,
+    job_id, job = await enqueue_unique_job(
+        arq_redis,
+        task,
+        activity_id,
+        priority=priority,
+        metadata=job_metadata(user, profile),
     )
+    # the task is locked per activity, so a duplicate request coalesces
+    # into the run which is already queued or running
+    if job is None:
+        raise ActivityExceptions.JobAlreadyInProgress
 
+    # every run has its own row, earlier runs keep theirs
     job_status = await job.status()
-    await JobTable.create(
-        id=_job_id,
-        activity_id=activity_id,
-        status=job_status,
-    )
+    await JobTable.create(id=job_id, activity_id=activity_id, status=job_status)
 
-    return JobStatus(id=_job_id, status=job_status)
+    return JobStatus(id=job_id, status=job_status)
 
 
 @router.get("/{activity_id}/job/active", response_model=JobStatus)
 async def get_active_job(
     activity_id: str,
-    email: str = Depends(authenticate_with_token),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
-    try:
-        active_job = await JobTable.get(activity_id=activity_id, status__in=[JobStatusEnum.queued, JobStatusEnum.in_progress])
-    except TortoiseExceptions.DoesNotExist as e:
+    # the latest run, clustering and training may run at the same time
+    active_job = await JobTable.filter(
+        activity_id=activity_id, status__in=[JobStatusEnum.queued, JobStatusEnum.in_progress]
+    ).using_db(primary()).order_by("-created_at").first()
+    if active_job is None:
         raise ActivityExceptions.ActivityDoesNotExist
 
     return JobStatus(id=active_job.id, status=active_job.status)
@@ -373,53 +525,252 @@ async def get_active_job(
 async def get_job_status(
     activity_id: str,
     job_id: str,
-    email: str = Depends(authenticate_with_token),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     try:
-        arq_redis = await create_pool(
-            RedisSettings(host=env("REDIS_HOST", "redis"), port=env("REDIS_PORT", 6379))
-        )
+        arq_redis = await get_redis_pool()
     except redis.exceptions.ConnectionError as e:
         raise ActivityExceptions.RedisConnectionError
 
-    job = Job(job_id=job_id, redis=arq_redis)
-    job_status = await job.status()
+    job = await get_job(arq_redis, activity_id, job_id)
+    job_status = await job.status() if job is not None else JobStatusEnum.not_found
 
     match job_status:
         case JobStatusEnum.not_found:
-            return JobStatus(id=job_id, status=job_status)
+            # runs whose arq result expired keep the status the worker recorded in their row
+            job_row = await get_job_row(activity_id, job_id)
+            return JobStatus(id=job_id, status=job_row.status if job_row is not None else job_status)
         case JobStatusEnum.complete:
             job_result = await job.result_info()
             if job_result.success:
+                # a job which fanned out finishes when its last shard or its reduce job does
+                job_row = await get_job_row(activity_id, job_id)
+                if job_row is not None and job_row.status in (
+                    JobStatusEnum.in_progress,
+                    JobStatusEnum.failed,
+                    JobStatusEnum.aborted,
+                ):
+                    return JobStatus(id=job_id, status=job_row.status)
                 return JobStatus(id=job_id, status=JobStatusEnum.success)
+            if isinstance(job_result.result, asyncio.CancelledError):
+                return JobStatus(id=job_id, status=JobStatusEnum.aborted)
             return JobStatus(id=job_id, status=JobStatusEnum.failed)
 
     return JobStatus(id=job_id, status=job_status)
 
 
+@router.get("/{activity_id}/job/{job_id}/progress")
+async def stream_job_progress(
+    activity_id: str,
+    job_id: str,
+    request: Request,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id)
+
+    try:
+        arq_redis = await get_redis_pool()
+    except redis.exceptions.ConnectionError as e:
+        raise ActivityExceptions.RedisConnectionError
+
+    # progress channels are keyed by job id alone, members may only follow the jobs of their activity
+    if await get_job(arq_redis, activity_id, job_id) is None and await get_job_row(activity_id, job_id) is None:
+        raise ActivityExceptions.JobDoesNotExist
+
+    async def event_stream():
+        async for event in listen_progress(arq_redis, job_id):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: progress\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{activity_id}/job/{job_id}/logs")
+async def fetch_job_logs(
+    activity_id: str,
+    job_id: str,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id)
+
+    # json lines of the job, including its retries and shards
+    data = await asyncio.to_thread(load_job_logs, activity_id, job_id)
+    if data is None:
+        raise ActivityExceptions.JobLogsDoNotExist
+
+    return Response(content=data, media_type="application/x-ndjson")
+
+
+@router.delete("/{activity_id}/job/{job_id}", response_model=JobStatus)
+async def abort_job(
+    activity_id: str,
+    job_id: str,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id)
+
+    try:
+        arq_redis = await get_redis_pool()
+    except redis.exceptions.ConnectionError as e:
+        raise ActivityExceptions.RedisConnectionError
+
+    # a job which fanned out has finished itself while its shards and reduce job run
+    jobs = [
+        job
+        for job in [await get_job(arq_redis, activity_id, job_id), *await get_fanout_jobs(arq_redis, job_id)]
+        if job is not None and await job.status() not in (JobStatusEnum.complete, JobStatusEnum.not_found)
+    ]
+    if not jobs:
+        raise ActivityExceptions.JobAbortError()
+
+    try:
+        is_aborted = all(
+            await asyncio.gather(*(request_job_abort(arq_redis, job, timeout=JOB_ABORT_TIMEOUT) for job in jobs))
+        )
+    except asyncio.TimeoutError:
+        # the worker is still unwinding the job and marks it aborted once it stops
+        job_status = JobStatusEnum.aborting
+    except Exception as exc:
+        # the job failed on its own before the abort reached it
+        raise ActivityExceptions.JobAbortError(exception=exc)
+    else:
+        if not is_aborted:
+            raise ActivityExceptions.JobAbortError()
+        job_status = JobStatusEnum.aborted
+
+    await JobTable.filter(id=job_id).exclude(status=JobStatusEnum.aborted).update(
+        status=job_status
+    )
+
+    return JobStatus(id=job_id, status=job_status)
+
+
+@router.get("/{activity_id}/models", response_model=list[ModelVersion])
+async def fetch_model_versions(
+    activity_id: str,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id)
+
+    model_versions = await ModelVersionTable.filter(
+        classifier__activity_id=activity_id
+    ).prefetch_related("classifier").order_by("-created_at")
+
+    return [
+        ModelVersion(
+            id=model_version.id,
+            name=model_version.classifier.name,
+            version=model_version.version,
+            digest=model_version.digest,
+            size=model_version.size,
+            metrics=model_version.metrics,
+            training_time=model_version.training_time,
+            is_active=model_version.classifier.active_version_id == model_version.id,
+            created_at=model_version.created_at,
+        )
+        for model_version in model_versions
+    ]
+
+
+@router.post("/{activity_id}/models/{version_id}/activate", response_model=ActivityId)
+async def activate_model_version(
+    activity_id: str,
+    version_id: str,
+    claims: TokenClaims | None = Depends(authenticate_with_token),
+):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+
+    user = await validate_token_user(claims)
+    user_id = user.id
+
+    await validate_activity_exists(activity_id)
+    await validate_activity_user(user_id, activity_id, using_db=primary())
+
+    if not await ModelVersionTable.exists(
+        id=version_id, classifier__activity_id=activity_id
+    ):
+        raise ActivityExceptions.ModelVersionDoesNotExist()
+
+    # later jobs warm start and predict from this version, running jobs keep theirs
+    await promote_model_version(version_id)
+
+    return ActivityId(id=activity_id)
+
+
 @router.delete("/{activity_id}", response_model=ActivityStatus)
 async def fetch_activity_data(
     activity_id: str,
-    email: str = Depends(authenticate_with_token),
+    claims: TokenClaims | None = Depends(authenticate_with_token),
 ):
-    if not email:
+    if not claims:
         raise AuthExceptions.InvalidToken()
 
-    user = await validate_user_exists(email)
+    user = await validate_token_user(claims)
     user_id = user.id
 
     activity = await validate_activity_exists(activity_id)
-    # await validate_activity_user(user_id, activity_id)
+    activity_user = await validate_activity_user(user_id, activity_id)
+    if not activity_user.is_owner:
+        raise ActivityExceptions.NotActivityOwner
 
     try:
-        await ActivityTable.delete(activity)
+        arq_redis = await get_redis_pool()
+    except redis.exceptions.ConnectionError as e:
+        raise ActivityExceptions.RedisConnectionError
+
+    # the activity disappears from the api at once, its rows and objects are purged by a worker
+    try:
+        activity.status = ActivityStatusEnum.DELETED
+        await activity.save(update_fields=["status", "updated_at"])
     except Exception as exc:
         raise ActivityExceptions.ActivityDeleteError(exception=exc)
 
+    await bump_activity_version(activity_id, arq_redis)
+    await abort_activity_jobs(arq_redis, activity_id)
+    job = await enqueue_purge(arq_redis, activity_id)
+    logger.info(job)
+
     return ActivityStatus(id=activity_id, status=ActivityStatusEnum.DELETED)
@@ -0,0 +1,76 @@
+import asyncio
+import json
+from os.path import join as joinpath
+
+from fastapi import APIRouter, Depends, Response
+
+from tagmate.exceptions import admin as AdminExceptions
+from tagmate.exceptions import auth as AuthExceptions
+from tagmate.models.py.user import TokenClaims
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.auth import authenticate_with_token
+from tagmate.utils.constants import PROFILES_BUCKET
+from tagmate.utils.profiling import PROFILE_FILES, PROFILE_KINDS, SUMMARY_FILE
+from tagmate.utils.validations import validate_user_is_admin
+
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+async def require_admin(claims: TokenClaims | None = Depends(authenticate_with_token)):
+    if not claims:
+        raise AuthExceptions.InvalidToken()
+    return await validate_user_is_admin(claims)
+
+
+def validate_profile_kind(kind: str) -> str:
+    if kind not in PROFILE_KINDS:
+        raise AdminExceptions.ProfileDoesNotExist(detail=f"profile kind must be one of {', '.join(PROFILE_KINDS)}")
+    return kind
+
+
+def download_profile_file(kind: str, profile_id: str, file_name: str) -> bytes:
+    client = MinioObjectStore()
+    object_name = joinpath(kind, profile_id, file_name)
+    if not client.bucket_exists(PROFILES_BUCKET) or not client.object_exists(PROFILES_BUCKET, object_name):
+        raise AdminExceptions.ProfileDoesNotExist()
+    return client.download_object_as_bytes(bucket_name=PROFILES_BUCKET, object_name=object_name)
+
+
+@router.get("/profiles/{kind}", response_model=list[str])
+async def list_profiles(kind: str, user=Depends(require_admin)):
+    kind = validate_profile_kind(kind)
+
+    def list_profile_ids() -> list[str]:
+        client = MinioObjectStore()
+        if not client.bucket_exists(PROFILES_BUCKET):
+            return []
+        objects = client.list_objects(bucket_name=PROFILES_BUCKET, prefix=f"{kind}/")
+        return [obj.object_name.removeprefix(f"{kind}/").strip("/") for obj in objects if obj.is_dir]
+
+    return await asyncio.to_thread(list_profile_ids)
+
+
+@router.get("/profiles/{kind}/{profile_id}")
+async def fetch_profile_summary(kind: str, profile_id: str, user=Depends(require_admin)):
+    kind = validate_profile_kind(kind)
+    data = await asyncio.to_thread(download_profile_file, kind, profile_id, SUMMARY_FILE)
+    return json.loads(data)
+
+
+@router.get("/profiles/{kind}/{profile_id}/{file_name}")
+async def fetch_profile_file(kind: str, profile_id: str, file_name: str, user=Depends(require_admin)):
+    kind = validate_profile_kind(kind)
+    if file_name not in PROFILE_FILES:
+        raise AdminExceptions.ProfileDoesNotExist(detail=f"profile file must be one of {', '.join(PROFILE_FILES)}")
+
+    data = await asyncio.to_thread(download_profile_file, kind, profile_id, file_name)
+    if file_name.endswith(".txt"):
+        return Response(content=data, media_type="text/plain; charset=utf-8")
+    if file_name.endswith(".json"):
+        return Response(content=data, media_type="application/json")
+    return Response(
+        content=data,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'},
+    )
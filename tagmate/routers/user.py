@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, Query, Form
+from fastapi import APIRouter, Depends, Query, Form, Request
 from fastapi.security import OAuth2PasswordRequestForm
 import uuid
 
@@ -6,6 +6,7 @@ from tagmate.models.py.user import User, UserId, UserToken
 from tagmate.models.db.user import User as UserTable
 from tagmate.utils import auth as U
 from tagmate.exceptions import auth as E
+from tagmate.utils.database import primary
 
 
 router = APIRouter(prefix="", tags=["auth"])
@@ -19,14 +20,14 @@ async def create_user(
     is_admin: bool = Form(default=False, description="Is the user an admin"),
 ):
     try:
-        user = await UserTable.get(email=email).values()
+        user = await UserTable.get(email=email, using_db=primary()).values()
     except:
         user = None
 
     if user:
         raise E.UserAlreadyExists()
 
-    hashed_password = U.get_password_hash(password)
+    hashed_password = await U.get_password_hash(password)
     user_id = uuid.uuid4()
 
     await UserTable.create(
@@ -41,21 +42,43 @@ async def create_user(
 
 
 @router.post("/login", response_model=UserToken)
-async def login_with_password(data: OAuth2PasswordRequestForm = Depends()):
+async def login_with_password(request: Request, data: OAuth2PasswordRequestForm = Depends()):
     email, password = data.username, data.password
 
+    # checked before the user lookup, so a rate limited client costs no bcrypt round
+    client = request.client.host if request.client else "unknown"
+    if await U.is_login_rate_limited(client, email):
+        raise E.TooManyLoginAttempts()
+
     try:
-        user = await UserTable.get(email=email).values()
+        user = await UserTable.get(email=email, using_db=primary()).values()
     except:
         user = None
 
     if not user:
         raise E.InvalidUsername()
 
-    is_authenticated = U.authenticate_with_password(user["password"], password)
+    is_authenticated, new_hash = await U.authenticate_with_password(user["password"], password)
     if not is_authenticated:
         raise E.InvalidPassword()
 
-    access_token = U.generate_access_token(data={"sub": email})
+    if new_hash is not None:
+        # stored with another work factor than BCRYPT_ROUNDS
+        await UserTable.filter(id=user["id"]).using_db(primary()).update(password=new_hash)
+
+    # the user id lets authenticated requests read the user by primary key
+    access_token = U.generate_access_token(data={"sub": email, "uid": str(user["id"])})
 
     return UserToken(username=email, email=email, access_token=access_token)
+
+
+@router.post("/logout")
+async def logout(token: str = Depends(U.oauth2_scheme)):
+    claims = await U.authenticate_with_token(token)
+    if not claims:
+        raise E.InvalidToken()
+
+    # without TOKEN_REVOCATION the token stays valid until it expires
+    is_revoked = await U.revoke_token(token, claims)
+
+    return {"revoked": is_revoked}
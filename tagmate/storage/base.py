@@ -27,6 +27,10 @@ class BaseObjectStore(ABC):
     def upload_object_from_bytes(self, bucket_name: str, object_name: str, data: Any):
         raise NotImplementedError
 
+    @abstractmethod
+    def upload_object_from_stream(self, bucket_name: str, object_name: str, data: Any, length: int):
+        raise NotImplementedError
+
     @abstractmethod
     def download_object_as_file(self, bucket_name: str, object_name: str, file_path: str):
         raise NotImplementedError
@@ -34,3 +38,11 @@ class BaseObjectStore(ABC):
     @abstractmethod
     def download_object_as_bytes(self, bucket_name: str, object_name: str):
         raise NotImplementedError
+
+    @abstractmethod
+    def object_exists(self, bucket_name: str, object_name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_objects(self, bucket_name: str, prefix: str):
+        raise NotImplementedError
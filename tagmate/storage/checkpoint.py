@@ -0,0 +1,79 @@
+import json
+from io import BytesIO
+from os.path import join as joinpath
+from typing import Any
+
+import numpy as np
+
+from tagmate.storage.base import BaseObjectStore
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import CHECKPOINTS_BUCKET
+
+
+class JobCheckpoint:
+    """intermediate job state persisted to the object store at stage boundaries
+
+    Checkpoints live under `{activity_id}/{job_id}/` so that a retried job,
+    which keeps its job id, finds the state left behind by the failed attempt.
+    """
+
+    def __init__(
+        self,
+        activity_id: str,
+        job_id: str,
+        store: BaseObjectStore | None = None,
+        bucket_name: str = CHECKPOINTS_BUCKET,
+    ):
+        self.prefix = joinpath(str(activity_id), str(job_id))
+        self.store = store or MinioObjectStore()
+        self.bucket_name = bucket_name
+        self._bucket_ready = False
+
+    def object_name(self, key: str) -> str:
+        return joinpath(self.prefix, key)
+
+    def ensure_bucket(self) -> None:
+        if self._bucket_ready:
+            return
+        if not self.store.bucket_exists(self.bucket_name):
+            self.store.create_bucket(self.bucket_name)
+        self._bucket_ready = True
+
+    def exists(self, key: str) -> bool:
+        return self.store.object_exists(self.bucket_name, self.object_name(key))
+
+    def save_bytes(self, key: str, data: bytes) -> None:
+        self.ensure_bucket()
+        self.store.upload_object_from_bytes(
+            bucket_name=self.bucket_name,
+            object_name=self.object_name(key),
+            data=data,
+            length=len(data),
+        )
+
+    def load_bytes(self, key: str) -> bytes | None:
+        if not self.exists(key):
+            return None
+        return self.store.download_object_as_bytes(
+            bucket_name=self.bucket_name, object_name=self.object_name(key)
+        )
+
+    def save_json(self, key: str, obj: Any) -> None:
+        self.save_bytes(key, json.dumps(obj).encode("utf-8"))
+
+    def load_json(self, key: str) -> Any | None:
+        data = self.load_bytes(key)
+        return None if data is None else json.loads(data)
+
+    def save_array(self, key: str, array: np.ndarray) -> None:
+        buffer = BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        self.save_bytes(key, buffer.getvalue())
+
+    def load_array(self, key: str) -> np.ndarray | None:
+        data = self.load_bytes(key)
+        return None if data is None else np.load(BytesIO(data), allow_pickle=False)
+
+    def clear(self) -> None:
+        if self.store.bucket_exists(self.bucket_name):
+            self.store.remove_objects(self.bucket_name, prefix=self.prefix + "/")
@@ -0,0 +1,50 @@
+from os.path import join as joinpath
+
+from tagmate.storage.base import BaseObjectStore
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import LOGS_BUCKET
+
+
+def job_logs_prefix(activity_id: str, job_id: str) -> str:
+    return joinpath(str(activity_id), str(job_id), "")
+
+
+def store_job_logs(
+    activity_id: str,
+    job_id: str,
+    attempt_id: str,
+    data: bytes,
+    store: BaseObjectStore | None = None,
+) -> None:
+    """uploads the log lines of one attempt of a job
+
+    Attempts are stored under the job they belong to, so that the logs of
+    retries, prediction shards and clustering shards are read together with
+    the logs of the job which enqueued them.
+    """
+    if not data:
+        return
+    store = store or MinioObjectStore()
+    if not store.bucket_exists(LOGS_BUCKET):
+        store.create_bucket(LOGS_BUCKET)
+    store.upload_object_from_bytes(
+        bucket_name=LOGS_BUCKET,
+        object_name=joinpath(job_logs_prefix(activity_id, job_id), f"{attempt_id}.jsonl"),
+        data=data,
+        length=len(data),
+    )
+
+
+def load_job_logs(activity_id: str, job_id: str, store: BaseObjectStore | None = None) -> bytes | None:
+    """log lines of every attempt of a job ordered by time, None when nothing was stored"""
+    store = store or MinioObjectStore()
+    if not store.bucket_exists(LOGS_BUCKET):
+        return None
+    objects = list(store.list_objects(LOGS_BUCKET, prefix=job_logs_prefix(activity_id, job_id), recursive=True))
+    if not objects:
+        return None
+    objects.sort(key=lambda obj: obj.last_modified)
+    return b"".join(
+        store.download_object_as_bytes(bucket_name=LOGS_BUCKET, object_name=obj.object_name)
+        for obj in objects
+    )
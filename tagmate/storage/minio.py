@@ -1,15 +1,18 @@
+from __future__ import annotations
+
 from os import getenv as env, listdir
 from os.path import isdir, isfile, join as joinpath
-from typing import Any
+from typing import TYPE_CHECKING, Any, BinaryIO
 from io import BytesIO
 import logging
 
 logger = logging.getLogger("arq.worker")
 
-from minio import Minio
-from minio.datatypes import Bucket, Object
+if TYPE_CHECKING:
+    from minio.datatypes import Bucket, Object
 
 from tagmate.storage.base import BaseObjectStore
+from tagmate.utils.metrics import OBJECT_STORE_CALL_DURATION, instrument_methods
 
 
 MINIO_HOST = env("MINIO_HOST", "minio")
@@ -18,6 +21,20 @@ MINIO_ROOT_USER = env("MINIO_ROOT_USER", "minioadmin")
 MINIO_ROOT_PASSWORD = env("MINIO_ROOT_PASSWORD", "minioadmin")
 
 
+@instrument_methods(
+    OBJECT_STORE_CALL_DURATION,
+    methods=[
+        "create_bucket",
+        "bucket_exists",
+        "upload_object_from_file",
+        "upload_object_from_bytes",
+        "upload_object_from_stream",
+        "download_object_as_bytes",
+        "download_object_as_file",
+        "object_exists",
+        "remove_objects",
+    ],
+)
 class MinioObjectStore(BaseObjectStore):
     def __init__(
         self,
@@ -33,6 +50,9 @@ class MinioObjectStore(BaseObjectStore):
         self.secure = False
         self.endpoint = f"{self.host}:{self.port}"
 
+        # imported with the first client, the sdk and its crypto dependencies are slow to import
+        from minio import Minio
+
         self.client = Minio(
             endpoint=self.endpoint,
             access_key=self.username,
@@ -49,8 +69,12 @@ class MinioObjectStore(BaseObjectStore):
     def bucket_exists(self, bucket_name: str) -> bool:
         return self.client.bucket_exists(bucket_name=bucket_name)
 
-    def list_objects(self, bucket_name: str) -> list[Object]:
-        return self.client.list_objects(bucket_name=bucket_name)
+    def list_objects(
+        self, bucket_name: str, prefix: str | None = None, recursive: bool = False
+    ) -> list[Object]:
+        return self.client.list_objects(
+            bucket_name=bucket_name, prefix=prefix, recursive=recursive
+        )
 
     def upload_object_from_file(
         self, bucket_name: str, object_name: str, file_path: str
@@ -73,6 +97,17 @@ class MinioObjectStore(BaseObjectStore):
             content_type="application/octet-stream",
         )
 
+    def upload_object_from_stream(
+        self, bucket_name: str, object_name: str, data: BinaryIO, length: int
+    ) -> None:
+        self.client.put_object(
+            bucket_name=bucket_name,
+            object_name=object_name,
+            data=data,
+            length=length,
+            content_type="application/octet-stream",
+        )
+
     def upload_objects_from_folder(
         self, bucket_name: str, objects_path: str, folder_path: str
     ):
@@ -129,3 +164,28 @@ class MinioObjectStore(BaseObjectStore):
                     object_name=obj.object_name,
                     file_path=file_path,
                 )
+
+    def object_exists(self, bucket_name: str, object_name: str) -> bool:
+        from minio.error import S3Error
+
+        try:
+            self.client.stat_object(bucket_name=bucket_name, object_name=object_name)
+            return True
+        except S3Error as exc:
+            if exc.code in ("NoSuchKey", "NoSuchBucket", "NoSuchObject"):
+                return False
+            raise
+
+    def remove_objects(self, bucket_name: str, prefix: str) -> None:
+        from minio.deleteobjects import DeleteObject
+
+        objects = self.client.list_objects(
+            bucket_name=bucket_name, prefix=prefix, recursive=True
+        )
+        # remove_objects is lazy, the deletion only happens while iterating the errors
+        errors = self.client.remove_objects(
+            bucket_name=bucket_name,
+            delete_object_list=(DeleteObject(obj.object_name) for obj in objects),
+        )
+        for error in errors:
+            logger.error(f"could not remove object {error.name}: {error.message}")
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from os import getenv as env
+from os.path import exists, getsize, isdir, join as joinpath, relpath
+import logging
+
+from tagmate.storage.base import BaseObjectStore
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import MODELS_BUCKET
+
+logger = logging.getLogger("arq.worker")
+
+
+MODEL_CACHE_DIR = env("MODEL_CACHE_DIR", joinpath(tempfile.gettempdir(), "tagmate", "models"))
+MODEL_CACHE_MAX_BYTES = int(env("MODEL_CACHE_MAX_BYTES", 10 * 1024**3))  # 10 GiB
+STAGING_PREFIX = ".staging-"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(folder_path: str) -> dict[str, str]:
+    """sha256 digest of every file in a model folder, keyed by its relative path"""
+    manifest = {}
+    for root, _, files in os.walk(folder_path):
+        for name in files:
+            file_path = joinpath(root, name)
+            manifest[relpath(file_path, folder_path).replace(os.sep, "/")] = file_digest(file_path)
+    return manifest
+
+
+def manifest_digest(manifest: dict[str, str]) -> str:
+    """content address of a model version, identical files give an identical digest"""
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def folder_size(folder_path: str) -> int:
+    return sum(
+        getsize(joinpath(root, name))
+        for root, _, files in os.walk(folder_path)
+        for name in files
+    )
+
+
+class ModelCache:
+    """worker local, content addressed cache of trained model folders
+
+    Every model version lives in `{cache_dir}/{digest}/`, where the digest is
+    the hash of its manifest, so an entry never changes once it is written
+    and can be shared by every job on the worker. Entries are filled through
+    a staging directory and renamed into place, verified against the manifest.
+    The least recently used entries are evicted once the cache grows past
+    `max_bytes`. Models are loaded straight from their cache folder instead of
+    being downloaded to a temporary directory for every load.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = MODEL_CACHE_DIR,
+        max_bytes: int = MODEL_CACHE_MAX_BYTES,
+        store: BaseObjectStore | None = None,
+        bucket_name: str = MODELS_BUCKET,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.store = store
+        self.bucket_name = bucket_name
+
+    def get_object_store(self) -> BaseObjectStore:
+        if self.store is None:
+            self.store = MinioObjectStore()
+        return self.store
+
+    def path(self, digest: str) -> str:
+        return joinpath(self.cache_dir, digest)
+
+    def get(self, digest: str) -> str | None:
+        """path of a cached model version, marked as recently used, or None on a miss"""
+        path = self.path(digest)
+        if not isdir(path):
+            return None
+        os.utime(path)
+        return path
+
+    def staging_dir(self) -> str:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return joinpath(self.cache_dir, f"{STAGING_PREFIX}{uuid.uuid4().hex}")
+
+    def commit(self, staging_path: str, digest: str, manifest: dict[str, str]) -> str:
+        actual = build_manifest(staging_path)
+        if actual != manifest:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise ValueError(f"model files do not match the manifest of version {digest}")
+
+        path = self.path(digest)
+        try:
+            os.rename(staging_path, path)
+        except OSError:
+            # another job cached the same version first, the contents are identical
+            shutil.rmtree(staging_path, ignore_errors=True)
+            if not isdir(path):
+                raise
+        os.utime(path)
+        self.evict(keep=digest)
+        return path
+
+    def add(self, folder_path: str, digest: str, manifest: dict[str, str]) -> str:
+        """copies a freshly saved model folder into the cache"""
+        cached = self.get(digest)
+        if cached is not None:
+            return cached
+        staging_path = self.staging_dir()
+        shutil.copytree(folder_path, staging_path)
+        return self.commit(staging_path, digest, manifest)
+
+    def fetch(self, digest: str, manifest: dict[str, str], objects_path: str) -> str:
+        """local path of a model version, downloading it from the object store on a miss
+
+        Args:
+            digest (str): content address of the model version
+            manifest (dict[str, str]): file digests of the model version
+            objects_path (str): object store prefix the model version was uploaded to
+
+        Raises:
+            ValueError: downloaded files do not match the manifest
+
+        Returns:
+            str: path of the cached model folder
+        """
+        cached = self.get(digest)
+        if cached is not None:
+            logger.info(f"model version {digest} found in the local cache")
+            return cached
+
+        logger.info(f"downloading model version {digest} from {objects_path}")
+        staging_path = self.staging_dir()
+        store = self.get_object_store()
+        for file_name in manifest:
+            file_path = joinpath(staging_path, *file_name.split("/"))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            store.download_object_as_file(
+                bucket_name=self.bucket_name,
+                object_name=f"{objects_path.rstrip('/')}/{file_name}",
+                file_path=file_path,
+            )
+        return self.commit(staging_path, digest, manifest)
+
+    def evict(self, keep: str | None = None) -> None:
+        """removes least recently used versions until the cache fits in `max_bytes`"""
+        if not exists(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = joinpath(self.cache_dir, name)
+            if name.startswith(STAGING_PREFIX) or not isdir(path):
+                continue
+            entries.append((os.stat(path).st_mtime, name, folder_size(path)))
+
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            logger.info(f"evicting model version {name} from the local cache")
+            shutil.rmtree(joinpath(self.cache_dir, name), ignore_errors=True)
+            total -= size
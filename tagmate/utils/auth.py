@@ -1,10 +1,20 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from os import getenv as env
+import hashlib
+import time
+import uuid
 import jwt
 from fastapi import Depends
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 
+from tagmate.logging.app import logger
+from tagmate.models.py.user import TokenClaims
+from tagmate.utils.queue import get_redis_pool
+
 
 # to get a string like this run:
 # openssl rand -hex 32
@@ -12,33 +22,174 @@ JWT_SECRET = env("JWT_SECRET")
 ALGORITHM = env("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(env("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# verified claims are reused for this long, or until the token expires if sooner
+TOKEN_CACHE_TTL = int(env("TOKEN_CACHE_TTL", 300))  # seconds
+TOKEN_CACHE_MAX_SIZE = int(env("TOKEN_CACHE_MAX_SIZE", 10000))
+# checks every request against the revoked tokens in redis, cached claims included
+TOKEN_REVOCATION = env("TOKEN_REVOCATION", "false").lower() in ("1", "true", "yes")
+REVOKED_TOKEN_KEY = "tagmate:revoked:{token_id}"
+
+# cost of bcrypt is 2**rounds, hashes of another cost are rehashed on the next login
+BCRYPT_ROUNDS = int(env("BCRYPT_ROUNDS", 12))
+# threads hashing passwords, a login burst queues here instead of blocking the event loop
+PASSWORD_HASH_WORKERS = int(env("PASSWORD_HASH_WORKERS", 2))
+# login attempts per client and email within the window, 0 disables the limit
+LOGIN_RATE_LIMIT = int(env("LOGIN_RATE_LIMIT", 0))
+LOGIN_RATE_WINDOW = int(env("LOGIN_RATE_WINDOW", 60))  # seconds
+LOGIN_ATTEMPTS_KEY = "tagmate:login:{client}:{email}"
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    # hashes outside of min and max need an update, which verify_and_update reports
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=True)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+class TokenCache:
+    """bounded ttl cache of verified token claims, keyed by the sha256 of the token
+
+    Least recently used entries are evicted first once the cache is full. The
+    cache is per process and only touched from the event loop.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_MAX_SIZE, ttl: int = TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, TokenClaims]] = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> TokenClaims | None:
+        key = self.key(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        valid_until, claims = entry
+        if valid_until <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return claims
+
+    def add(self, token: str, claims: TokenClaims) -> None:
+        key = self.key(token)
+        self.entries[key] = (min(time.time() + self.ttl, claims.expires_at), claims)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, token: str) -> None:
+        self.entries.pop(self.key(token), None)
+
+
+token_cache = TokenCache()
+
+
+async def get_password_hash(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
 
-def authenticate_with_password(hashed_password: str, plain_password: str):
-    is_authenticated = pwd_context.verify(plain_password, hashed_password)
-    return is_authenticated
+async def authenticate_with_password(hashed_password: str, plain_password: str) -> tuple[bool, str | None]:
+    """verifies a password in the password executor
+
+    Returns:
+        tuple[bool, str | None]: whether the password matches, and a new hash
+            when the stored one uses other settings than the current ones
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        password_executor, pwd_context.verify_and_update, plain_password, hashed_password
+    )
+
+
+async def is_login_rate_limited(client: str, email: str) -> bool:
+    """counts a login attempt, true once the client exceeded the limit for this email"""
+    if not LOGIN_RATE_LIMIT:
+        return False
+    key = LOGIN_ATTEMPTS_KEY.format(client=client, email=email)
+    try:
+        redis = await get_redis_pool()
+        async with redis.pipeline(transaction=True) as pipe:
+            # the window starts with the first attempt
+            _, attempts = await pipe.set(key, 0, ex=LOGIN_RATE_WINDOW, nx=True).incr(key).execute()
+    except Exception as exc:
+        # fails open, logins keep working while redis is unreachable
+        logger.warning(f"could not count the login attempt of {client}: {exc}")
+        return False
+    return attempts > LOGIN_RATE_LIMIT
 
 
 def generate_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # unique per token, so that a single token can be revoked
+    to_encode.setdefault("jti", uuid.uuid4().hex)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def authenticate_with_token(token: str = Depends(oauth2_scheme)):
+def verify_access_token(token: str) -> TokenClaims | None:
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    except jwt.PyJWTError:
+        return None
+    email = payload.get("sub")
+    if email is None or payload.get("exp") is None:
+        return None
+    return TokenClaims(
+        email=email,
+        user_id=payload.get("uid"),
+        token_id=payload.get("jti"),
+        expires_at=payload["exp"],
+    )
+
+
+async def is_token_revoked(claims: TokenClaims) -> bool:
+    if claims.token_id is None:
+        return False
+    try:
+        redis = await get_redis_pool()
+        return bool(await redis.exists(REVOKED_TOKEN_KEY.format(token_id=claims.token_id)))
+    except Exception as exc:
+        # fails closed, a revoked token must not pass while redis is unreachable
+        logger.warning(f"could not check the revocation of token {claims.token_id}: {exc}")
+        return True
+
+
+async def revoke_token(token: str, claims: TokenClaims) -> bool:
+    """adds the token to the revocation list until it expires
+
+    Returns:
+        bool: whether the token was revoked, tokens without an id can only expire
+    """
+    token_cache.discard(token)
+    if not TOKEN_REVOCATION or claims.token_id is None:
+        return False
+    redis = await get_redis_pool()
+    await redis.set(
+        REVOKED_TOKEN_KEY.format(token_id=claims.token_id),
+        1,
+        ex=max(1, int(claims.expires_at - time.time())),
+    )
+    return True
+
+
+async def authenticate_with_token(token: str = Depends(oauth2_scheme)) -> TokenClaims | None:
+    claims = token_cache.get(token)
+    if claims is None:
+        claims = verify_access_token(token)
+        if claims is None:
             return None
-        return username
-    except:
+        token_cache.add(token, claims)
+    if TOKEN_REVOCATION and await is_token_revoked(claims):
         return None
+    return claims
@@ -0,0 +1,106 @@
+from typing import Callable, Iterator
+
+
+# padded tokens (longest text in the batch * batch size) allowed per batch
+DEFAULT_MAX_TOKENS = 8192
+CHARS_PER_TOKEN = 4
+
+
+def estimate_token_lengths(texts: list[str]) -> list[int]:
+    """cheap token length estimate for when no tokenizer is at hand"""
+    return [len(text) // CHARS_PER_TOKEN + 2 for text in texts]
+
+
+def count_tokens(tokenizer, texts: list[str], max_length: int | None = None) -> list[int]:
+    """token length of each text, truncated to what the model will actually see
+
+    Args:
+        tokenizer: huggingface tokenizer of the model
+        texts (list[str]): texts to measure
+        max_length (int | None): max sequence length of the model
+
+    Returns:
+        list[int]: number of tokens per text
+    """
+    if tokenizer is None:
+        lengths = estimate_token_lengths(texts)
+    else:
+        lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=True)["input_ids"]]
+    if max_length is not None:
+        lengths = [min(length, max_length) for length in lengths]
+    return lengths
+
+
+def token_budget_batches(
+    lengths: list[int],
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    max_batch_size: int | None = None,
+) -> Iterator[list[int]]:
+    """yields batches of indices sorted by length, each packed up to a padded token budget
+
+    Texts are sorted by length so that every batch pads to a similar length,
+    and a batch grows until `longest length * batch size` would exceed
+    `max_tokens`. Short texts therefore get large batches and long texts
+    small ones.
+
+    Args:
+        lengths (list[int]): token length of each text
+        max_tokens (int): padded token budget per batch
+        max_batch_size (int | None): optional cap on the number of texts per batch
+
+    Yields:
+        list[int]: indices of the texts in the batch
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batch, batch_max = [], 0
+    for idx in order:
+        longest = max(batch_max, lengths[idx])
+        is_full = longest * (len(batch) + 1) > max_tokens or (
+            max_batch_size is not None and len(batch) >= max_batch_size
+        )
+        if batch and is_full:
+            yield batch
+            batch, longest = [], lengths[idx]
+        batch.append(idx)
+        batch_max = longest
+    if batch:
+        yield batch
+
+
+def fixed_size_batches(n: int, batch_size: int) -> Iterator[list[int]]:
+    for start in range(0, n, batch_size):
+        yield list(range(start, min(start + batch_size, n)))
+
+
+def padding_efficiency(lengths: list[int], batches: list[list[int]]) -> float:
+    """share of real tokens among all padded tokens computed for the batches"""
+    padded = sum(max(lengths[idx] for idx in batch) * len(batch) for batch in batches)
+    return sum(lengths) / padded if padded else 1.0
+
+
+def map_in_length_buckets(
+    func: Callable[[list[str]], list],
+    texts: list[str],
+    lengths: list[int] | None = None,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    max_batch_size: int | None = None,
+) -> list:
+    """applies `func` to token budget batches and returns the outputs in the original order
+
+    Args:
+        func (Callable[[list[str]], list]): batch function returning one output per text
+        texts (list[str]): texts to process
+        lengths (list[int] | None): token length of each text, estimated when not given
+        max_tokens (int): padded token budget per batch
+        max_batch_size (int | None): optional cap on the number of texts per batch
+
+    Returns:
+        list: one output per text, aligned with `texts`
+    """
+    if lengths is None:
+        lengths = estimate_token_lengths(texts)
+    outputs = [None] * len(texts)
+    for batch in token_budget_batches(lengths, max_tokens, max_batch_size):
+        for idx, output in zip(batch, func([texts[idx] for idx in batch])):
+            outputs[idx] = output
+    return outputs
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+from typing import Any, Callable
+
+from tagmate.utils.profiling import profiled_in_thread
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """cooperative cancellation for the blocking stages of a job
+
+    Blocking stages run in a worker thread via `run`, which keeps the event
+    loop free to receive aborts from arq. When the awaiting task is
+    cancelled the token is set, and the thread stops at its next check:
+    between batches, or on the next forward pass of a watched model.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise JobCancelled()
+
+    def watch(self, module) -> None:
+        """checks for cancellation before every forward pass of a torch module"""
+        module.register_forward_pre_hook(lambda *args: self.raise_if_cancelled())
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        try:
+            # a profiled job follows its stages into their thread
+            return await asyncio.to_thread(profiled_in_thread(func), *args, **kwargs)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
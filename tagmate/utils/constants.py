@@ -4,4 +4,7 @@ DATASET_INDEX_COLUMN_NAME = "index"
 
 # obejct store
 UPLOADS_BUCKET = "uploads"
-MODELS_BUCKET = "models"
\ No newline at end of file
+MODELS_BUCKET = "models"
+CHECKPOINTS_BUCKET = "checkpoints"
+PROFILES_BUCKET = "profiles"
+LOGS_BUCKET = "logs"
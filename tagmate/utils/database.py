@@ -1,5 +1,8 @@
 from os import getenv as env
-from tortoise import Tortoise, run_async
+from tortoise import Tortoise, connections, run_async
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from tagmate.utils.metrics import instrument_database_client
 
 PG_USERNAME = env("POSTGRES_USER", "postgres")
 PG_PASSWORD = env("POSTGRES_PASSWORD", "postgres")
@@ -7,15 +10,61 @@ PG_HOST = env("POSTGRES_HOST", "postgres")
 PG_PORT = env("POSTGRES_PORT", 5432)
 PG_DATABASE = "postgres"
 
+# read replica, falls back to the primary when not configured
+PG_REPLICA_HOST = env("POSTGRES_REPLICA_HOST", PG_HOST)
+PG_REPLICA_PORT = env("POSTGRES_REPLICA_PORT", PG_PORT)
+
 DB_URI = f"postgres://{PG_USERNAME}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DATABASE}"
+DB_REPLICA_URI = f"postgres://{PG_USERNAME}:{PG_PASSWORD}@{PG_REPLICA_HOST}:{PG_REPLICA_PORT}/{PG_DATABASE}"
 DB_MODELS = ["tagmate.models.db.activity", "tagmate.models.db.user"]
 
+PRIMARY_CONNECTION = "default"
+REPLICA_CONNECTION = "replica"
+
+
+class ReadReplicaRouter:
+    """routes read-only queries to the replica and everything else to the primary"""
+
+    def db_for_read(self, model):
+        return REPLICA_CONNECTION
+
+    def db_for_write(self, model):
+        return PRIMARY_CONNECTION
+
+
+TORTOISE_ORM = {
+    "connections": {
+        PRIMARY_CONNECTION: DB_URI,
+        REPLICA_CONNECTION: DB_REPLICA_URI,
+    },
+    "apps": {
+        "models": {
+            "models": DB_MODELS,
+            "default_connection": PRIMARY_CONNECTION,
+        }
+    },
+    "routers": ["tagmate.utils.database.ReadReplicaRouter"],
+}
+
+
+def primary() -> BaseDBAsyncClient:
+    """connection to the primary, for reads that must see the latest writes
+
+    Returns:
+        BaseDBAsyncClient: primary database connection
+    """
+    return connections.get(PRIMARY_CONNECTION)
+
+
+def instrument_connections() -> None:
+    """records query timings of every initialised connection"""
+    for connection in connections.all():
+        instrument_database_client(type(connection))
+
 
 async def db_init(db_url=None):
-    await Tortoise.init(
-        db_url=DB_URI,
-        modules={"models": DB_MODELS},
-    )
+    await Tortoise.init(config=TORTOISE_ORM)
+    instrument_connections()
 
 
 if __name__ == "__main__":
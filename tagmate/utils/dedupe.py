@@ -0,0 +1,110 @@
+import hashlib
+import re
+from collections import defaultdict
+from os import getenv as env
+
+
+# near duplicate grouping is opt-in, it merges texts the model would see as different
+NEAR_DUPLICATES = env("DEDUPE_NEAR_DUPLICATES", "false").lower() == "true"
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4  # texts within BANDS - 1 bits are guaranteed to share a band
+MAX_HAMMING_DISTANCE = 3
+SHINGLE_SIZE = 4  # characters
+# texts of a band bucket are compared with this many neighbours, short texts fill huge buckets
+MAX_BUCKET_NEIGHBOURS = 64
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return WHITESPACE_PATTERN.sub(" ", text).strip().lower()
+
+
+def simhash(text: str, n_bits: int = SIMHASH_BITS) -> int:
+    """simhash fingerprint of the character shingles of a text"""
+    shingles = [
+        text[idx:idx + SHINGLE_SIZE]
+        for idx in range(max(1, len(text) - SHINGLE_SIZE + 1))
+    ]
+    weights = [0] * n_bits
+    for shingle in shingles:
+        digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=n_bits // 8).digest()
+        value = int.from_bytes(digest, "big")
+        for bit in range(n_bits):
+            weights[bit] += 1 if (value >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(n_bits) if weights[bit] > 0)
+
+
+def near_duplicate_representatives(
+    texts: list[str], max_distance: int = MAX_HAMMING_DISTANCE
+) -> list[int]:
+    """groups texts whose simhash fingerprints are within `max_distance` bits
+
+    Candidate pairs are found by banding the fingerprints, so only texts
+    sharing at least one band are compared. A bucket is sorted by fingerprint
+    and every text compared with its next MAX_BUCKET_NEIGHBOURS texts only,
+    which keeps buckets of texts with identical bands linear rather than
+    quadratic, at the cost of missing far apart pairs in those buckets.
+
+    Returns:
+        list[int]: index of the group representative (its first text) for every text
+    """
+    fingerprints = [simhash(text) for text in texts]
+    parent = list(range(len(texts)))
+
+    def find(idx: int) -> int:
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    band_bits = SIMHASH_BITS // SIMHASH_BANDS
+    band_mask = (1 << band_bits) - 1
+    for band in range(SIMHASH_BANDS):
+        buckets = defaultdict(list)
+        for idx, fingerprint in enumerate(fingerprints):
+            buckets[(fingerprint >> (band * band_bits)) & band_mask].append(idx)
+        for bucket in buckets.values():
+            bucket.sort(key=lambda idx: fingerprints[idx])
+            for pos, idx in enumerate(bucket):
+                for other in bucket[pos + 1:pos + 1 + MAX_BUCKET_NEIGHBOURS]:
+                    if bin(fingerprints[idx] ^ fingerprints[other]).count("1") <= max_distance:
+                        root, other_root = find(idx), find(other)
+                        if root != other_root:
+                            parent[max(root, other_root)] = min(root, other_root)
+
+    return [find(idx) for idx in range(len(texts))]
+
+
+def dedupe(
+    texts: list[str],
+    near_duplicates: bool = NEAR_DUPLICATES,
+    normalize: bool = True,
+) -> tuple[list[int], list[int]]:
+    """finds the unique texts so that model work runs once per unique text
+
+    Args:
+        texts (list[str]): texts to dedupe
+        near_duplicates (bool): also group near duplicates using simhash
+        normalize (bool): ignore case and whitespace differences for exact matches
+
+    Returns:
+        tuple[list[int], list[int]]: indices of the unique texts, and for every
+            text the position of its unique text, to fan results back out with
+            `[unique_outputs[pos] for pos in inverse]`
+    """
+    keys = [normalize_text(text) for text in texts] if normalize else texts
+
+    first_seen = {}
+    representatives = [first_seen.setdefault(key, idx) for idx, key in enumerate(keys)]
+
+    if near_duplicates and len(first_seen) > 1:
+        exact_unique = list(first_seen.values())
+        near = near_duplicate_representatives([keys[idx] for idx in exact_unique])
+        near_representative = {idx: exact_unique[rep] for idx, rep in zip(exact_unique, near)}
+        representatives = [near_representative[rep] for rep in representatives]
+
+    unique_idx = sorted(set(representatives))
+    position = {idx: pos for pos, idx in enumerate(unique_idx)}
+    inverse = [position[rep] for rep in representatives]
+    return unique_idx, inverse
@@ -0,0 +1,226 @@
+import csv
+import io
+import json
+import uuid
+import zlib
+from datetime import datetime
+from os import getenv as env
+from typing import AsyncIterator
+
+from tortoise import connections
+
+from tagmate.models.db.activity import Document as DocumentTable
+from tagmate.models.enums import ExportCompressionEnum, ExportFormatEnum
+from tagmate.utils.database import REPLICA_CONNECTION
+
+
+# rows fetched from the cursor and encoded at a time, memory stays bounded by one batch
+EXPORT_BATCH_SIZE = int(env("EXPORT_BATCH_SIZE", 10000))
+
+EXPORT_COLUMNS = [
+    "id",
+    "index",
+    "text",
+    "labels",
+    "clusters",
+    "is_auto_generated",
+    "is_user_validated",
+    "created_at",
+    "updated_at",
+]
+JSON_COLUMNS = {"labels", "clusters"}
+
+STREAM_COMPRESSIONS = {ExportCompressionEnum.none, ExportCompressionEnum.gzip}
+MEDIA_TYPES = {
+    ExportFormatEnum.parquet: "application/vnd.apache.parquet",
+    ExportFormatEnum.csv: "text/csv",
+    ExportFormatEnum.jsonl: "application/x-ndjson",
+}
+
+
+def normalise_row(row: dict) -> dict:
+    """python values of a document row, whichever driver read it"""
+    for key, value in row.items():
+        if isinstance(value, uuid.UUID):
+            row[key] = str(value)
+        elif key in JSON_COLUMNS:
+            # asyncpg returns json columns as text
+            value = json.loads(value) if isinstance(value, str) else value
+            # tags and cluster ids are strings, entity labels are objects and kept as json
+            row[key] = [item if isinstance(item, str) else json.dumps(item) for item in value or []]
+    return row
+
+
+async def iter_document_batches(
+    activity_id: str, columns: list[str], batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[list[dict]]:
+    """batches of the documents of an activity in id order, read from the replica
+
+    On postgres the rows come from a server side cursor in a read only
+    transaction. Other databases page through the documents by id.
+    """
+    connection = connections.get(REPLICA_CONNECTION)
+    if connection.capabilities.dialect == "postgres":
+        # columns come from EXPORT_COLUMNS, never from the request as is
+        selected = ", ".join(f'"{column}"' for column in columns)
+        query = f'SELECT {selected} FROM "{DocumentTable._meta.db_table}" WHERE "activity_id" = $1 ORDER BY "id"'
+
+        async with connection.acquire_connection() as conn:
+            async with conn.transaction(readonly=True):
+                batch = []
+                async for record in conn.cursor(query, uuid.UUID(str(activity_id)), prefetch=batch_size):
+                    batch.append(normalise_row(dict(record)))
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+        return
+
+    last_id = None
+    while True:
+        query = DocumentTable.filter(activity_id=activity_id)
+        if last_id is not None:
+            query = query.filter(id__gt=last_id)
+        rows = await query.order_by("id").limit(batch_size).values("id", *columns)
+        if not rows:
+            return
+        last_id = rows[-1]["id"]
+        yield [normalise_row({column: row[column] for column in columns}) for row in rows]
+
+
+class GzipStream:
+    """incremental gzip of an encoded stream"""
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+class RowEncoder:
+    """encodes batches of rows into chunks of the export file"""
+
+    def __init__(self, columns: list[str], compression: ExportCompressionEnum):
+        self.columns = columns
+        self.gzip = GzipStream() if compression == ExportCompressionEnum.gzip else None
+
+    def encode_rows(self, rows: list[dict]) -> bytes:
+        raise NotImplementedError
+
+    def encode(self, rows: list[dict]) -> bytes:
+        data = self.encode_rows(rows)
+        return self.gzip.compress(data) if self.gzip else data
+
+    def close(self) -> bytes:
+        return self.gzip.flush() if self.gzip else b""
+
+
+class CsvEncoder(RowEncoder):
+    """csv with a header row, list columns are written as json arrays"""
+
+    def __init__(self, columns: list[str], compression: ExportCompressionEnum):
+        super().__init__(columns, compression)
+        self.header_written = False
+
+    def encode_rows(self, rows: list[dict]) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=self.columns)
+        if not self.header_written:
+            writer.writeheader()
+            self.header_written = True
+        for row in rows:
+            writer.writerow({
+                key: json.dumps(value) if key in JSON_COLUMNS
+                else value.isoformat() if isinstance(value, datetime)
+                else value
+                for key, value in row.items()
+            })
+        return buffer.getvalue().encode("utf-8")
+
+    def close(self) -> bytes:
+        # an activity without documents still gets its header
+        header = b"" if self.header_written else self.encode([])
+        return header + super().close()
+
+
+class JsonLinesEncoder(RowEncoder):
+    def encode_rows(self, rows: list[dict]) -> bytes:
+        return "".join(
+            json.dumps(row, default=lambda value: value.isoformat()) + "\n" for row in rows
+        ).encode("utf-8")
+
+
+class ChunkSink(io.RawIOBase):
+    """write only file handing out what was written since the last drain
+
+    The parquet writer records file offsets through `tell`, so the position
+    keeps counting across drains.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ParquetEncoder(RowEncoder):
+    """parquet with one row group per batch, flushed as soon as it is written"""
+
+    def __init__(self, columns: list[str], compression: ExportCompressionEnum):
+        # imported on use, so that the api does not load arrow at startup
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        super().__init__(columns, ExportCompressionEnum.none)
+        types = {
+            "id": pa.string(),
+            "index": pa.int64(),
+            "text": pa.string(),
+            "labels": pa.list_(pa.string()),
+            "clusters": pa.list_(pa.string()),
+            "is_auto_generated": pa.bool_(),
+            "is_user_validated": pa.bool_(),
+            "created_at": pa.timestamp("us", tz="UTC"),
+            "updated_at": pa.timestamp("us", tz="UTC"),
+        }
+        self.pa = pa
+        self.schema = pa.schema([(column, types[column]) for column in columns])
+        self.sink = ChunkSink()
+        self.writer = pq.ParquetWriter(
+            self.sink, self.schema, compression=compression.value if compression != ExportCompressionEnum.none else "none"
+        )
+
+    def encode_rows(self, rows: list[dict]) -> bytes:
+        self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+        return self.sink.drain()
+
+    def close(self) -> bytes:
+        self.writer.close()
+        return self.sink.drain()
+
+
+ENCODERS: dict[ExportFormatEnum, type[RowEncoder]] = {
+    ExportFormatEnum.parquet: ParquetEncoder,
+    ExportFormatEnum.csv: CsvEncoder,
+    ExportFormatEnum.jsonl: JsonLinesEncoder,
+}
@@ -1,5 +1,3 @@
-from io import StringIO
-import pandas as pd
 import contextlib
 import os
 import shutil
@@ -8,13 +6,6 @@ import tempfile
 from typing import Generator
 
 
-def bytes_to_df(bytes_data: bytes):
-    s = str(bytes_data, "utf-8")
-    data = StringIO(s)
-    df = pd.read_csv(data).reset_index()
-    return df
-
-
 @contextlib.contextmanager
 def SoftTemporaryDirectory(
     suffix: str | None = None,
@@ -0,0 +1,338 @@
+import asyncio
+import contextlib
+import gzip
+import io
+import json
+import math
+import shutil
+import tempfile
+from os import getenv as env
+from os.path import splitext
+from typing import Awaitable, BinaryIO, Callable, Iterator
+
+from tagmate.exceptions import activity as ActivityExceptions
+from tagmate.models.db.activity import Document as DocumentTable
+from tagmate.models.enums import UploadFormatEnum
+from tagmate.utils.constants import DATASET_INDEX_COLUMN_NAME, DATASET_TEXT_COLUMN_NAME
+
+
+# rows parsed and inserted at a time, memory stays bounded by one batch
+UPLOAD_BATCH_SIZE = int(env("UPLOAD_BATCH_SIZE", 10000))
+# compressed parquet and excel uploads are decompressed into a file that stays in memory up to this size
+UPLOAD_SPOOL_MAX_SIZE = int(env("UPLOAD_SPOOL_MAX_SIZE", 64 * 1024**2))
+# text columns looked up when the upload does not name one, `review` is the original upload format
+DEFAULT_TEXT_COLUMNS = [DATASET_TEXT_COLUMN_NAME, "review"]
+# document indexes are stored in a 32 bit integer column
+MAX_DOCUMENT_INDEX = 2**31 - 1
+
+FORMAT_EXTENSIONS = {
+    ".csv": UploadFormatEnum.csv,
+    ".jsonl": UploadFormatEnum.jsonl,
+    ".ndjson": UploadFormatEnum.jsonl,
+    ".parquet": UploadFormatEnum.parquet,
+    ".pq": UploadFormatEnum.parquet,
+    ".xlsx": UploadFormatEnum.excel,
+    ".xlsm": UploadFormatEnum.excel,
+}
+COMPRESSION_EXTENSIONS = {".gz", ".gzip", ".zst", ".zstd"}
+# parquet and excel readers seek around the file, the others read it front to back
+SEEKABLE_FORMATS = {UploadFormatEnum.parquet, UploadFormatEnum.excel}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class UploadError(ValueError):
+    """the upload can not be read as documents, the message is meant for the user"""
+
+
+def detect_upload_format(file_name: str | None, upload_format: UploadFormatEnum | None = None) -> UploadFormatEnum:
+    """the format given with the upload, else the one of the file extension
+
+    A compression extension is skipped, `reviews.jsonl.gz` is read as jsonl.
+    """
+    if upload_format is not None:
+        return upload_format
+    root, extension = splitext((file_name or "").lower())
+    if extension in COMPRESSION_EXTENSIONS:
+        root, extension = splitext(root)
+    if extension not in FORMAT_EXTENSIONS:
+        raise UploadError(
+            f"could not tell the format of {file_name}, "
+            f"name the format as one of {', '.join(item.value for item in UploadFormatEnum)}"
+        )
+    return FORMAT_EXTENSIONS[extension]
+
+
+def open_decompressed(file: BinaryIO) -> BinaryIO:
+    """the upload, decompressed while it is read when it starts with gzip or zstd magic bytes"""
+    file.seek(0)
+    magic = file.read(4)
+    file.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    if magic == ZSTD_MAGIC:
+        try:
+            import zstandard
+        except ImportError:
+            raise UploadError("zstd compressed uploads are not supported by this server")
+        # buffered, so that the stream can be read line by line
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file, closefd=False))
+    return file
+
+
+def spool(stream: BinaryIO) -> BinaryIO:
+    """a seekable copy of a decompressed stream, written to disk once it outgrows memory"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+    shutil.copyfileobj(stream, spooled, length=1024**2)
+    spooled.seek(0)
+    return spooled
+
+
+def resolve_columns(columns: list, text_column: str | None, id_column: str | None) -> tuple[str, str | None]:
+    candidates = [text_column] if text_column else DEFAULT_TEXT_COLUMNS
+    text = next((column for column in candidates if column in columns), None)
+    if text is None:
+        found = f", found {', '.join(str(column) for column in columns[:20])}" if columns else ""
+        raise UploadError(f"the upload has no {' or '.join(candidates)} column{found}")
+    if id_column and id_column not in columns:
+        raise UploadError(f"the upload has no {id_column} column")
+    return text, id_column
+
+
+def is_missing(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float):
+        return math.isnan(value)
+    return isinstance(value, str) and not value.strip()
+
+
+def to_index(value, position: int) -> int:
+    try:
+        # csv ids arrive as strings and nullable parquet ids as floats
+        number = float(value)
+        if isinstance(value, bool) or not number.is_integer():
+            raise ValueError
+    except (TypeError, ValueError):
+        raise UploadError(f"the id of row {position} is not an integer: {value!r}")
+    index = int(number)
+    if abs(index) > MAX_DOCUMENT_INDEX:
+        raise UploadError(f"the id of row {position} is out of range: {index}")
+    return index
+
+
+class DocumentBatcher:
+    """turns columns of texts and ids into document rows
+
+    Rows without text are skipped. Without an id column a document is
+    indexed by its row number in the upload, counted across batches.
+    """
+
+    def __init__(self):
+        self.position = 0
+
+    def documents(self, texts: list, ids: list | None = None) -> list[dict]:
+        documents = []
+        for offset, text in enumerate(texts):
+            position = self.position + offset
+            if is_missing(text):
+                continue
+            documents.append({
+                DATASET_INDEX_COLUMN_NAME: position if ids is None else to_index(ids[offset], position),
+                DATASET_TEXT_COLUMN_NAME: str(text),
+            })
+        self.position += len(texts)
+        return documents
+
+
+def read_csv(stream: BinaryIO, text_column: str | None, id_column: str | None, batch_size: int):
+    # imported on use, so that the api does not load pandas at startup
+    import pandas as pd
+
+    wanted = set([text_column] if text_column else DEFAULT_TEXT_COLUMNS) | {id_column}
+    chunks = pd.read_csv(
+        stream,
+        # only the mapped columns are parsed, text is kept as written
+        usecols=lambda column: column in wanted,
+        dtype=str,
+        encoding="utf-8-sig",
+        chunksize=batch_size,
+    )
+    columns = None
+    for chunk in chunks:
+        if columns is None:
+            columns = resolve_columns(list(chunk.columns), text_column, id_column)
+        text, ident = columns
+        yield chunk[text].tolist(), chunk[ident].tolist() if ident else None
+
+
+def read_jsonl(stream: BinaryIO, text_column: str | None, id_column: str | None, batch_size: int):
+    columns = None
+    texts, ids = [], []
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise UploadError(f"line {line_number} of the upload is not a json object")
+        if columns is None:
+            # the first row names the columns, later rows may leave them out
+            columns = resolve_columns(list(row), text_column, id_column)
+        text, ident = columns
+        texts.append(row.get(text))
+        ids.append(row.get(ident) if ident else None)
+        if len(texts) == batch_size:
+            yield texts, ids if ident else None
+            texts, ids = [], []
+    if texts:
+        yield texts, ids if columns[1] else None
+
+
+def read_parquet(stream: BinaryIO, text_column: str | None, id_column: str | None, batch_size: int):
+    # imported on use, so that the api does not load arrow at startup
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(stream)
+    text, ident = resolve_columns(parquet.schema_arrow.names, text_column, id_column)
+    # only the mapped columns are read, one row group at a time
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=[text, ident] if ident else [text]):
+        values = batch.to_pydict()
+        yield values[text], values[ident] if ident else None
+
+
+def read_excel(stream: BinaryIO, text_column: str | None, id_column: str | None, batch_size: int):
+    try:
+        import openpyxl
+    except ImportError:
+        raise UploadError("excel uploads are not supported by this server")
+
+    # read only workbooks load rows as they are iterated, the first sheet holds the documents
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = ["" if column is None else str(column) for column in header]
+        text, ident = resolve_columns(columns, text_column, id_column)
+        text_position = columns.index(text)
+        id_position = columns.index(ident) if ident else None
+
+        def cell(row: tuple, position: int):
+            return row[position] if position < len(row) else None
+
+        texts, ids = [], []
+        for row in rows:
+            texts.append(cell(row, text_position))
+            ids.append(cell(row, id_position) if ident else None)
+            if len(texts) == batch_size:
+                yield texts, ids if ident else None
+                texts, ids = [], []
+        if texts:
+            yield texts, ids if ident else None
+    finally:
+        workbook.close()
+
+
+READERS = {
+    UploadFormatEnum.csv: read_csv,
+    UploadFormatEnum.jsonl: read_jsonl,
+    UploadFormatEnum.parquet: read_parquet,
+    UploadFormatEnum.excel: read_excel,
+}
+
+
+def iter_upload_documents(
+    file: BinaryIO,
+    upload_format: UploadFormatEnum,
+    text_column: str | None = None,
+    id_column: str | None = None,
+    batch_size: int = UPLOAD_BATCH_SIZE,
+) -> Iterator[list[dict]]:
+    """batches of documents read from an uploaded file
+
+    Compressed uploads are decompressed as they are read. Parquet and excel
+    need random access, compressed ones are decompressed into a spooled
+    temporary file first.
+
+    Args:
+        file (BinaryIO): the uploaded file, read from its start
+        upload_format (UploadFormatEnum): format of the file, see `detect_upload_format`
+        text_column (str | None): column of the document text, `text` or `review` by default
+        id_column (str | None): column of integer document ids, the row number by default
+        batch_size (int): rows read at a time
+
+    Returns:
+        Iterator[list[dict]]: non empty batches of `index` and `text` rows
+
+    Raises:
+        UploadError: when the file can not be read as documents
+    """
+    stream = open_decompressed(file)
+    try:
+        if upload_format in SEEKABLE_FORMATS and stream is not file:
+            decompressed, stream = stream, spool(stream)
+            decompressed.close()
+        batcher = DocumentBatcher()
+        for texts, ids in READERS[upload_format](stream, text_column, id_column, batch_size):
+            documents = batcher.documents(texts, ids)
+            if documents:
+                yield documents
+    except UploadError:
+        raise
+    except Exception as exc:
+        raise UploadError(f"could not read the upload as {upload_format.value}: {exc}") from exc
+    finally:
+        if stream is not file:
+            stream.close()
+
+
+@contextlib.asynccontextmanager
+async def upload_errors(cleanup: Callable[[], Awaitable] | None = None):
+    """turns an UploadError into a bad request with its message, after running `cleanup`"""
+    try:
+        yield
+    except UploadError as exc:
+        if cleanup is not None:
+            await cleanup()
+        raise ActivityExceptions.InvalidUploadFile(detail=str(exc), exception=exc)
+
+
+async def first_upload_batch(documents: Iterator[list[dict]]) -> list[dict]:
+    """the first batch of an upload, reading it checks the format and the columns
+
+    Raises:
+        UploadError: when the file can not be read as documents, or has none
+    """
+    # parsing is cpu bound, batches are read off the event loop
+    batch = await asyncio.to_thread(next, documents, None)
+    if batch is None:
+        raise UploadError("the upload has no documents")
+    return batch
+
+
+async def insert_upload_documents(activity_id: str, batch: list[dict], documents: Iterator[list[dict]]) -> int:
+    """inserts the documents of an upload a batch at a time, starting with the batch already read
+
+    Returns:
+        int: number of documents inserted
+
+    Raises:
+        UploadError: when a later batch can not be read, earlier batches stay inserted
+    """
+    inserted = 0
+    while batch:
+        await DocumentTable.bulk_create(
+            [
+                DocumentTable(
+                    index=doc[DATASET_INDEX_COLUMN_NAME],
+                    text=doc[DATASET_TEXT_COLUMN_NAME],
+                    activity_id=activity_id,
+                )
+                for doc in batch
+            ]
+        )
+        inserted += len(batch)
+        batch = await asyncio.to_thread(next, documents, None)
+    return inserted
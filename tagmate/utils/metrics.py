@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import time
+from os import getenv as env
+from typing import Callable
+import logging
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+logger = logging.getLogger("arq.worker")
+
+
+# set when the api runs several uvicorn workers, every process writes its samples there
+PROMETHEUS_MULTIPROC_DIR = env("PROMETHEUS_MULTIPROC_DIR")
+WORKER_METRICS_PORT = int(env("WORKER_METRICS_PORT", 9100))
+QUEUE_DEPTH_INTERVAL = 15  # seconds
+
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 10800)
+SIZE_BUCKETS = tuple(1024 * 4**power for power in range(12))  # 1 KiB to 4 GiB
+
+HTTP_REQUEST_DURATION = Histogram(
+    "tagmate_http_request_duration_seconds",
+    "latency of api requests",
+    ["method", "route", "status"],
+    buckets=FAST_BUCKETS,
+)
+UPLOAD_BYTES = Histogram(
+    "tagmate_upload_bytes",
+    "size of uploaded datasets",
+    buckets=SIZE_BUCKETS,
+)
+DB_QUERY_DURATION = Histogram(
+    "tagmate_db_query_duration_seconds",
+    "latency of database queries",
+    ["connection", "method"],
+    buckets=FAST_BUCKETS,
+)
+REDIS_CALL_DURATION = Histogram(
+    "tagmate_redis_call_duration_seconds",
+    "latency of redis commands",
+    ["command"],
+    buckets=FAST_BUCKETS,
+)
+OBJECT_STORE_CALL_DURATION = Histogram(
+    "tagmate_object_store_call_duration_seconds",
+    "latency of object store calls",
+    ["method"],
+    buckets=FAST_BUCKETS,
+)
+STAGE_DURATION = Histogram(
+    "tagmate_worker_stage_duration_seconds",
+    "time spent in each stage of the worker pipelines",
+    ["component", "stage"],
+    buckets=SLOW_BUCKETS,
+)
+JOB_DURATION = Histogram(
+    "tagmate_worker_job_duration_seconds",
+    "run time of worker jobs",
+    ["function", "outcome"],
+    buckets=SLOW_BUCKETS,
+)
+JOB_QUEUED_DURATION = Histogram(
+    "tagmate_worker_job_queued_seconds",
+    "time jobs spent in the queue before starting",
+    ["function"],
+    buckets=SLOW_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "tagmate_worker_queue_depth",
+    "jobs waiting in each queue",
+    ["queue"],
+    multiprocess_mode="max",
+)
+
+DB_CLIENT_METHODS = ["execute_insert", "execute_many", "execute_query", "execute_query_dict", "execute_script"]
+
+# per task rather than per thread, concurrent jobs on one event loop time their stages independently
+_active_stages: contextvars.ContextVar[frozenset] = contextvars.ContextVar("active_stages", default=frozenset())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """prometheus exposition of this process, or of all api processes in multiprocess mode"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def observe(histogram: Histogram, **labels) -> Callable:
+    """decorator timing a sync or async function into `histogram`"""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.labels(**labels).observe(time.perf_counter() - started)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.labels(**labels).observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def stage(name: str) -> Callable:
+    """decorator timing a pipeline method as a worker stage
+
+    The component label is the class of the instance, so that the sharded and
+    the local clustering report separately. Recursive calls of the same stage
+    are only timed once, by the outermost call.
+    """
+
+    def decorator(func):
+        @contextlib.contextmanager
+        def timer(self):
+            key = (type(self).__name__, name)
+            active = _active_stages.get()
+            if key in active:
+                yield
+                return
+            token = _active_stages.set(active | {key})
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                _active_stages.reset(token)
+                STAGE_DURATION.labels(component=key[0], stage=name).observe(time.perf_counter() - started)
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                with timer(self):
+                    return await func(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with timer(self):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_job(func):
+    """decorator recording the run time, outcome and queueing time of an arq job function"""
+
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        function = func.__name__
+        enqueue_time = ctx.get("enqueue_time")
+        if enqueue_time is not None:
+            JOB_QUEUED_DURATION.labels(function=function).observe(
+                max(0.0, time.time() - enqueue_time.timestamp())
+            )
+        started = time.perf_counter()
+        outcome = "failed"
+        try:
+            result = await func(ctx, *args, **kwargs)
+            outcome = "success"
+            return result
+        except asyncio.CancelledError:
+            # arq cancels timed out jobs too, the job records in ctx whether it was aborted
+            outcome = "aborted" if ctx.get("aborted") else "failed"
+            raise
+        finally:
+            JOB_DURATION.labels(function=function, outcome=outcome).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_methods(histogram: Histogram, methods: list[str], label: str = "method") -> Callable:
+    """class decorator timing the given methods into `histogram`, labelled by method name"""
+
+    def decorator(cls):
+        for method in methods:
+            setattr(cls, method, observe(histogram, **{label: method})(getattr(cls, method)))
+        return cls
+
+    return decorator
+
+
+def instrument_database_client(client_class: type) -> None:
+    """times the query methods of a tortoise client class, once per class"""
+    if client_class.__dict__.get("_tagmate_instrumented", False):
+        return
+    for method in DB_CLIENT_METHODS:
+        original = getattr(client_class, method, None)
+        if original is None:
+            continue
+
+        def wrap(original, method):
+            @functools.wraps(original)
+            async def wrapper(self, *args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(self, *args, **kwargs)
+                finally:
+                    DB_QUERY_DURATION.labels(
+                        connection=self.connection_name, method=method
+                    ).observe(time.perf_counter() - started)
+
+            return wrapper
+
+        setattr(client_class, method, wrap(original, method))
+    client_class._tagmate_instrumented = True
+
+
+def instrument_redis_client(client_class: type) -> None:
+    """times every command sent by a redis client class, once per class"""
+    if client_class.__dict__.get("_tagmate_instrumented", False):
+        return
+    original = client_class.execute_command
+
+    @functools.wraps(original)
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await original(self, *args, **options)
+        finally:
+            command = str(args[0]).upper() if args else "UNKNOWN"
+            REDIS_CALL_DURATION.labels(command=command).observe(time.perf_counter() - started)
+
+    client_class.execute_command = execute_command
+    client_class._tagmate_instrumented = True
+
+
+async def report_queue_depth(redis, queue_names: list[str], interval: float = QUEUE_DEPTH_INTERVAL):
+    """periodically publishes the number of queued jobs of every queue"""
+    while True:
+        for queue_name in queue_names:
+            try:
+                QUEUE_DEPTH.labels(queue=queue_name).set(await redis.zcard(queue_name))
+            except Exception as exc:
+                logger.warning(f"could not read the depth of queue {queue_name}: {exc}")
+        await asyncio.sleep(interval)
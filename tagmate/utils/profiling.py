@@ -0,0 +1,166 @@
+import contextvars
+import cProfile
+import io
+import json
+import marshal
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from os.path import join as joinpath
+from typing import Any, Callable
+import logging
+
+from tagmate.storage.base import BaseObjectStore
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import PROFILES_BUCKET
+
+logger = logging.getLogger("tagmate.app")
+
+
+PROFILE_HEADER = "X-Tagmate-Profile"
+PROFILE_QUERY_PARAM = "profile"
+PROFILE_ID_HEADER = "X-Tagmate-Profile-Id"
+TRUTHY = ("1", "true", "yes", "on")
+
+REQUEST_PROFILES = "requests"
+JOB_PROFILES = "jobs"
+PROFILE_KINDS = (REQUEST_PROFILES, JOB_PROFILES)
+
+PROFILE_FILE = "profile.prof"  # loadable with pstats.Stats or snakeviz
+PROFILE_TEXT_FILE = "profile.txt"
+MEMORY_TEXT_FILE = "memory.txt"
+SUMMARY_FILE = "summary.json"
+PROFILE_FILES = (PROFILE_FILE, PROFILE_TEXT_FILE, MEMORY_TEXT_FILE, SUMMARY_FILE)
+
+TOP_FUNCTIONS = 80
+TOP_ALLOCATIONS = 50
+TRACEMALLOC_FRAMES = 25
+
+# a thread holds one cProfile profiler at a time, so only one profile runs per process
+_profile_lock = threading.Lock()
+# profiler of the job running in this context, asyncio.to_thread carries it into worker threads
+active_profiler: contextvars.ContextVar["Profiler | None"] = contextvars.ContextVar("active_profiler", default=None)
+
+
+def is_truthy(value: str | bool | None) -> bool:
+    if isinstance(value, bool):
+        return value
+    return value is not None and value.lower() in TRUTHY
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profiler:
+    """cProfile and tracemalloc capture of a single request or job
+
+    cProfile only sees the thread it was enabled in, so blocking stages which
+    run in worker threads are profiled separately through `wrap`, or
+    `profiled_in_thread` for the active profiler, and merged into one profile
+    on `stop`. The profile of the event loop thread also
+    contains whatever else ran concurrently on that loop, and only one
+    profile can run per process at a time.
+    """
+
+    def __init__(self, kind: str, profile_id: str, name: str):
+        self.kind = kind
+        self.profile_id = profile_id
+        self.name = name
+        self.main_profile = cProfile.Profile()
+        self.thread_profiles: list[cProfile.Profile] = []
+        self.lock = threading.Lock()
+        self.started_tracemalloc = False
+
+    def start(self) -> None:
+        """starts cProfile on the calling thread and tracemalloc
+
+        Raises:
+            ProfilerBusy: another request or job of this process is being profiled
+        """
+        if not _profile_lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.main_profile.enable()
+
+    def wrap(self, func: Callable) -> Callable:
+        """profiles calls of `func` in whichever thread they run"""
+
+        def profiled(*args, **kwargs) -> Any:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.thread_profiles.append(profile)
+
+        return profiled
+
+    def stop(self) -> dict[str, bytes]:
+        """stops profiling and renders the files to store"""
+        self.main_profile.disable()
+        duration = time.perf_counter() - self.started
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+        profile_text = io.StringIO()
+        stats = pstats.Stats(self.main_profile, stream=profile_text)
+        for profile in self.thread_profiles:
+            stats.add(profile)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+        memory_lines = [f"peak traced memory: {peak} bytes, at stop: {current} bytes", ""]
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            memory_lines.append(str(stat))
+
+        summary = {
+            "kind": self.kind,
+            "id": self.profile_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "duration_seconds": round(duration, 4),
+            "peak_traced_memory_bytes": peak,
+            "profiled_threads": 1 + len(self.thread_profiles),
+        }
+        return {
+            PROFILE_FILE: marshal.dumps(stats.stats),
+            PROFILE_TEXT_FILE: profile_text.getvalue().encode("utf-8"),
+            MEMORY_TEXT_FILE: "\n".join(memory_lines).encode("utf-8"),
+            SUMMARY_FILE: json.dumps(summary, indent=2).encode("utf-8"),
+        }
+
+
+def profiled_in_thread(func: Callable) -> Callable:
+    """`func` profiled by the profiler active in the calling context, unchanged when there is none"""
+    profiler = active_profiler.get()
+    return func if profiler is None else profiler.wrap(func)
+
+
+def store_profile(
+    kind: str,
+    profile_id: str,
+    files: dict[str, bytes],
+    store: BaseObjectStore | None = None,
+) -> None:
+    """uploads the rendered files of a profile to the profiles bucket"""
+    store = store or MinioObjectStore()
+    if not store.bucket_exists(PROFILES_BUCKET):
+        store.create_bucket(PROFILES_BUCKET)
+    for file_name, data in files.items():
+        store.upload_object_from_bytes(
+            bucket_name=PROFILES_BUCKET,
+            object_name=joinpath(kind, profile_id, file_name),
+            data=data,
+            length=len(data),
+        )
+    logger.info(f"stored profile {kind}/{profile_id}")
@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+from typing import AsyncIterator
+
+from redis.asyncio import Redis
+
+from tagmate.models.enums import JobStageEnum
+
+
+logger = logging.getLogger("arq.worker")
+
+PROGRESS_CHANNEL = "tagmate:progress:{job_id}"
+PROGRESS_LAST_EVENT_KEY = "tagmate:progress:{job_id}:last"
+PROGRESS_TTL = 60 * 60 * 24  # 1 day
+KEEPALIVE_SECONDS = 15
+
+TERMINAL_STAGES = {JobStageEnum.completed, JobStageEnum.failed, JobStageEnum.aborted}
+
+
+class ProgressReporter:
+    """publishes structured job progress events to redis pub/sub
+
+    The last event is also stored under a key so that watchers connecting
+    mid-job immediately receive the current state.
+    """
+
+    def __init__(self, redis: Redis | None, job_id: str, activity_id: str):
+        self.redis = redis
+        self.job_id = job_id
+        self.activity_id = activity_id
+        self.started_at = time.monotonic()
+        self.channel = PROGRESS_CHANNEL.format(job_id=job_id)
+        self.last_event_key = PROGRESS_LAST_EVENT_KEY.format(job_id=job_id)
+
+    def estimate_eta(self, percent: float) -> float | None:
+        if percent <= 0 or percent >= 100:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return round(elapsed * (100 - percent) / percent, 1)
+
+    async def update(
+        self,
+        stage: JobStageEnum,
+        percent: float,
+        rows_processed: int | None = None,
+        rows_total: int | None = None,
+    ) -> dict:
+        event = {
+            "job_id": self.job_id,
+            "activity_id": str(self.activity_id),
+            "stage": stage,
+            "percent": round(percent, 1),
+            "rows_processed": rows_processed,
+            "rows_total": rows_total,
+            "eta_seconds": self.estimate_eta(percent),
+            "timestamp": time.time(),
+        }
+        if self.redis is None:
+            return event
+
+        # progress reporting must never fail the job itself
+        try:
+            payload = json.dumps(event)
+            await self.redis.set(self.last_event_key, payload, ex=PROGRESS_TTL)
+            await self.redis.publish(self.channel, payload)
+        except Exception as exc:
+            logger.warning(f"could not publish progress for job {self.job_id}: {exc}")
+        return event
+
+
+async def listen_progress(
+    redis: Redis, job_id: str, keepalive: float = KEEPALIVE_SECONDS
+) -> AsyncIterator[dict | None]:
+    """yields progress events for a job until it reaches a terminal stage
+
+    Yields None every `keepalive` seconds without an event so that callers
+    can emit keep-alives and check for client disconnects.
+    """
+    channel = PROGRESS_CHANNEL.format(job_id=job_id)
+    pubsub = redis.pubsub()
+    # subscribe before reading the last event so nothing is missed in between
+    await pubsub.subscribe(channel)
+    try:
+        last_event = await redis.get(PROGRESS_LAST_EVENT_KEY.format(job_id=job_id))
+        if last_event is not None:
+            event = json.loads(last_event)
+            yield event
+            if event["stage"] in TERMINAL_STAGES:
+                return
+
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=keepalive
+            )
+            if message is None:
+                yield None
+                continue
+            event = json.loads(message["data"])
+            yield event
+            if event["stage"] in TERMINAL_STAGES:
+                return
+    finally:
+        await pubsub.unsubscribe(channel)
+        await pubsub.close()
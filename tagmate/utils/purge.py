@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import uuid
+from datetime import timedelta
+from os import getenv as env
+
+from arq.connections import ArqRedis
+from arq.jobs import Job, JobStatus
+
+from tagmate.models.db.activity import (
+    Activity as ActivityTable,
+    ActivityUserMap as ActivityUserTable,
+    Classifier as ClassifierTable,
+    Cluster as ClusterTable,
+    Document as DocumentTable,
+    Job as JobTable,
+    ModelVersion as ModelVersionTable,
+)
+from tagmate.models.enums import ActivityTaskEnum, JobPriorityEnum
+from tagmate.storage.base import BaseObjectStore
+from tagmate.storage.minio import MinioObjectStore
+from tagmate.utils.constants import CHECKPOINTS_BUCKET, LOGS_BUCKET, MODELS_BUCKET, PROFILES_BUCKET, UPLOADS_BUCKET
+from tagmate.utils.database import primary
+from tagmate.utils.profiling import JOB_PROFILES
+from tagmate.utils.queue import clear_finished_job, get_activity_jobs, get_queue_name, request_job_abort
+
+
+logger = logging.getLogger("arq.worker")
+
+PURGE_TASK = "purge_activity"
+# purges are short and io bound, they share the bulk clustering workers
+PURGE_QUEUE_NAME = get_queue_name(ActivityTaskEnum.CLUSTERING, JobPriorityEnum.bulk)
+# rows deleted per statement, so that no delete holds its locks for long
+PURGE_BATCH_SIZE = int(env("PURGE_BATCH_SIZE", 5000))
+# gives aborted jobs of the activity time to stop before their rows are removed
+PURGE_DELAY = int(env("PURGE_DELAY", 30))  # seconds
+
+
+def get_purge_job_id(activity_id: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"tagmate:{PURGE_TASK}:{activity_id}"))
+
+
+async def abort_activity_jobs(redis: ArqRedis, activity_id: str) -> None:
+    """asks the queued and running jobs of an activity to stop, without waiting for them
+
+    Shard and reduce jobs outlive the job which fanned them out, they are aborted too.
+    """
+    for job in await get_activity_jobs(redis, activity_id):
+        if await job.status() not in (JobStatus.deferred, JobStatus.queued, JobStatus.in_progress):
+            continue
+        try:
+            await request_job_abort(redis, job, timeout=0)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def enqueue_purge(redis: ArqRedis, activity_id: str) -> Job | None:
+    """enqueues the purge of a soft deleted activity, once per activity"""
+    job_id = get_purge_job_id(activity_id)
+    await clear_finished_job(redis, job_id, PURGE_QUEUE_NAME)
+    return await redis.enqueue_job(
+        PURGE_TASK,
+        activity_id=activity_id,
+        _job_id=job_id,
+        _queue_name=PURGE_QUEUE_NAME,
+        _defer_by=timedelta(seconds=PURGE_DELAY),
+    )
+
+
+class ActivityPurger:
+    """removes a soft deleted activity, its dependent rows and its objects
+
+    Rows are deleted in batches of primary keys, the activity row itself
+    last, so that an interrupted purge leaves the activity marked deleted
+    and a retry continues where it stopped. Every step is idempotent.
+    """
+
+    def __init__(
+        self,
+        activity_id: str,
+        store: BaseObjectStore | None = None,
+        batch_size: int = PURGE_BATCH_SIZE,
+    ):
+        self.activity_id = activity_id
+        self.store = store or MinioObjectStore()
+        self.batch_size = batch_size
+
+    async def delete_in_batches(self, model, **filters) -> int:
+        deleted = 0
+        while True:
+            ids = await model.filter(**filters).using_db(primary()).limit(self.batch_size).values_list("id", flat=True)
+            if not ids:
+                return deleted
+            deleted += await model.filter(id__in=ids).delete()
+
+    async def delete_documents(self) -> int:
+        """deletes the documents in batches, with the clusters they reference"""
+        deleted = 0
+        while True:
+            rows = await DocumentTable.filter(activity_id=self.activity_id).using_db(primary()).limit(
+                self.batch_size
+            ).values_list("id", "clusters")
+            if not rows:
+                return deleted
+            # clusters have no activity, they are only reachable from their documents
+            cluster_ids = {cluster_id for _, clusters in rows for cluster_id in clusters or []}
+            cluster_ids = list(cluster_ids)
+            for start in range(0, len(cluster_ids), self.batch_size):
+                await ClusterTable.filter(id__in=cluster_ids[start:start + self.batch_size]).delete()
+            deleted += await DocumentTable.filter(id__in=[doc_id for doc_id, _ in rows]).delete()
+
+    async def purge_rows(self) -> None:
+        n_documents = await self.delete_documents()
+        classifier_ids = await ClassifierTable.filter(activity_id=self.activity_id).using_db(primary()).values_list("id", flat=True)
+        if classifier_ids:
+            await self.delete_in_batches(ModelVersionTable, classifier_id__in=classifier_ids)
+            await ClassifierTable.filter(id__in=classifier_ids).delete()
+        await self.delete_in_batches(JobTable, activity_id=self.activity_id)
+        await self.delete_in_batches(ActivityUserTable, activity_id=self.activity_id)
+        logger.info(f"purged {n_documents} documents of activity {self.activity_id}")
+
+    def purge_objects(self, user_id: str, job_ids: list[str]) -> None:
+        # uploads and models live under the owner, checkpoints and logs under the activity
+        activity_prefix = f"{self.activity_id}/"
+        owner_prefix = f"{user_id}/{self.activity_id}/"
+        prefixes = [
+            (UPLOADS_BUCKET, owner_prefix),
+            (MODELS_BUCKET, owner_prefix),
+            (CHECKPOINTS_BUCKET, activity_prefix),
+            (LOGS_BUCKET, activity_prefix),
+        ]
+        # job profiles are named after the job, the activity is only known from its job rows
+        prefixes.extend((PROFILES_BUCKET, f"{JOB_PROFILES}/{job_id}-") for job_id in job_ids)
+        for bucket_name, prefix in prefixes:
+            if self.store.bucket_exists(bucket_name):
+                self.store.remove_objects(bucket_name, prefix=prefix)
+
+    async def purge(self) -> bool:
+        """purges the activity
+
+        Returns:
+            bool: False when there was nothing to purge
+        """
+        activity = await ActivityTable.get_or_none(id=self.activity_id, using_db=primary())
+        if activity is None:
+            return False
+        # objects first, profiles are only found through the job rows purge_rows deletes
+        job_ids = await JobTable.filter(activity_id=self.activity_id).using_db(primary()).values_list("id", flat=True)
+        await asyncio.to_thread(self.purge_objects, str(activity.user_id), [str(job_id) for job_id in job_ids])
+        await self.purge_rows()
+        await activity.delete()
+        return True
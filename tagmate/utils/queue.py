@@ -0,0 +1,291 @@
+import uuid
+from os import getenv as env
+
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+from arq.constants import result_key_prefix
+from arq.jobs import Job, JobStatus
+from redis.asyncio import Redis
+
+from tagmate.models.enums import ActivityTaskEnum, JobPriorityEnum
+from tagmate.utils.metrics import instrument_redis_client
+
+
+REDIS_SETTINGS = RedisSettings(host=env("REDIS_HOST", "redis"), port=env("REDIS_PORT", 6379))
+
+# every task type gets its own queue so long training jobs never block clustering
+QUEUE_NAMES = {
+    ActivityTaskEnum.CLUSTERING: "tagmate:queue:clustering",
+    ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION: "tagmate:queue:multi_label_classification",
+    ActivityTaskEnum.ENTITY_CLASSIFICATION: "tagmate:queue:entity_classification",
+}
+# bulk jobs get a queue of their own per task, served by their own workers,
+# so that a backlog of them never delays interactive jobs
+BULK_QUEUE_NAMES = {task: f"{queue_name}:bulk" for task, queue_name in QUEUE_NAMES.items()}
+LANES = {
+    JobPriorityEnum.interactive: QUEUE_NAMES,
+    JobPriorityEnum.bulk: BULK_QUEUE_NAMES,
+}
+
+# id of the current run of a task on an activity, taken with SET NX to dedupe enqueues
+TASK_LOCK_KEY = "tagmate:activity:{activity_id}:lock:{task}"
+TASK_LOCK_TTL = 60 * 60 * 24 * 7  # 7 days
+# a lock whose run is not found yet is held for this long, the run is enqueued right after the lock is taken
+TASK_LOCK_GRACE = 60  # seconds
+# every job enqueued for an activity, runs and their shard and reduce jobs, with their queue names
+ACTIVITY_JOBS_KEY = "tagmate:activity:{activity_id}:jobs"
+ACTIVITY_JOBS_TTL = 60 * 60 * 24 * 7  # 7 days
+# replaces the lock of a finished run, unless a concurrent request replaced it first
+TAKE_OVER_LOCK_SCRIPT = """
+if (redis.call("get", KEYS[1]) or "") == ARGV[1] then
+    return redis.call("set", KEYS[1], ARGV[2], "EX", ARGV[3])
+end
+return false
+"""
+ACTIVE_JOB_STATUSES = (JobStatus.deferred, JobStatus.queued, JobStatus.in_progress)
+# arq cancels a job on an abort, a timeout and a shutdown alike, this marks the aborts
+ABORT_REQUESTED_KEY = "tagmate:job:{job_id}:abort_requested"
+ABORT_REQUESTED_TTL = 60 * 60 * 24  # 1 day
+
+SHARDS_DONE_KEY = "tagmate:shards:{job_id}:done"
+SHARDS_DONE_TTL = 60 * 60 * 24  # 1 day
+# shard and reduce jobs of a fanned out job, by job id, with their queue names
+FANOUT_JOBS_KEY = "tagmate:shards:{job_id}:jobs"
+# adds a finished shard and counts the finished shards in one step, returns {added, count}
+MARK_SHARD_DONE_SCRIPT = """
+local added = redis.call("sadd", KEYS[1], ARGV[1])
+redis.call("expire", KEYS[1], ARGV[2])
+return {added, redis.call("scard", KEYS[1])}
+"""
+
+_redis_pool: ArqRedis | None = None
+
+
+async def get_redis_pool() -> ArqRedis:
+    """returns the process wide arq redis pool, creating it on first use
+
+    Raises:
+        redis.exceptions.ConnectionError: redis is not reachable
+
+    Returns:
+        ArqRedis: shared arq redis pool
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        instrument_redis_client(ArqRedis)
+        _redis_pool = await create_pool(REDIS_SETTINGS)
+    return _redis_pool
+
+
+async def close_redis_pool() -> None:
+    global _redis_pool
+    if _redis_pool is not None:
+        await _redis_pool.close()
+        _redis_pool = None
+
+
+def get_queue_name(task: ActivityTaskEnum, priority: JobPriorityEnum = JobPriorityEnum.interactive) -> str:
+    return LANES[priority][task]
+
+
+def decode(value: bytes | str | None) -> str | None:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def record_activity_job(redis: Redis, activity_id: str, job_id: str, queue_name: str) -> None:
+    jobs_key = ACTIVITY_JOBS_KEY.format(activity_id=activity_id)
+    await redis.hset(jobs_key, job_id, queue_name)
+    await redis.expire(jobs_key, ACTIVITY_JOBS_TTL)
+
+
+async def get_job(redis: ArqRedis, activity_id: str, job_id: str) -> Job | None:
+    """job of an activity, None when the activity has no job with this id
+
+    Args:
+        redis (ArqRedis): arq redis pool
+        activity_id (str): uuid of the activity
+        job_id (str): id of a run, or of one of its shard or reduce jobs
+
+    Returns:
+        Job | None: the job on the queue it was enqueued to
+    """
+    queue_name = await redis.hget(ACTIVITY_JOBS_KEY.format(activity_id=activity_id), job_id)
+    if queue_name is None:
+        return None
+    return Job(job_id=job_id, redis=redis, _queue_name=decode(queue_name))
+
+
+async def get_activity_jobs(redis: ArqRedis, activity_id: str) -> list[Job]:
+    """every job enqueued for an activity within ACTIVITY_JOBS_TTL"""
+    jobs = await redis.hgetall(ACTIVITY_JOBS_KEY.format(activity_id=activity_id))
+    return [
+        Job(job_id=decode(job_id), redis=redis, _queue_name=decode(queue_name))
+        for job_id, queue_name in jobs.items()
+    ]
+
+
+async def clear_finished_job(redis: ArqRedis, job_id: str, queue_name: str) -> None:
+    """removes the result of a finished job so that its id can be enqueued again"""
+    previous_job = Job(job_id=job_id, redis=redis, _queue_name=queue_name)
+    if await previous_job.status() == JobStatus.complete:
+        await redis.delete(result_key_prefix + job_id)
+
+
+async def enqueue_unique_job(
+    redis: ArqRedis,
+    task: ActivityTaskEnum,
+    activity_id: str,
+    priority: JobPriorityEnum = JobPriorityEnum.interactive,
+    **kwargs,
+) -> tuple[str, Job | None]:
+    """enqueues a run of a task on the queue of its lane, unless the task is already queued or running
+
+    Every run gets a job id of its own, so that earlier runs keep their
+    results, job rows, logs and profiles. The lock of the task on the activity
+    holds the id of its current run. It is taken with SET NX, so concurrent
+    requests coalesce into a single run, and taken over once that run finished.
+
+    Args:
+        redis (ArqRedis): arq redis pool
+        task (ActivityTaskEnum): task to run on the activity
+        activity_id (str): uuid of the activity
+        priority (JobPriorityEnum): lane of the job
+
+    Returns:
+        tuple[str, Job | None]: id of the new run and its job, or the id of the
+            run already queued or running and None
+    """
+    job_id = str(uuid.uuid4())
+    queue_name = get_queue_name(task, priority)
+    lock_key = TASK_LOCK_KEY.format(activity_id=activity_id, task=task.value)
+
+    # recorded before the lock is taken, so that a concurrent request finds the run holding it
+    await record_activity_job(redis, activity_id, job_id, queue_name)
+    if not await redis.set(lock_key, job_id, ex=TASK_LOCK_TTL, nx=True):
+        holder = await take_over_task_lock(redis, activity_id, lock_key, job_id)
+        if holder is not None:
+            await redis.hdel(ACTIVITY_JOBS_KEY.format(activity_id=activity_id), job_id)
+            return holder, None
+
+    job = await redis.enqueue_job(
+        task,
+        activity_id=activity_id,
+        _job_id=job_id,
+        _queue_name=queue_name,
+        **kwargs,
+    )
+    return job_id, job
+
+
+async def is_run_active(redis: ArqRedis, activity_id: str, job_id: str, lock_key: str) -> bool:
+    """whether a run, or a shard or reduce job it enqueued, is still queued or running"""
+    jobs = [await get_job(redis, activity_id, job_id), *await get_fanout_jobs(redis, job_id)]
+    statuses = [await job.status() for job in jobs if job is not None]
+    if any(status in ACTIVE_JOB_STATUSES for status in statuses):
+        return True
+    if JobStatus.complete in statuses:
+        return False
+    # not enqueued yet by the request which took the lock, or its result expired long ago
+    return TASK_LOCK_TTL - await redis.ttl(lock_key) < TASK_LOCK_GRACE
+
+
+async def take_over_task_lock(redis: ArqRedis, activity_id: str, lock_key: str, job_id: str) -> str | None:
+    """takes the lock of a task over for `job_id` from a run which finished
+
+    Returns:
+        str | None: None when the lock was taken over, the id of the run holding it otherwise
+    """
+    holder = decode(await redis.get(lock_key))
+    if holder is not None and await is_run_active(redis, activity_id, holder, lock_key):
+        return holder
+    if await redis.eval(TAKE_OVER_LOCK_SCRIPT, 1, lock_key, holder or "", job_id, TASK_LOCK_TTL):
+        return None
+    # another request took it over first
+    return decode(await redis.get(lock_key)) or holder
+
+
+async def request_job_abort(redis: ArqRedis, job: Job, timeout: float | None = None) -> bool:
+    """aborts a job, marking the abort first so that the job records itself as aborted rather than failed
+
+    Args:
+        redis (ArqRedis): arq redis pool
+        job (Job): job to abort
+        timeout (float | None): seconds to wait for the job to stop, None waits until it does
+
+    Raises:
+        asyncio.TimeoutError: the job did not stop within `timeout`
+
+    Returns:
+        bool: whether the job was aborted
+    """
+    await redis.set(ABORT_REQUESTED_KEY.format(job_id=job.job_id), 1, ex=ABORT_REQUESTED_TTL)
+    return await job.abort(timeout=timeout)
+
+
+async def is_abort_requested(redis: Redis, job_id: str) -> bool:
+    return bool(await redis.exists(ABORT_REQUESTED_KEY.format(job_id=job_id)))
+
+
+async def reset_shards(redis: ArqRedis, job_id: str) -> None:
+    await redis.delete(SHARDS_DONE_KEY.format(job_id=job_id), FANOUT_JOBS_KEY.format(job_id=job_id))
+
+
+async def enqueue_fanout_job(
+    redis: ArqRedis,
+    activity_id: str,
+    coordinator_job_id: str,
+    task: str,
+    job_id: str,
+    queue_name: str,
+    **kwargs,
+) -> Job | None:
+    """enqueues a shard or reduce job of a fanned out job
+
+    The job is recorded under the job it belongs to and under the activity,
+    so that aborting or purging either reaches it too.
+
+    Args:
+        redis (ArqRedis): arq redis pool
+        activity_id (str): uuid of the activity
+        coordinator_job_id (str): id of the job which fanned out
+        task (str): name of the shard or reduce task
+        job_id (str): id of the shard or reduce job
+        queue_name (str): queue of the shard or reduce job
+
+    Returns:
+        Job | None: the job, or None if it was already queued
+    """
+    await clear_finished_job(redis, job_id, queue_name)
+    jobs_key = FANOUT_JOBS_KEY.format(job_id=coordinator_job_id)
+    await redis.hset(jobs_key, job_id, queue_name)
+    await redis.expire(jobs_key, SHARDS_DONE_TTL)
+    await record_activity_job(redis, activity_id, job_id, queue_name)
+    return await redis.enqueue_job(
+        task, activity_id=activity_id, _job_id=job_id, _queue_name=queue_name, **kwargs
+    )
+
+
+async def get_fanout_jobs(redis: ArqRedis, coordinator_job_id: str) -> list[Job]:
+    """shard and reduce jobs enqueued by the last run of a fanned out job"""
+    jobs = await redis.hgetall(FANOUT_JOBS_KEY.format(job_id=coordinator_job_id))
+    return [
+        Job(job_id=decode(job_id), redis=redis, _queue_name=decode(queue_name))
+        for job_id, queue_name in jobs.items()
+    ]
+
+
+async def mark_shard_done(redis: ArqRedis, job_id: str, shard_idx: int, n_shards: int) -> tuple[int, bool]:
+    """records a finished shard of a fanned out job
+
+    A set rather than a counter is used so that retried shards are only
+    counted once. The shard is added and the set counted atomically, so of
+    shards finishing together exactly one sees the set complete.
+
+    Returns:
+        tuple[int, bool]: number of distinct shards finished so far, and
+            whether this shard completed the set and so finishes the job
+    """
+    added, n_done = await redis.eval(
+        MARK_SHARD_DONE_SCRIPT, 1, SHARDS_DONE_KEY.format(job_id=job_id), shard_idx, SHARDS_DONE_TTL
+    )
+    return n_done, bool(added) and n_done == n_shards
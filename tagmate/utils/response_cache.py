@@ -0,0 +1,174 @@
+import logging
+import time
+import uuid
+from functools import lru_cache
+from os import getenv as env
+from typing import Any, Awaitable, Callable
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+from redis.asyncio import Redis
+from tortoise import BaseDBAsyncClient
+
+from tagmate.utils.database import primary
+from tagmate.utils.queue import get_redis_pool
+
+
+logger = logging.getLogger("arq.worker")
+
+# cached responses of a version are dropped by redis once this is over, bumped versions are never read again
+RESPONSE_CACHE_TTL = int(env("RESPONSE_CACHE_TTL", 60 * 60))  # seconds, 0 only keeps the etags
+# larger responses are not cached, clients still get a 304 when their etag is current
+RESPONSE_CACHE_MAX_BYTES = int(env("RESPONSE_CACHE_MAX_BYTES", 16 * 1024**2))
+# a lost version is replaced by a new random one, which only costs cache misses
+ACTIVITY_VERSION_TTL = int(env("ACTIVITY_VERSION_TTL", 60 * 60 * 24 * 7))  # seconds
+ACTIVITY_VERSION_KEY = "tagmate:activity:{activity_id}:version"
+# versions younger than this are loaded from the primary, the replica may not have their writes yet
+REPLICA_MAX_LAG = float(env("REPLICA_MAX_LAG", 5))  # seconds
+RESPONSE_CACHE_KEY = "tagmate:cache:{activity_id}:{version}:{name}"
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def new_version() -> str:
+    # random rather than a counter, a version key lost by redis can never hand out an old etag again,
+    # prefixed with the time of the bump in milliseconds to tell whether the replica has caught up
+    return f"{int(time.time() * 1000):x}.{uuid.uuid4().hex}"
+
+
+def read_connection(version: str | None) -> BaseDBAsyncClient | None:
+    """connection to load a response of `version` from, None for the replica
+
+    The replica serves a version once it is older than REPLICA_MAX_LAG. Newer
+    versions, and versions of unknown age, are loaded from the primary so
+    that the response has every write the version was bumped for.
+    """
+    bumped_at, _, _ = (version or "").partition(".")
+    try:
+        age = time.time() - int(bumped_at, 16) / 1000
+    except ValueError:
+        return primary()
+    return None if age >= REPLICA_MAX_LAG else primary()
+
+
+async def get_activity_version(redis: Redis, activity_id: str) -> str:
+    key = ACTIVITY_VERSION_KEY.format(activity_id=activity_id)
+    version = await redis.get(key)
+    if version is None:
+        await redis.set(key, new_version(), ex=ACTIVITY_VERSION_TTL, nx=True)
+        version = await redis.get(key)
+    return version.decode() if isinstance(version, bytes) else version
+
+
+async def bump_activity_version(activity_id: str, redis: Redis | None = None) -> None:
+    """invalidates the cached responses and etags of an activity
+
+    Called after every write to the activity, its documents or its users.
+    A failure is logged rather than raised, the write itself went through.
+    """
+    try:
+        redis = redis or await get_redis_pool()
+        await redis.set(ACTIVITY_VERSION_KEY.format(activity_id=activity_id), new_version(), ex=ACTIVITY_VERSION_TTL)
+    except Exception as exc:
+        logger.warning(f"could not bump the version of activity {activity_id}: {exc}")
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, as If-None-Match asks for
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+@lru_cache
+def type_adapter(response_type: Any) -> TypeAdapter:
+    return TypeAdapter(response_type)
+
+
+def serialize(response_type: Any, content: Any) -> bytes:
+    """json of orm objects validated against the response model of the endpoint"""
+    adapter = type_adapter(response_type)
+    return adapter.dump_json(adapter.validate_python(content, from_attributes=True))
+
+
+async def read_activity_version(activity_id: str) -> tuple[Redis | None, str | None]:
+    """redis pool and current version of the activity, both None while redis is unreachable"""
+    try:
+        redis = await get_redis_pool()
+        return redis, await get_activity_version(redis, activity_id)
+    except Exception as exc:
+        # fails open, reads keep working without the cache while redis is unreachable
+        logger.warning(f"could not read the version of activity {activity_id}: {exc}")
+        return None, None
+
+
+def revalidate(request: Request, version: str) -> tuple[dict, Response | None]:
+    """etag headers of the version, and a 304 when the client has it already"""
+    etag = f'"{version}"'
+    # revalidated on every use, the etag makes that cheap
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+async def fill_response(
+    redis: Redis,
+    key: str,
+    version: str,
+    load: Callable[[BaseDBAsyncClient | None], Awaitable[bytes]],
+) -> bytes:
+    """the cached response under `key`, loaded and cached on a miss"""
+    if RESPONSE_CACHE_TTL:
+        try:
+            content = await redis.get(key)
+            if content is not None:
+                return content
+        except Exception as exc:
+            logger.warning(f"could not read the cached response {key}: {exc}")
+
+    content = await load(read_connection(version))
+    if RESPONSE_CACHE_TTL and len(content) <= RESPONSE_CACHE_MAX_BYTES:
+        try:
+            await redis.set(key, content, ex=RESPONSE_CACHE_TTL)
+        except Exception as exc:
+            logger.warning(f"could not cache the response {key}: {exc}")
+    return content
+
+
+async def cached_activity_response(
+    request: Request,
+    activity_id: str,
+    name: str,
+    load: Callable[[BaseDBAsyncClient | None], Awaitable[bytes]],
+) -> Response:
+    """json response of an activity read, served from redis while the activity is unchanged
+
+    Responses are keyed by the current version of the activity, so a bump
+    makes every cached response of it unreachable at once. The version is the
+    etag, a client sending it back in If-None-Match gets a 304 without the
+    response being loaded. Access to the activity must be checked before.
+
+    Args:
+        request (Request): request, for its If-None-Match header
+        activity_id (str): uuid of the activity
+        name (str): name of the response, unique among the reads of an activity
+        load (Callable[[BaseDBAsyncClient | None], Awaitable[bytes]]): loads the response json on a
+            miss, from the given connection or from the replica when it is None
+
+    Returns:
+        Response: the json response, or a 304 without a body
+    """
+    redis, version = await read_activity_version(activity_id)
+    if version is None:
+        return Response(content=await load(primary()), media_type=JSON_MEDIA_TYPE)
+
+    headers, not_modified = revalidate(request, version)
+    if not_modified is not None:
+        return not_modified
+
+    key = RESPONSE_CACHE_KEY.format(activity_id=activity_id, version=version, name=name)
+    content = await fill_response(redis, key, version, load)
+    return Response(content=content, media_type=JSON_MEDIA_TYPE, headers=headers)
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import orjson
+from tortoise import BaseDBAsyncClient
+
+from tagmate.models.db.activity import Document as DocumentTable
+
+
+# fields of the `Document` response model, in the order of the response
+DOCUMENT_COLUMNS = (
+    "id",
+    "index",
+    "text",
+    "labels",
+    "clusters",
+    "is_auto_generated",
+    "is_user_validated",
+    "created_at",
+    "updated_at",
+)
+JSON_COLUMNS = {DOCUMENT_COLUMNS.index("labels"), DOCUMENT_COLUMNS.index("clusters")}
+
+
+def documents_json(rows: list[tuple]) -> bytes:
+    """json of document rows read with `values_list(*DOCUMENT_COLUMNS)`
+
+    The rows are read from the database as tuples and encoded as they are,
+    without building a model instance or a pydantic object per document.
+    """
+    documents = []
+    for row in rows:
+        document = dict(zip(DOCUMENT_COLUMNS, row))
+        for position in JSON_COLUMNS:
+            value = row[position]
+            # some drivers return json columns as text
+            if isinstance(value, str):
+                document[DOCUMENT_COLUMNS[position]] = json.loads(value)
+        documents.append(document)
+    return orjson.dumps(documents)
+
+
+async def load_documents_json(activity_id: str, using_db: BaseDBAsyncClient | None = None) -> bytes:
+    """json of the documents of an activity, in the shape of `list[Document]`"""
+    query = DocumentTable.filter(activity_id=activity_id)
+    if using_db is not None:
+        query = query.using_db(using_db)
+    rows = await query.values_list(*DOCUMENT_COLUMNS)
+    # encoding a large activity takes a while, it runs off the event loop
+    return await asyncio.to_thread(documents_json, rows)
@@ -1,11 +1,13 @@
 from tortoise import exceptions as TortoiseExceptions
+from tortoise.backends.base.client import BaseDBAsyncClient
 
 from tagmate.exceptions import activity as ActivityExceptions
 from tagmate.exceptions import auth as AuthExceptions
 from tagmate.models.db.activity import Activity as ActivityTable, ActivityUserMap as ActivityUserTable
 from tagmate.models.db.user import User as UserTable
+from tagmate.models.enums import ActivityStatusEnum
 from tagmate.models.py.activity import Activity, ActivityId
-from tagmate.models.py.user import User
+from tagmate.models.py.user import TokenClaims, User
 from tagmate.logging.app import logger
 
 
@@ -29,6 +31,29 @@ async def validate_user_exists(email: str) -> User:
         raise AuthExceptions.InvalidUsername()
 
 
+async def validate_token_user(claims: TokenClaims) -> User:
+    """checks if the user of a verified token exists in the database
+
+    Tokens carry the user id, so the user is read by primary key. Tokens
+    issued before the id was embedded fall back to the email.
+
+    Args:
+        claims (TokenClaims): claims of the verified token
+
+    Raises:
+        AuthExceptions.InvalidUsername: user of the token does not exist in the database
+
+    Returns:
+        User: user details
+    """
+    if claims.user_id is None:
+        return await validate_user_exists(claims.email)
+    try:
+        return await UserTable.get(id=claims.user_id)
+    except TortoiseExceptions.DoesNotExist:
+        raise AuthExceptions.InvalidUsername()
+
+
 async def validate_activity_exists(activity_id: str) -> Activity:
     """checks if the given activity exists for the given user
 
@@ -43,18 +68,22 @@ async def validate_activity_exists(activity_id: str) -> Activity:
         Activity: activity details
     """
     try:
-        activity = await ActivityTable.get(id=activity_id)
+        # soft deleted activities are gone for the api while their purge is pending
+        activity = await ActivityTable.get(id=activity_id, status__not=ActivityStatusEnum.DELETED)
         return activity
     except TortoiseExceptions.DoesNotExist as exc:
         raise ActivityExceptions.ActivityDoesNotExist(exception=exc)
     
 
-async def validate_activity_user(user_id: str, activity_id: str) -> ActivityId:
+async def validate_activity_user(
+    user_id: str, activity_id: str, using_db: BaseDBAsyncClient | None = None
+) -> ActivityId:
     """checks if the given activity exists for the given user
 
     Args:
         user_id (str): uuid of the user
         activity_id (str): uuid of the activity
+        using_db (BaseDBAsyncClient | None): connection to read from, defaults to the routed read connection
 
     Raises:
         ActivityExceptions.ActivityDoesNotExist: activity does not exist for the given user
@@ -63,7 +92,26 @@ async def validate_activity_user(user_id: str, activity_id: str) -> ActivityId:
         Activity: activity details
     """
     try:
-        activity_id = await ActivityUserTable.get(user_id=user_id, activity_id=activity_id)
+        activity_id = await ActivityUserTable.get(user_id=user_id, activity_id=activity_id, using_db=using_db)
         return activity_id
     except TortoiseExceptions.DoesNotExist as exc:
         raise ActivityExceptions.ActivityDoesNotExist(exception=exc)
+
+
+async def validate_user_is_admin(claims: TokenClaims) -> User:
+    """checks if the user of a verified token exists and is an admin
+
+    Args:
+        claims (TokenClaims): claims of the verified token
+
+    Raises:
+        AuthExceptions.InvalidUsername: username/email does not exist in the database
+        AuthExceptions.NotAnAdmin: the user is not an admin
+
+    Returns:
+        User: user details
+    """
+    user = await validate_token_user(claims)
+    if not user.is_admin:
+        raise AuthExceptions.NotAnAdmin()
+    return user
@@ -1,73 +1,376 @@
+import asyncio
+import functools
+import time
 from os import getenv as env
+from arq import func
 from arq.connections import RedisSettings
 from httpx import AsyncClient
+from prometheus_client import start_http_server
 
 from tagmate.classifiers.entity_classification import EntityClassifier
-from tagmate.classifiers.multi_label_classification import MultiLabelClassifier
-from tagmate.classifiers.clustering import ClusterBuilder
-from tagmate.models.enums import ActivityTaskEnum, JobStatusEnum
-from tagmate.logging.worker import LOG_LEVEL, BASELOGFMT, DATEFMT, JobLogger
+from tagmate.classifiers.multi_label_classification import PREDICTION_TASK, MultiLabelClassifier
+from tagmate.classifiers.sharded_clustering import REDUCE_TASK, SHARD_TASK, ShardedClusterBuilder
+from tagmate.models.enums import ActivityTaskEnum, JobPriorityEnum, JobStageEnum, JobStatusEnum
+from tagmate.logging.worker import LOG_LEVEL, JobLogger, queue_handler
 from tagmate.utils.database import db_init
+from tagmate.utils.metrics import WORKER_METRICS_PORT, instrument_redis_client, observe_job, report_queue_depth
+from tagmate.utils.profiling import JOB_PROFILES, Profiler, ProfilerBusy, active_profiler, is_truthy, store_profile
+from tagmate.utils.progress import ProgressReporter
+from tagmate.utils.purge import PURGE_TASK, ActivityPurger
+from tagmate.utils.queue import BULK_QUEUE_NAMES, QUEUE_NAMES, get_queue_name, is_abort_requested, mark_shard_done
+from tagmate.utils.response_cache import bump_activity_version
 from tagmate.models.db.activity import Job as JobTable
+from tagmate.storage.checkpoint import JobCheckpoint
+from tagmate.storage.job_logs import store_job_logs
 import logging
 
 logger = logging.getLogger("arq")
 
 
-JOB_TIMEOUT = 60 * 60 * 30  # 3 hours
+JOB_TIMEOUT = 60 * 60 * 30  # 30 hours
+
+CLUSTERING_MAX_JOBS = int(env("CLUSTERING_MAX_JOBS", 4))
+CLUSTERING_BULK_MAX_JOBS = int(env("CLUSTERING_BULK_MAX_JOBS", CLUSTERING_MAX_JOBS))
+CLUSTERING_JOB_TIMEOUT = int(env("CLUSTERING_JOB_TIMEOUT", 60 * 60))  # 1 hour
+CLASSIFICATION_MAX_JOBS = int(env("CLASSIFICATION_MAX_JOBS", 1))
+CLASSIFICATION_BULK_MAX_JOBS = int(env("CLASSIFICATION_BULK_MAX_JOBS", CLASSIFICATION_MAX_JOBS))
+CLASSIFICATION_JOB_TIMEOUT = int(env("CLASSIFICATION_JOB_TIMEOUT", JOB_TIMEOUT))
 
 
 async def startup(ctx):
     ctx["session"] = AsyncClient()
+    # the pool of the worker is created by arq, its class is instrumented here rather than on import
+    instrument_redis_client(type(ctx["redis"]))
+    try:
+        start_http_server(WORKER_METRICS_PORT)
+    except OSError as exc:
+        logger.warning(f"could not start the metrics exporter on port {WORKER_METRICS_PORT}: {exc}")
+    ctx["queue_depth"] = asyncio.create_task(
+        report_queue_depth(ctx["redis"], [*QUEUE_NAMES.values(), *BULK_QUEUE_NAMES.values()])
+    )
 
 
 async def shutdown(ctx):
+    ctx["queue_depth"].cancel()
     await ctx["session"].aclose()
 
 
+def get_job_checkpoint(ctx, activity_id: str) -> JobCheckpoint:
+    """checkpoint of the running job, state left by an earlier attempt is
+    discarded unless this is a retry of an attempt which did not finish
+    """
+    checkpoint = JobCheckpoint(activity_id=activity_id, job_id=ctx.get("job_id"))
+    if ctx.get("job_try", 1) == 1:
+        checkpoint.clear()
+    return checkpoint
+
+
+def start_job_profiler(ctx, name: str, metadata: dict) -> Profiler | None:
+    """profiler of the job when it was enqueued with `metadata={"profile": True}`"""
+    if not is_truthy(metadata.get("profile")):
+        return None
+    # one profile per attempt, retries of a job share its id
+    profiler = Profiler(JOB_PROFILES, f"{ctx.get('job_id')}-{int(time.time())}", name)
+    try:
+        profiler.start()
+    except ProfilerBusy:
+        logger.warning(f"another job of this worker is being profiled, running {ctx.get('job_id')} unprofiled")
+        return None
+    return profiler
+
+
+async def stop_job_profiler(profiler: Profiler | None) -> None:
+    if profiler is None:
+        return
+    files = profiler.stop()
+    try:
+        await asyncio.to_thread(store_profile, profiler.kind, profiler.profile_id, files)
+    except Exception as exc:
+        logger.warning(f"could not store profile {profiler.profile_id}: {exc}")
+
+
+def profile_job(func):
+    """decorator profiling an arq job function when it was enqueued with `metadata={"profile": True}`
+
+    The profiler is active for the context of the job, stages run through
+    `CancellationToken.run` are profiled in their worker thread too.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        profiler = start_job_profiler(ctx, func.__name__, kwargs.get("metadata") or {})
+        token = active_profiler.set(profiler)
+        try:
+            return await func(ctx, *args, **kwargs)
+        finally:
+            active_profiler.reset(token)
+            await stop_job_profiler(profiler)
+
+    return wrapper
+
+
+def get_job_logger(ctx) -> JobLogger:
+    return JobLogger(job_id=ctx.get("job_id"), capture=True)
+
+
+async def save_job_logs(ctx, activity_id: str, job_logger: JobLogger, coordinator_job_id: str | None = None) -> None:
+    """stores the captured logs of this attempt, next to those of the job it belongs to"""
+    data = job_logger.captured_logs()
+    attempt_id = f"{ctx.get('job_id')}.{ctx.get('job_try', 1)}"
+    try:
+        await asyncio.to_thread(
+            store_job_logs,
+            activity_id,
+            coordinator_job_id or ctx.get("job_id"),
+            attempt_id,
+            data,
+        )
+    except Exception as exc:
+        logger.warning(f"could not store the logs of job {ctx.get('job_id')}: {exc}")
+
+
 async def update_job_status(id: str, status: str | JobStatusEnum):
     await db_init()
     await JobTable(id=id, status=status).save(update_fields=["status", "updated_at"])
 
 
+async def record_cancelled(ctx, job_id: str, progress: ProgressReporter) -> None:
+    """records a cancelled job as aborted when the abort came through the api, as failed otherwise
+
+    arq cancels the job too when it hits its timeout, or when the worker shuts
+    down, in which case arq runs it again and the job marks itself in progress.
+    """
+    ctx["aborted"] = await is_abort_requested(ctx["redis"], ctx.get("job_id"))
+    if ctx["aborted"]:
+        await update_job_status(job_id, JobStatusEnum.aborted)
+        await progress.update(JobStageEnum.aborted, 0)
+    else:
+        await update_job_status(job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+
+
+@observe_job
+@profile_job
 async def multi_label_classification(ctx, activity_id: int, metadata: dict = {}):
     job_id = ctx.get("job_id")
-    job_logger = JobLogger(job_id=job_id)
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=job_id, activity_id=activity_id
+    )
+
+    checkpoint = get_job_checkpoint(ctx, activity_id)
 
     classifier = MultiLabelClassifier(
         activity_id=activity_id,
         logger=job_logger,
+        progress=progress,
+        checkpoint=checkpoint,
     )
     try:
-        await classifier.train_classifier()
+        # set before the prediction shards are enqueued, so that it never overwrites their status
+        await update_job_status(job_id, JobStatusEnum.in_progress)
+        n_shards = await classifier.train_classifier(redis=ctx.get("redis"), job_id=job_id)
+        if n_shards:
+            # the last prediction shard marks the job as completed
+            return n_shards
+        checkpoint.clear()
         await update_job_status(job_id, JobStatusEnum.success)
-    except Exception as exc:
+        await progress.update(JobStageEnum.completed, 100)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, job_id, progress)
+        raise
+    except Exception:
         await update_job_status(job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
         raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger)
+        # cached reads of the activity include the labels and clusters written back
+        await bump_activity_version(activity_id, ctx.get("redis"))
 
 
+@observe_job
+async def multi_label_prediction(
+    ctx,
+    activity_id: str,
+    coordinator_job_id: str,
+    shard_idx: int,
+    n_shards: int,
+    first_id: str,
+    last_id: str,
+    model_version_id: str | None = None,
+):
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=coordinator_job_id, activity_id=activity_id
+    )
+    classifier = MultiLabelClassifier(
+        activity_id=activity_id,
+        logger=job_logger,
+        progress=progress,
+    )
+    try:
+        await classifier.run_prediction_shard(first_id, last_id, model_version_id)
+        n_done, is_last = await mark_shard_done(ctx["redis"], coordinator_job_id, shard_idx, n_shards)
+        await progress.update(JobStageEnum.predict, 70 + 25 * n_done / n_shards, n_done, n_shards)
+        if is_last:
+            JobCheckpoint(activity_id=activity_id, job_id=coordinator_job_id).clear()
+            await update_job_status(coordinator_job_id, JobStatusEnum.success)
+            await progress.update(JobStageEnum.completed, 100)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, coordinator_job_id, progress)
+        raise
+    except Exception:
+        await update_job_status(coordinator_job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+        raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger, coordinator_job_id)
+        await bump_activity_version(activity_id, ctx.get("redis"))
+
+
+@observe_job
+@profile_job
 async def entity_classification(ctx, activity_id: int, metadata: dict = {}):
     job_id = ctx.get("job_id")
-    job_logger = JobLogger(job_id=job_id)
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=job_id, activity_id=activity_id
+    )
+    checkpoint = get_job_checkpoint(ctx, activity_id)
+
     classifier = EntityClassifier(
         activity_id=activity_id,
+        logger=job_logger,
+        progress=progress,
+        checkpoint=checkpoint,
     )
-    response = await classifier.train_classifier()
-    return response
+    try:
+        await update_job_status(job_id, JobStatusEnum.in_progress)
+        await classifier.train_classifier()
+        checkpoint.clear()
+        await update_job_status(job_id, JobStatusEnum.success)
+        await progress.update(JobStageEnum.completed, 100)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, job_id, progress)
+        raise
+    except Exception:
+        await update_job_status(job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+        raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger)
+        await bump_activity_version(activity_id, ctx.get("redis"))
 
 
-async def clustering(ctx, activity_id: int):
+@observe_job
+@profile_job
+async def clustering(ctx, activity_id: int, metadata: dict = {}):
     job_id = ctx.get("job_id")
-    job_logger = JobLogger(job_id=job_id)
-    builder = ClusterBuilder(
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=job_id, activity_id=activity_id
+    )
+    checkpoint = get_job_checkpoint(ctx, activity_id)
+    builder = ShardedClusterBuilder(
         activity_id=activity_id,
+        coordinator_job_id=job_id,
         logger=job_logger,
+        progress=progress,
+        checkpoint=checkpoint,
     )
-    response = await builder.run_clustering()
+    try:
+        await update_job_status(job_id, JobStatusEnum.in_progress)
+        await progress.update(JobStageEnum.fetch, 0)
+        await builder.prepare_sentences()
+        if builder.should_shard():
+            # the reduce job writes the clusters back and marks the job as completed
+            return await builder.enqueue_shards(ctx["redis"])
+        response = await builder.cluster_sentences()
+        checkpoint.clear()
+        await update_job_status(job_id, JobStatusEnum.success)
+        await progress.update(JobStageEnum.completed, 100)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, job_id, progress)
+        raise
+    except Exception:
+        await update_job_status(job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+        raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger)
+        await bump_activity_version(activity_id, ctx.get("redis"))
     return response
 
 
+@observe_job
+async def clustering_shard(ctx, activity_id: str, coordinator_job_id: str, shard_idx: int):
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=coordinator_job_id, activity_id=activity_id
+    )
+    builder = ShardedClusterBuilder(
+        activity_id=activity_id,
+        coordinator_job_id=coordinator_job_id,
+        logger=job_logger,
+        progress=progress,
+    )
+    try:
+        await builder.run_shard(ctx["redis"], shard_idx)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, coordinator_job_id, progress)
+        raise
+    except Exception:
+        # the reduce job is only enqueued once every shard is done, so the job stops here
+        await update_job_status(coordinator_job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+        raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger, coordinator_job_id)
+
+
+@observe_job
+async def clustering_reduce(ctx, activity_id: str, coordinator_job_id: str):
+    job_logger = get_job_logger(ctx)
+    progress = ProgressReporter(
+        redis=ctx.get("redis"), job_id=coordinator_job_id, activity_id=activity_id
+    )
+    builder = ShardedClusterBuilder(
+        activity_id=activity_id,
+        coordinator_job_id=coordinator_job_id,
+        logger=job_logger,
+        progress=progress,
+    )
+    try:
+        await builder.run_reduce()
+        await update_job_status(coordinator_job_id, JobStatusEnum.success)
+        await progress.update(JobStageEnum.completed, 100)
+    except asyncio.CancelledError:
+        await record_cancelled(ctx, coordinator_job_id, progress)
+        raise
+    except Exception:
+        await update_job_status(coordinator_job_id, JobStatusEnum.failed)
+        await progress.update(JobStageEnum.failed, 0)
+        raise
+    finally:
+        await save_job_logs(ctx, activity_id, job_logger, coordinator_job_id)
+        await bump_activity_version(activity_id, ctx.get("redis"))
+
+
+@observe_job
+async def purge_activity(ctx, activity_id: str):
+    await db_init()
+    return await ActivityPurger(activity_id=activity_id).purge()
+
+
 class WorkerSettings:
+    """shared settings, run one of the per-queue subclasses below
+
+    Every task has an interactive and a bulk queue, each served by workers of
+    its own. Shard and reduce jobs are enqueued to the queue of the worker
+    which fanned them out, so they stay in the lane of their job.
+    """
+
     functions = [clustering, multi_label_classification, entity_classification]
     on_startup = startup
     on_shutdown = shutdown
@@ -76,18 +379,58 @@ class WorkerSettings:
     allow_abort_jobs = True
 
 
+class ClusteringWorkerSettings(WorkerSettings):
+    functions = [
+        clustering,
+        func(clustering_shard, name=SHARD_TASK),
+        func(clustering_reduce, name=REDUCE_TASK),
+        func(purge_activity, name=PURGE_TASK),
+    ]
+    queue_name = get_queue_name(ActivityTaskEnum.CLUSTERING)
+    max_jobs = CLUSTERING_MAX_JOBS
+    job_timeout = CLUSTERING_JOB_TIMEOUT
+
+
+class ClusteringBulkWorkerSettings(ClusteringWorkerSettings):
+    queue_name = get_queue_name(ActivityTaskEnum.CLUSTERING, JobPriorityEnum.bulk)
+    max_jobs = CLUSTERING_BULK_MAX_JOBS
+
+
+class MultiLabelClassificationWorkerSettings(WorkerSettings):
+    functions = [
+        multi_label_classification,
+        func(multi_label_prediction, name=PREDICTION_TASK),
+    ]
+    queue_name = get_queue_name(ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION)
+    max_jobs = CLASSIFICATION_MAX_JOBS
+    job_timeout = CLASSIFICATION_JOB_TIMEOUT
+
+
+class MultiLabelClassificationBulkWorkerSettings(MultiLabelClassificationWorkerSettings):
+    queue_name = get_queue_name(ActivityTaskEnum.MULTI_LABEL_CLASSIFICATION, JobPriorityEnum.bulk)
+    max_jobs = CLASSIFICATION_BULK_MAX_JOBS
+
+
+class EntityClassificationWorkerSettings(WorkerSettings):
+    functions = [entity_classification]
+    queue_name = get_queue_name(ActivityTaskEnum.ENTITY_CLASSIFICATION)
+    max_jobs = CLASSIFICATION_MAX_JOBS
+    job_timeout = CLASSIFICATION_JOB_TIMEOUT
+
+
+class EntityClassificationBulkWorkerSettings(EntityClassificationWorkerSettings):
+    queue_name = get_queue_name(ActivityTaskEnum.ENTITY_CLASSIFICATION, JobPriorityEnum.bulk)
+    max_jobs = CLASSIFICATION_BULK_MAX_JOBS
+
+
 LoggerSettings = {
     "version": 1,
     "disable_existing_loggers": False,
     "handlers": {
-        "standard": {
-            "level": LOG_LEVEL,
-            "class": "logging.StreamHandler",
-            "formatter": "standard",
-        },
+        # the queue handler of the other worker loggers, so arq does not write to stdout itself
+        "queue": {"()": lambda: queue_handler},
     },
-    "formatters": {"standard": {"format": BASELOGFMT, "datefmt": DATEFMT}},
     "loggers": {
-        "arq": {"handlers": ["standard"], "level": LOG_LEVEL},
+        "arq": {"handlers": ["queue"], "level": LOG_LEVEL},
     },
 }